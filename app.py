@@ -1,18 +1,37 @@
 # app.py - ПОЛНОСТЬЮ ИСПРАВЛЕННЫЙ КОД
-from flask import Flask, render_template, jsonify, request, session, redirect, url_for, flash, send_from_directory
+from flask import Flask, render_template, jsonify, request, session, redirect, url_for, flash, send_from_directory, send_file, Response, stream_with_context, make_response
+from markupsafe import Markup, escape
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import LoginManager, UserMixin, login_user, login_required, current_user, logout_user
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 import os
 import json
 import logging
 import sqlite3
 from werkzeug.security import generate_password_hash, check_password_hash
 from werkzeug.utils import secure_filename
+from werkzeug.http import is_resource_modified
 import random
 import string
 from functools import wraps
 import traceback
+import base64
+import threading
+import hmac
+import hashlib
+import heapq
+import itertools
+from sqlalchemy import event
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import Session as SessionBase, joinedload, load_only
+
+from serializers import product_serializer, set_image_resolver
+from images import ImagePipeline, FORMATS
+from assets import AssetManifest
+from showcase import ShowcasePools
+from recommender import build_neighbors, group_baskets, order_basket, ORDER_WEIGHT, CART_WEIGHT, FAVORITE_WEIGHT
+from search import create_fts_index, fts_table_exists, build_match_query, search_sql, SearchIndex
+from writebehind import CoalescingBuffer
 
 # Настройка логгирования
 logging.basicConfig(
@@ -25,17 +44,27 @@ logging.basicConfig(
 )
 logger = logging.getLogger('VogueEliteWeb')
 
-app = Flask(__name__)
+# Статика отдается собственным маршрутом static (хэши в URL и сжатые копии)
+app = Flask(__name__, static_folder=None)
 
 # Конфигурация приложения
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'dev-key-12345-secure-vogue-elite-premium')
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(os.path.abspath(os.path.dirname(__file__)), 'instance', 'fashion_store.db')
+app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('SQLALCHEMY_DATABASE_URI') or 'sqlite:///' + os.path.join(os.path.abspath(os.path.dirname(__file__)), 'instance', 'fashion_store.db')
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['SESSION_PERMANENT'] = False
 app.config['PERMANENT_SESSION_LIFETIME'] = 3600
 app.config['UPLOAD_FOLDER'] = 'static/uploads'
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
 app.config['JSON_AS_ASCII'] = False
+# Режим бота: polling (отдельный процесс bot.py) или webhook (обновления принимает веб-приложение)
+app.config['BOT_MODE'] = os.environ.get('BOT_MODE', 'polling')
+app.config['TELEGRAM_WEBHOOK_SECRET'] = os.environ.get('WEBHOOK_SECRET', '')
+app.config['BOT_BACKGROUND_TASKS'] = True
+# Период пересчета рекомендаций процессом recommend.py --loop (секунды) и число соседей товара
+app.config['RECOMMENDER_INTERVAL'] = int(os.environ.get('RECOMMENDER_INTERVAL', 3600))
+app.config['RECOMMENDER_TOP_K'] = 10
+# Время кэширования статики без хэша в имени (секунды)
+app.config['STATIC_MAX_AGE'] = int(os.environ.get('STATIC_MAX_AGE', 600))
 
 # Создаем необходимые директории
 for folder in ['instance', 'static/uploads', 'static/uploads/products']:
@@ -192,6 +221,43 @@ def api_response(func):
             }), 500
     return wrapper
 
+# Курсоры keyset-пагинации: непрозрачная base64-строка с позицией (значение, id)
+def encode_cursor(value, item_id):
+    """Кодирование позиции последней строки страницы в курсор"""
+    if isinstance(value, datetime):
+        value = value.isoformat()
+    raw = json.dumps([value, item_id], ensure_ascii=False)
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii')
+
+def decode_cursor(cursor):
+    """Декодирование курсора; возвращает (значение, id) или None"""
+    try:
+        value, item_id = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8'))
+        return value, int(item_id)
+    except Exception:
+        return None
+
+def encode_page_token(sort, values):
+    """Курсор страницы каталога: порядок сортировки и значения ключа последней строки"""
+    values = [value.isoformat() if isinstance(value, datetime) else value for value in values]
+    raw = json.dumps({'s': sort, 'k': values}, ensure_ascii=False)
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii')
+
+def decode_page_token(token, sort):
+    """Значения ключа из курсора или None, если курсор испорчен или от другой сортировки"""
+    try:
+        data = json.loads(base64.urlsafe_b64decode(token.encode('ascii')).decode('utf-8'))
+        return data['k'] if data['s'] == sort else None
+    except Exception:
+        return None
+
+def parse_timestamp(value):
+    """Разбор ISO-метки времени из параметров запроса"""
+    try:
+        return datetime.fromisoformat(value.replace('Z', '+00:00')).replace(tzinfo=None)
+    except (AttributeError, ValueError):
+        return None
+
 # Модели базы данных
 class User(db.Model, UserMixin):
     __tablename__ = 'users'
@@ -210,7 +276,8 @@ class User(db.Model, UserMixin):
     referral_code = db.Column(db.String(50), unique=True, nullable=True)
     notification_enabled = db.Column(db.Boolean, default=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
-    last_activity = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    # Обновляется через activity_buffer, а не при каждом изменении пользователя
+    last_activity = db.Column(db.DateTime, default=datetime.utcnow)
     
     def set_password(self, password):
         self.password_hash = generate_password_hash(password)
@@ -221,16 +288,23 @@ class User(db.Model, UserMixin):
         return False
     
     def get_cart_count(self):
-        return Cart.query.filter_by(user_id=self.id).count()
+        return get_cart_summary(self.id)[0]
     
     def get_cart_total(self):
-        cart_items = Cart.query.filter_by(user_id=self.id).all()
-        total = sum(item.product.price * item.quantity for item in cart_items if item.product)
-        return total
+        return get_cart_summary(self.id)[1]
     
     def __repr__(self):
         return f'<User {self.username}>'
 
+# Значения ключей сортировки каталога вместо NULL: (значение в курсоре, SQL-литерал).
+# Без них строки с пустым столбцом выпадают из сравнения (ключ) < (курсор);
+# литерал встраивается в запрос, чтобы выражение совпало с индексом.
+CATALOG_SORT_NULLS = {
+    'created_at': (datetime(1970, 1, 1), "'1970-01-01 00:00:00.000000'"),
+    'discount': (0, '0'),
+    'is_hit': (False, '0'),
+}
+
 class Product(db.Model):
     __tablename__ = 'products'
     id = db.Column(db.Integer, primary_key=True)
@@ -262,7 +336,17 @@ class Product(db.Model):
     dimensions = db.Column(db.String(100), nullable=True)
     care_instructions = db.Column(db.Text, nullable=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
-    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, index=True)
+    
+    # Составные индексы под порядки keyset-пагинации каталога (id замыкает порядок)
+    __table_args__ = (
+        db.Index('ix_products_active_created_key', 'is_active',
+                 db.text(f"coalesce(created_at, {CATALOG_SORT_NULLS['created_at'][1]})"), 'id'),
+        db.Index('ix_products_active_category_created_key', 'is_active', 'category',
+                 db.text(f"coalesce(created_at, {CATALOG_SORT_NULLS['created_at'][1]})"), 'id'),
+        db.Index('ix_products_active_price', 'is_active', 'price', 'id'),
+        db.Index('ix_products_active_category_price', 'is_active', 'category', 'price', 'id'),
+    )
     
     def get_formatted_price(self):
         return f"{int(self.price):,}".replace(",", " ")
@@ -288,6 +372,15 @@ class Product(db.Model):
     def __repr__(self):
         return f'<Product {self.article} - {self.name}>'
 
+class ProductTombstone(db.Model):
+    """Отметка об удалении товара: удаления доходят до бота при инкрементальной синхронизации"""
+    __tablename__ = 'product_tombstones'
+    product_id = db.Column(db.Integer, primary_key=True)
+    deleted_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False, index=True)
+    
+    def __repr__(self):
+        return f'<ProductTombstone {self.product_id}>'
+
 class Order(db.Model):
     __tablename__ = 'orders'
     id = db.Column(db.Integer, primary_key=True)
@@ -339,7 +432,7 @@ class Cart(db.Model):
     __tablename__ = 'cart'
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
-    product_id = db.Column(db.Integer, db.ForeignKey('products.id'), nullable=False)
+    product_id = db.Column(db.Integer, db.ForeignKey('products.id'), nullable=False, index=True)
     quantity = db.Column(db.Integer, default=1)
     selected_size = db.Column(db.String(50), nullable=True)
     selected_color = db.Column(db.String(50), nullable=True)
@@ -354,6 +447,18 @@ class Cart(db.Model):
     def __repr__(self):
         return f'<Cart {self.user_id} - {self.product_id}>'
 
+class CartSummary(db.Model):
+    """Итоги корзины для шапки сайта: обновляются вместе с корзиной
+    и при изменении цен товаров, которые в ней лежат"""
+    __tablename__ = 'cart_summaries'
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), primary_key=True)
+    item_count = db.Column(db.Integer, default=0, nullable=False)
+    subtotal = db.Column(db.Float, default=0.0, nullable=False)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    
+    def __repr__(self):
+        return f'<CartSummary {self.user_id}: {self.item_count} / {self.subtotal}>'
+
 class PromoCode(db.Model):
     __tablename__ = 'promo_codes'
     id = db.Column(db.Integer, primary_key=True)
@@ -435,6 +540,670 @@ class Notification(db.Model):
     def __repr__(self):
         return f'<Notification {self.title}>'
 
+class BroadcastNotification(db.Model):
+    """Уведомление для сегмента пользователей: одна строка на рассылку"""
+    __tablename__ = 'broadcast_notifications'
+    id = db.Column(db.Integer, primary_key=True)
+    title = db.Column(db.String(200), nullable=False)
+    message = db.Column(db.Text, nullable=False)
+    type = db.Column(db.String(50), default='info')
+    segment = db.Column(db.String(20), default='all', index=True)  # all, vip, new
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+    
+    def __repr__(self):
+        return f'<BroadcastNotification {self.segment}: {self.title}>'
+
+class NotificationCursor(db.Model):
+    """Курсор прочтения рассылок пользователем: последний прочитанный id"""
+    __tablename__ = 'notification_cursors'
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), primary_key=True)
+    last_read_broadcast_id = db.Column(db.Integer, default=0, nullable=False)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    
+    def __repr__(self):
+        return f'<NotificationCursor {self.user_id}: {self.last_read_broadcast_id}>'
+
+class CatalogState(db.Model):
+    """Поколение каталога: увеличивается при каждом изменении товаров"""
+    __tablename__ = 'catalog_state'
+    id = db.Column(db.Integer, primary_key=True)
+    generation = db.Column(db.Integer, default=0, nullable=False)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    def __repr__(self):
+        return f'<CatalogState {self.generation}>'
+
+class RecommenderState(db.Model):
+    """Отпечаток исходных данных последнего расчета рекомендаций"""
+    __tablename__ = 'recommender_state'
+    id = db.Column(db.Integer, primary_key=True)
+    signature = db.Column(db.String(200), nullable=True)
+    built_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    def __repr__(self):
+        return f'<RecommenderState {self.built_at}>'
+
+class ProductNeighbor(db.Model):
+    """Рекомендации: top-K соседей товара по совместной встречаемости"""
+    __tablename__ = 'product_neighbors'
+    product_id = db.Column(db.Integer, db.ForeignKey('products.id'), primary_key=True)
+    neighbor_id = db.Column(db.Integer, db.ForeignKey('products.id'), primary_key=True)
+    rank = db.Column(db.Integer, nullable=False)
+    score = db.Column(db.Float, nullable=False)
+    built_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    __table_args__ = (
+        db.Index('ix_product_neighbors_rank', 'product_id', 'rank'),
+    )
+    
+    def __repr__(self):
+        return f'<ProductNeighbor {self.product_id} -> {self.neighbor_id}: {self.score}>'
+
+class OrderDailyRollup(db.Model):
+    """Агрегат заказов за день (UTC): количество, выручка и единицы товара"""
+    __tablename__ = 'order_daily_rollups'
+    day = db.Column(db.Date, primary_key=True)
+    orders_count = db.Column(db.Integer, default=0, nullable=False)
+    revenue = db.Column(db.Float, default=0.0, nullable=False)
+    items_count = db.Column(db.Integer, default=0, nullable=False)
+    
+    def __repr__(self):
+        return f'<OrderDailyRollup {self.day}: {self.orders_count}>'
+
+class OrderCategoryRollup(db.Model):
+    """Продажи категории за день: единицы товара и сумма позиций"""
+    __tablename__ = 'order_category_rollups'
+    day = db.Column(db.Date, primary_key=True)
+    category = db.Column(db.String(100), primary_key=True)
+    units = db.Column(db.Integer, default=0, nullable=False)
+    revenue = db.Column(db.Float, default=0.0, nullable=False)
+    
+    def __repr__(self):
+        return f'<OrderCategoryRollup {self.day} {self.category}: {self.units}>'
+
+class OrderStatusRollup(db.Model):
+    """Заказы по статусам: количество и выручка"""
+    __tablename__ = 'order_status_rollups'
+    status = db.Column(db.String(50), primary_key=True)
+    orders_count = db.Column(db.Integer, default=0, nullable=False)
+    revenue = db.Column(db.Float, default=0.0, nullable=False)
+    
+    def __repr__(self):
+        return f'<OrderStatusRollup {self.status}: {self.orders_count}>'
+
+# Столбцы товара, не видимые в каталоге: остатки меняются при каждом заказе
+CATALOG_NEUTRAL_COLUMNS = frozenset(('stock', 'reserved', 'updated_at'))
+
+def _catalog_changed(db_session):
+    """Затрагивает ли текущий flush видимые в каталоге данные товаров"""
+    for obj in db_session.new | db_session.deleted:
+        if isinstance(obj, Product):
+            return True
+    for obj in db_session.dirty:
+        if isinstance(obj, Product):
+            state = db.inspect(obj)
+            for column in state.mapper.column_attrs:
+                if column.key not in CATALOG_NEUTRAL_COLUMNS and state.attrs[column.key].history.has_changes():
+                    return True
+    return False
+
+@event.listens_for(SessionBase, 'after_flush')
+def bump_catalog_generation(db_session, flush_context):
+    """Увеличение поколения каталога в той же транзакции, что и изменение товаров"""
+    if not _catalog_changed(db_session):
+        return
+    
+    state_table = CatalogState.__table__
+    connection = db_session.connection()
+    result = connection.execute(
+        state_table.update()
+        .where(state_table.c.id == 1)
+        .values(generation=state_table.c.generation + 1, updated_at=datetime.utcnow())
+    )
+    if result.rowcount == 0:
+        connection.execute(state_table.insert().values(id=1, generation=1, updated_at=datetime.utcnow()))
+
+@event.listens_for(SessionBase, 'after_flush')
+def record_product_tombstones(db_session, flush_context):
+    """Отметки об удалении товаров в той же транзакции, что и удаление"""
+    deleted = [obj.id for obj in db_session.deleted if isinstance(obj, Product)]
+    if not deleted:
+        return
+    
+    table = ProductTombstone.__table__
+    insert = sqlite_insert(table)
+    db_session.connection().execute(
+        insert.on_conflict_do_update(index_elements=[table.c.product_id],
+                                     set_={'deleted_at': insert.excluded.deleted_at}),
+        [{'product_id': product_id, 'deleted_at': datetime.utcnow()} for product_id in deleted]
+    )
+
+def _repriced_product_ids(db_session):
+    """Id товаров, у которых текущий flush изменил цену или которые удалены"""
+    product_ids = {obj.id for obj in db_session.deleted if isinstance(obj, Product)}
+    for obj in db_session.dirty:
+        if isinstance(obj, Product) and db.inspect(obj).attrs.price.history.has_changes():
+            product_ids.add(obj.id)
+    return product_ids
+
+@event.listens_for(SessionBase, 'after_flush')
+def refresh_repriced_cart_summaries(db_session, flush_context):
+    """Пересчет итогов только тех корзин, где лежат товары с новой ценой"""
+    product_ids = _repriced_product_ids(db_session)
+    if not product_ids:
+        return
+    
+    summary_table = CartSummary.__table__
+    db_session.connection().execute(
+        summary_table.update()
+        .where(summary_table.c.user_id.in_(
+            db.select(Cart.user_id).where(Cart.product_id.in_(product_ids))
+        ))
+        .values(
+            item_count=_cart_count_query(summary_table.c.user_id).scalar_subquery(),
+            subtotal=_cart_total_query(summary_table.c.user_id).scalar_subquery(),
+            updated_at=datetime.utcnow()
+        )
+    )
+
+# Агрегаты заказов обновляются в той же транзакции, что и сами заказы
+UNCATEGORIZED = 'Без категории'
+
+def _new_rollup_deltas():
+    return {'daily': {}, 'category': {}, 'status': {}}
+
+def _add_delta(bucket, key, values):
+    current = bucket.get(key)
+    bucket[key] = values if current is None else tuple(a + b for a, b in zip(current, values))
+
+def _collect_order_deltas(deltas, order, sign=1, status=None, final_amount=None):
+    """Вклад заказа в агрегаты со знаком sign (1 - добавление, -1 - удаление).
+    
+    Категория берется из позиции заказа (сохраняется при оформлении), поэтому
+    удаление вычитает то же, что было прибавлено, даже если товар перенесен
+    в другую категорию или удален."""
+    day = (order.created_at or datetime.utcnow()).date()
+    amount = (order.final_amount if final_amount is None else final_amount) or 0
+    items = order.get_items()
+    units = sum(int(item.get('quantity') or 0) for item in items)
+    
+    _add_delta(deltas['daily'], day, (sign, sign * amount, sign * units))
+    _add_delta(deltas['status'], status or order.status or 'new', (sign, sign * amount))
+    for item in items:
+        quantity = int(item.get('quantity') or 0)
+        item_total = item.get('total') or (item.get('price') or 0) * quantity
+        category = item.get('category') or UNCATEGORIZED
+        _add_delta(deltas['category'], (day, category), (sign * quantity, sign * item_total))
+
+def _apply_rollup_deltas(executor, deltas):
+    """Прибавление приращений к строкам агрегатов (INSERT ... ON CONFLICT DO UPDATE)"""
+    targets = [
+        (OrderDailyRollup.__table__, ('day',), ('orders_count', 'revenue', 'items_count'), deltas['daily']),
+        (OrderCategoryRollup.__table__, ('day', 'category'), ('units', 'revenue'), deltas['category']),
+        (OrderStatusRollup.__table__, ('status',), ('orders_count', 'revenue'), deltas['status']),
+    ]
+    for table, keys, columns, bucket in targets:
+        if not bucket:
+            continue
+        rows = []
+        for key, values in bucket.items():
+            key = key if isinstance(key, tuple) else (key,)
+            rows.append({**dict(zip(keys, key)), **dict(zip(columns, values))})
+        insert = sqlite_insert(table)
+        executor.execute(insert.on_conflict_do_update(
+            index_elements=[table.c[name] for name in keys],
+            set_={name: table.c[name] + insert.excluded[name] for name in columns}
+        ), rows)
+
+@event.listens_for(SessionBase, 'after_flush')
+def update_order_rollups(db_session, flush_context):
+    """Новые, удаленные и изменившие статус или сумму заказы отражаются в агрегатах"""
+    created = [obj for obj in db_session.new if isinstance(obj, Order)]
+    deleted = [obj for obj in db_session.deleted if isinstance(obj, Order)]
+    changed = []
+    for obj in db_session.dirty:
+        if isinstance(obj, Order):
+            state = db.inspect(obj)
+            status, amount = state.attrs.status.history, state.attrs.final_amount.history
+            if status.has_changes() or amount.has_changes():
+                changed.append((obj, (status.deleted or [obj.status])[0], (amount.deleted or [obj.final_amount])[0]))
+    if not created and not deleted and not changed:
+        return
+    
+    deltas = _new_rollup_deltas()
+    for order in created:
+        _collect_order_deltas(deltas, order)
+    for order in deleted:
+        _collect_order_deltas(deltas, order, sign=-1)
+    for order, old_status, old_amount in changed:
+        # Перенос между статусами и поправка выручки дня; позиции заказа не меняются
+        day = (order.created_at or datetime.utcnow()).date()
+        _add_delta(deltas['status'], old_status or 'new', (-1, -(old_amount or 0)))
+        _add_delta(deltas['status'], order.status or 'new', (1, order.final_amount or 0))
+        _add_delta(deltas['daily'], day, (0, (order.final_amount or 0) - (old_amount or 0), 0))
+    _apply_rollup_deltas(db_session.connection(), deltas)
+
+def legacy_order_lines():
+    """Заказы с позициями без сохраненной категории (оформлены до ее записи)"""
+    return Order.query.filter(Order.items_json.like('%"product_id"%'), Order.items_json.notlike('%"category"%'))
+
+def rebuild_order_rollups():
+    """Заполнение агрегатов по всей истории заказов (первый запуск или сверка).
+    
+    Позициям старых заказов без категории записывается текущая категория
+    товара, чтобы последующие изменения заказа вычитали ту же категорию."""
+    for model in (OrderDailyRollup, OrderCategoryRollup, OrderStatusRollup):
+        model.query.delete()
+    
+    categories = None
+    deltas = _new_rollup_deltas()
+    orders = 0
+    for order in Order.query.yield_per(500):
+        items = order.get_items()
+        if any('category' not in item for item in items):
+            if categories is None:
+                categories = dict(db.session.query(Product.id, Product.category))
+            for item in items:
+                item.setdefault('category', categories.get(item.get('product_id')) or UNCATEGORIZED)
+            order.items_json = json.dumps(items, ensure_ascii=False, indent=2)
+        _collect_order_deltas(deltas, order)
+        orders += 1
+    _apply_rollup_deltas(db.session, deltas)
+    db.session.commit()
+    logger.info(f"Агрегаты заказов пересчитаны: заказов {orders}, дней {len(deltas['daily'])}")
+    return orders
+
+def get_order_totals():
+    """Всего заказов и выручка: сумма нескольких строк агрегата по статусам"""
+    count, revenue = db.session.query(
+        db.func.coalesce(db.func.sum(OrderStatusRollup.orders_count), 0),
+        db.func.coalesce(db.func.sum(OrderStatusRollup.revenue), 0)
+    ).one()
+    return count, revenue
+
+def get_daily_rollups(since):
+    """Строки дневного агрегата начиная с даты since: {дата: строка}"""
+    return {row.day: row for row in OrderDailyRollup.query.filter(OrderDailyRollup.day >= since)}
+
+def get_catalog_generation():
+    """Текущее поколение каталога"""
+    return db.session.query(CatalogState.generation).filter_by(id=1).scalar() or 0
+
+# Условные GET-запросы: ETag и Last-Modified вычисляются до формирования ответа
+def products_data_version():
+    """Версия выборки товаров: (последнее изменение, последнее удаление), время изменения.
+    
+    Любое изменение товара, включая остатки, меняет его updated_at, удаление
+    оставляет отметку в product_tombstones."""
+    updated_at = db.session.query(db.func.max(Product.updated_at)).scalar()
+    deleted_at = db.session.query(db.func.max(ProductTombstone.deleted_at)).scalar()
+    return (updated_at, deleted_at), max(filter(None, (updated_at, deleted_at)), default=None)
+
+def products_version(*args, **kwargs):
+    """Версия ответа /api/products: версия товаров и нормализованные параметры выборки"""
+    if 'updated_since' in request.args or 'cursor' in request.args:
+        position = change_position()
+        if position is False:
+            return None
+        filters = ('delta', position, min(max(request.args.get('limit', 500, type=int), 1), 1000))
+    else:
+        filters = (
+            request.args.get('category') or None,
+            request.args.get('sort', 'newest'),
+            min(max(request.args.get('limit', 100, type=int), 1), 500),
+            request.args.get('offset', 0, type=int),
+            request.args.get('page_token') or None,
+            request.args.get('include_total', '1') != '0'
+        )
+    key, last_modified = products_data_version()
+    return (key, filters), last_modified
+
+def export_version(*args, **kwargs):
+    """Версия выгрузки: версия товаров, позиция синхронизации и признак неактивных"""
+    position = change_position()
+    if position is False:
+        return None
+    key, last_modified = products_data_version()
+    return (key, position, request.args.get('include_inactive') == '1'), last_modified
+
+def facets_version(*args, **kwargs):
+    """Версия фасетов (категорий и брендов): их пересчитывает только смена поколения каталога"""
+    state = db.session.query(CatalogState.generation, CatalogState.updated_at).filter_by(id=1).first()
+    if state is None:
+        return None
+    return (state.generation,), state.updated_at
+
+def product_version(product_id, **kwargs):
+    """Версия товара: (ключ, время изменения) или None.
+    
+    Ответ содержит карточки рекомендованных товаров, поэтому в ключ входят
+    время расчета рекомендаций, последнее изменение соседей и их число
+    (удаленный сосед не меняет updated_at остальных)."""
+    updated_at = db.session.query(Product.updated_at).filter_by(id=product_id).scalar()
+    if not updated_at:
+        return None
+    built_at, neighbors_updated_at, neighbors_count = db.session.query(
+        db.func.max(ProductNeighbor.built_at), db.func.max(Product.updated_at), db.func.count(Product.id)
+    ).select_from(ProductNeighbor).outerjoin(Product, Product.id == ProductNeighbor.neighbor_id).filter(
+        ProductNeighbor.product_id == product_id
+    ).one()
+    key = (product_id, updated_at, built_at, neighbors_updated_at, neighbors_count)
+    return key, max(filter(None, (updated_at, built_at, neighbors_updated_at)))
+
+def conditional_get(version_func):
+    """Декоратор маршрутов с поддержкой If-None-Match и If-Modified-Since.
+    
+    version_func получает аргументы маршрута и возвращает (ключ версии,
+    время изменения) или None. Ключ описывает только выбранные данные: их
+    версию и нормализованные параметры выборки, поэтому прочие параметры
+    запроса на ETag не влияют. Сильный ETag строится из ключа и пути; если
+    клиент уже имеет эту версию, маршрут не вызывается и возвращается 304 без тела."""
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            version = version_func(*args, **kwargs)
+            if version is None:
+                return func(*args, **kwargs)
+            
+            key, last_modified = version
+            raw = json.dumps([key, request.path], default=str)
+            etag = hashlib.sha256(raw.encode('utf-8')).hexdigest()[:32]
+            if last_modified:
+                last_modified = last_modified.replace(microsecond=0, tzinfo=timezone.utc)
+            
+            if not is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+                response = Response(status=304)
+            else:
+                response = make_response(func(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+            
+            response.set_etag(etag)
+            if last_modified:
+                response.last_modified = last_modified
+            # Клиент хранит ответ, но проверяет его актуальность при каждом использовании
+            response.headers['Cache-Control'] = 'no-cache'
+            return response
+        return wrapper
+    return decorator
+
+# Кэш фасетов каталога, действительный в пределах одного поколения
+_facets_lock = threading.Lock()
+_facets_cache = {'generation': None, 'facets': None}
+
+def compute_catalog_facets():
+    """Расчет всех фасетов каталога за один проход по таблице товаров"""
+    categories = {}
+    brands = {}
+    all_categories = set()
+    all_brands = set()
+    colors = set()
+    sizes = set()
+    min_price = None
+    max_price = None
+    
+    rows = db.session.query(
+        Product.category, Product.brand, Product.price, Product.color, Product.size, Product.is_active
+    ).yield_per(1000)
+    
+    for category, brand, price, color, size, is_active in rows:
+        if category:
+            all_categories.add(category)
+        if brand:
+            all_brands.add(brand)
+        if not is_active:
+            continue
+        
+        if category:
+            categories[category] = categories.get(category, 0) + 1
+        if brand:
+            brands[brand] = brands.get(brand, 0) + 1
+        if price is not None:
+            min_price = price if min_price is None else min(min_price, price)
+            max_price = price if max_price is None else max(max_price, price)
+        if color:
+            colors.update(c.strip() for c in color.split(',') if c.strip())
+        if size:
+            sizes.update(s.strip() for s in size.split(',') if s.strip())
+    
+    return {
+        'categories': sorted(categories.items()),
+        'brands': sorted(brands.items()),
+        'all_categories': sorted(all_categories),
+        'all_brands': sorted(all_brands),
+        'min_price': min_price,
+        'max_price': max_price,
+        'colors': sorted(colors),
+        'sizes': sorted(sizes)
+    }
+
+def get_catalog_facets():
+    """Фасеты каталога из кэша; пересчитываются при смене поколения"""
+    generation = get_catalog_generation()
+    with _facets_lock:
+        if _facets_cache['generation'] == generation:
+            return _facets_cache['facets']
+    
+    facets = compute_catalog_facets()
+    with _facets_lock:
+        _facets_cache['generation'] = generation
+        _facets_cache['facets'] = facets
+    return facets
+
+# ==================== КОРЗИНА И ИЗБРАННОЕ ====================
+
+# Столбцы товара для корзины, оформления заказа и проекций cart_line/item_ref
+# (updated_at - версия записи в кэше сериализатора)
+CART_PRODUCT_COLUMNS = ('id', 'name', 'article', 'price', 'image_url', 'category',
+                        'stock', 'reserved', 'is_active', 'updated_at')
+WISHLIST_PRODUCT_COLUMNS = ('id', 'name', 'price', 'image_url', 'category', 'is_active', 'updated_at')
+
+def _with_product(relationship, columns):
+    """Загрузка товара тем же запросом (JOIN); columns=None - все столбцы"""
+    option = joinedload(relationship)
+    if columns:
+        option = option.load_only(*[getattr(Product, name) for name in columns])
+    return option
+
+def load_cart_items(user_id, columns=CART_PRODUCT_COLUMNS):
+    """Позиции корзины вместе с товарами одним запросом"""
+    return Cart.query.filter_by(user_id=user_id).options(_with_product(Cart.product, columns)).all()
+
+def load_wishlist_items(user_id, columns=WISHLIST_PRODUCT_COLUMNS):
+    """Позиции избранного вместе с товарами одним запросом"""
+    return Wishlist.query.filter_by(user_id=user_id).options(_with_product(Wishlist.product, columns)).all()
+
+def _cart_count_query(user_id):
+    """Количество позиций корзины (user_id - значение или столбец для коррелированного подзапроса)"""
+    return db.select(db.func.count(Cart.id)).where(Cart.user_id == user_id)
+
+def _cart_total_query(user_id):
+    """Сумма корзины по текущим ценам; позиции удаленных товаров не учитываются"""
+    return db.select(
+        db.func.coalesce(db.func.sum(Product.price * Cart.quantity), 0)
+    ).select_from(Cart).outerjoin(Product, Product.id == Cart.product_id).where(Cart.user_id == user_id)
+
+def _cart_totals(user_id):
+    """Пересчет итогов корзины в сессии запроса"""
+    count = db.session.execute(_cart_count_query(user_id)).scalar()
+    total = db.session.execute(_cart_total_query(user_id)).scalar()
+    return count, total
+
+def refresh_cart_summary(user_id):
+    """Обновление итогов в текущей транзакции: вызывается после изменения корзины до commit"""
+    count, total = _cart_totals(user_id)
+    summary_table = CartSummary.__table__
+    values = {'item_count': count, 'subtotal': total, 'updated_at': datetime.utcnow()}
+    db.session.execute(
+        sqlite_insert(summary_table).values(user_id=user_id, **values)
+        .on_conflict_do_update(index_elements=[summary_table.c.user_id], set_=values)
+    )
+    return count, total
+
+def get_cart_summary(user_id):
+    """Количество позиций и сумма корзины для шапки: одно чтение по первичному ключу.
+    
+    Итоги актуальны всегда: их обновляют изменения корзины и цен. Если записи
+    еще нет (корзина не менялась с появления итогов), они считаются в сессии
+    запроса без записи - чтение страницы ничего не пишет в базу."""
+    row = db.session.query(CartSummary.item_count, CartSummary.subtotal).filter(CartSummary.user_id == user_id).first()
+    if row is not None:
+        return row.item_count, row.subtotal
+    return _cart_totals(user_id)
+
+# Порядки каталога для keyset-пагинации: столбцы ключа и направление.
+# Последний столбец - id, поэтому ключ уникален и страницы не пересекаются.
+CATALOG_SORTS = {
+    'newest': (True, ('created_at', 'id')),
+    'price_low': (False, ('price', 'id')),
+    'price_high': (True, ('price', 'id')),
+    'discount': (True, ('discount', 'id')),
+    'popular': (True, ('is_hit', 'created_at', 'id')),
+}
+
+# Размер страницы каталога на сайте (catalog.js догружает страницы этого же размера)
+CATALOG_PAGE_SIZE = 100
+
+def catalog_query(category=None, sort='newest'):
+    """Активные товары категории с фильтром выбранной сортировки"""
+    query = Product.query.filter(Product.is_active == True)
+    if category and category != 'all':
+        query = query.filter(Product.category == category)
+    if sort == 'discount':
+        query = query.filter(Product.discount > 0)
+    return query
+
+def catalog_sort_columns(sort):
+    """Выражения ключа сортировки: столбцы, допускающие NULL, - через coalesce"""
+    columns = []
+    for name in CATALOG_SORTS[sort][1]:
+        column = getattr(Product, name)
+        if name in CATALOG_SORT_NULLS:
+            column = db.func.coalesce(column, db.literal_column(CATALOG_SORT_NULLS[name][1]), type_=column.type)
+        columns.append(column)
+    return columns
+
+def catalog_sort_values(sort, product):
+    """Значения ключа сортировки товара с той же заменой NULL, что и в запросе"""
+    values = []
+    for name in CATALOG_SORTS[sort][1]:
+        value = getattr(product, name)
+        if value is None and name in CATALOG_SORT_NULLS:
+            value = CATALOG_SORT_NULLS[name][0]
+        values.append(value)
+    return values
+
+def keyset_page(query, sort, page_token=None, limit=12):
+    """Страница по курсору: (товары, курсор следующей страницы или None).
+    
+    Вместо OFFSET условие (ключ) < (ключ последней строки) идет по составному
+    индексу, поэтому стоимость страницы не зависит от глубины. Некорректный
+    курсор - ValueError."""
+    descending = CATALOG_SORTS[sort][0]
+    columns = catalog_sort_columns(sort)
+    
+    if page_token:
+        values = decode_page_token(page_token, sort)
+        if values is None or len(values) != len(columns):
+            raise ValueError('Некорректный курсор страницы')
+        values = [parse_timestamp(value) if isinstance(column.type, db.DateTime) else value
+                  for column, value in zip(columns, values)]
+        if any(value is None for value in values):
+            raise ValueError('Некорректный курсор страницы')
+        values = [db.literal(value, column.type) for column, value in zip(columns, values)]
+        key = db.tuple_(*columns)
+        # Условие по первому столбцу дублирует сравнение кортежей: SQLite ищет
+        # по нему в индексе, а сравнение кортежа из выражений только фильтрует
+        if descending:
+            query = query.filter(columns[0] <= values[0], key < db.tuple_(*values))
+        else:
+            query = query.filter(columns[0] >= values[0], key > db.tuple_(*values))
+    
+    order = [column.desc() if descending else column.asc() for column in columns]
+    products = query.order_by(*order).limit(limit + 1).all()
+    
+    next_token = None
+    if len(products) > limit:
+        products = products[:limit]
+        next_token = encode_page_token(sort, catalog_sort_values(sort, products[-1]))
+    return products, next_token
+
+# Точные количества товаров, действительные в пределах одного поколения каталога
+_count_cache = {}
+
+def cached_catalog_count(category=None, sort='newest'):
+    """Число товаров выборки каталога (COUNT выполняется один раз на поколение)"""
+    generation = get_catalog_generation()
+    key = (category or 'all', sort == 'discount')
+    cached = _count_cache.get(key)
+    if cached and cached[0] == generation:
+        return cached[1]
+    
+    count = catalog_query(category, sort).count()
+    _count_cache[key] = (generation, count)
+    return count
+
+def upgrade_schema():
+    """Создание недостающих таблиц, индексов и служебных строк (идемпотентно)"""
+    db.create_all()
+    
+    # create_all не добавляет индексы в уже существующие таблицы. Индексы по
+    # выражениям SQLAlchemy не отражает, поэтому наличие проверяется по sqlite_master
+    with db.engine.connect() as connection:
+        existing = set(connection.exec_driver_sql("SELECT name FROM sqlite_master WHERE type = 'index'").scalars())
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            if index.name not in existing:
+                index.create(db.engine)
+    
+    if not db.session.get(CatalogState, 1):
+        db.session.add(CatalogState(id=1, generation=0))
+        db.session.commit()
+    
+    # Прежние индексы по created_at заменены индексами по выражению ключа сортировки
+    for name in ('ix_products_active_created', 'ix_products_active_category_created'):
+        db.session.execute(db.text(f'DROP INDEX IF EXISTS {name}'))
+    db.session.commit()
+    
+    # Товары без updated_at не попадают в синхронизацию по курсору (updated_at, id)
+    Product.query.filter(Product.updated_at == None).update({'updated_at': datetime.utcnow()})
+    db.session.commit()
+    
+    # Агрегаты заказов заполняются из истории при первом запуске
+    # и пересчитываются, пока у старых заказов нет категорий в позициях
+    has_rollups = db.session.query(OrderStatusRollup.status).first() is not None
+    if (not has_rollups and db.session.query(Order.id).first()) or legacy_order_lines().first():
+        rebuild_order_rollups()
+    
+    # Полнотекстовый индекс товаров поддерживается триггерами SQLite
+    raw_connection = db.engine.raw_connection()
+    try:
+        cursor = raw_connection.cursor()
+        if not create_fts_index(cursor, 'products_fts', 'products'):
+            logger.warning("FTS5 недоступен, поиск работает через LIKE")
+        raw_connection.commit()
+    finally:
+        raw_connection.close()
+    _search_state['fts'] = None
+
+# Состояние полнотекстового поиска (проверяется при первом запросе)
+_search_state = {'fts': None}
+
+def search_product_ids(query, limit):
+    """Id активных товаров по релевантности (bm25) или None, если FTS недоступен"""
+    match = build_match_query(query)
+    if not match:
+        return []
+    
+    if _search_state['fts'] is None:
+        _search_state['fts'] = fts_table_exists(db.session.connection().connection.dbapi_connection, 'products_fts')
+    if not _search_state['fts']:
+        return None
+    
+    sql = search_sql('products_fts', 'products', where='p.is_active = 1', columns='p.id')
+    rows = db.session.connection().exec_driver_sql(sql, (match, limit)).fetchall()
+    return [row[0] for row in rows]
+
 @login_manager.user_loader
 def load_user(user_id):
     return User.query.get(int(user_id))
@@ -445,7 +1214,7 @@ def init_database():
     with app.app_context():
         try:
             # Создаем таблицы
-            db.create_all()
+            upgrade_schema()
             logger.info("Таблицы базы данных созданы")
             
             # Проверяем, нужно ли создавать тестовые данные
@@ -802,6 +1571,27 @@ def init_database():
             logger.error(f"Ошибка инициализации базы данных: {e}")
             db.session.rollback()
 
+# ==================== АКТИВНОСТЬ ПОЛЬЗОВАТЕЛЕЙ ====================
+
+def flush_user_activity(items):
+    """Пакетная запись времени активности: [(user_id, время)]"""
+    with app.app_context():
+        with db.engine.begin() as connection:
+            connection.execute(
+                User.__table__.update()
+                .where(User.__table__.c.id == db.bindparam('user_id'))
+                .values(last_activity=db.bindparam('last_activity')),
+                [{'user_id': user_id, 'last_activity': last_activity} for user_id, last_activity in items]
+            )
+
+# Время активности пишется пакетами в фоне, а не отдельным UPDATE на каждый запрос
+activity_buffer = CoalescingBuffer(flush_user_activity, interval=5.0, name='web-activity')
+
+@app.before_request
+def track_user_activity():
+    if request.endpoint != 'static' and current_user.is_authenticated:
+        activity_buffer.touch(current_user.id, datetime.utcnow())
+
 # Контекстный процессор для передачи данных во все шаблоны
 @app.context_processor
 def inject_globals():
@@ -809,8 +1599,7 @@ def inject_globals():
     cart_total = 0
     
     if current_user.is_authenticated:
-        cart_count = current_user.get_cart_count()
-        cart_total = current_user.get_cart_total()
+        cart_count, cart_total = get_cart_summary(current_user.id)
     
     return {
         'shop_name': SHOP_NAME,
@@ -832,6 +1621,72 @@ def inject_globals():
         'format_price': lambda price: f"{int(price):,}".replace(",", " ") if price else "0"
     }
 
+# ==================== ИЗОБРАЖЕНИЯ ====================
+
+# Производные изображений товаров создаются пулом процессов и кэшируются на диске
+image_pipeline = ImagePipeline(os.path.join(app.root_path, 'static'),
+                               os.path.join(app.instance_path, 'image_cache'))
+set_image_resolver(image_pipeline.variants, image_pipeline.cache_key)
+
+@app.template_global()
+def product_picture(image_url, variant='card', alt='', fallback=None, picture=True, **attrs):
+    """<picture> с WebP и JPEG нужного размера и размытой заглушкой.
+    
+    Внешние и отсутствующие изображения выводятся обычным <img>."""
+    attributes = ''.join(f' {name.rstrip("_").replace("_", "-")}="{escape(value)}"' for name, value in attrs.items())
+    variants = image_pipeline.variants(image_url)
+    if not variants:
+        return Markup(f'<img src="{escape(image_url or fallback or "")}" alt="{escape(alt)}"{attributes}>')
+    
+    sized = variants[variant]
+    placeholder = ''
+    if variants['placeholder']:
+        placeholder = f' style="background: center / cover no-repeat url({variants["placeholder"]})"'
+    img = f'<img src="{sized["jpg"]}" alt="{escape(alt)}"{placeholder}{attributes}>'
+    if not picture:
+        return Markup(img)
+    return Markup(f'<picture style="display: contents"><source type="image/webp" srcset="{sized["webp"]}">{img}</picture>')
+
+@app.route('/img/<variant>/<version>/<path:filename>')
+def image_variant(variant, version, filename):
+    """Производная изображения; URL содержит хэш содержимого, поэтому кэшируется навсегда"""
+    source, _, extension = filename.rpartition('.')
+    try:
+        current = image_pipeline.version(f'/static/{source}')
+        if current is not None and version != current:
+            # Устаревший хэш: текущие байты под immutable закрепились бы за старым URL
+            return redirect(url_for('image_variant', variant=variant, version=current, filename=filename))
+        path = image_pipeline.derivative(f'/static/{source}', variant, extension)
+    except Exception as e:
+        logger.error(f"Ошибка создания производной изображения {filename}: {e}")
+        path = None
+    if path is None:
+        return jsonify({'success': False, 'message': 'Изображение не найдено'}), 404
+    
+    response = send_file(path, mimetype=FORMATS[extension][1], max_age=31536000)
+    response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    return response
+
+# ==================== СТАТИЧЕСКИЕ ФАЙЛЫ ====================
+
+# Хэши содержимого и сжатые копии CSS/JS собираются один раз при развертывании
+# (python assets.py, см. Procfile); процессы приложения только читают манифест
+asset_manifest = AssetManifest(os.path.join(app.root_path, 'static'),
+                               os.path.join(app.instance_path, 'asset_cache'))
+try:
+    asset_files = asset_manifest.load()
+    if asset_files is None:
+        logger.warning("Манифест статических файлов не собран (python assets.py), хэши считаются по запросу")
+    else:
+        logger.info(f"Манифест статических файлов: {asset_files} файлов")
+except Exception as e:
+    logger.error(f"Ошибка чтения манифеста статических файлов: {e}")
+
+@app.template_global()
+def asset_url(filename):
+    """URL статического файла с хэшем содержимого в имени"""
+    return asset_manifest.url(filename)
+
 # Форматирование чисел
 @app.template_filter('format_price')
 def format_price_filter(price):
@@ -839,17 +1694,106 @@ def format_price_filter(price):
         return "0"
     return f"{int(price):,}".replace(",", " ")
 
+# ==================== ВИТРИНЫ ====================
+
+def load_showcase_pools():
+    """Кандидаты витрин одним проходом по активным товарам"""
+    pools = {'hit': [], 'exclusive': []}
+    rows = db.session.query(Product.id, Product.category, Product.is_hit, Product.is_exclusive).filter(
+        Product.is_active == True
+    )
+    for product_id, category, is_hit, is_exclusive in rows:
+        if is_hit:
+            pools['hit'].append(product_id)
+        if is_exclusive:
+            pools['exclusive'].append(product_id)
+        pools.setdefault(f'category:{category}', []).append(product_id)
+    return pools
+
+# Пулы пересобираются при смене поколения каталога, запросы только выбирают из них
+showcase = ShowcasePools(load_showcase_pools)
+
+def showcase_products(pool, count, exclude=()):
+    """Очередные товары витрины: выборка id из пула и чтение по первичному ключу"""
+    showcase.refresh(get_catalog_generation())
+    ids = showcase.sample(pool, count, exclude)
+    if not ids:
+        return []
+    products = {product.id: product for product in Product.query.filter(Product.id.in_(ids))}
+    return [products[product_id] for product_id in ids if product_id in products]
+
+# ==================== РЕКОМЕНДАЦИИ ====================
+
+def recommendation_signature():
+    """Отпечаток исходных данных: пересчет нужен, только если он изменился"""
+    return json.dumps([
+        list(db.session.query(db.func.count(model.id), db.func.max(model.id)).one())
+        for model in (Order, Cart, Wishlist)
+    ])
+
+def collect_recommendation_baskets():
+    """Корзины для расчета: заказы, корзины и избранное пользователей"""
+    for (items_json,) in db.session.query(Order.items_json).yield_per(1000):
+        yield ORDER_WEIGHT, order_basket(items_json)
+    
+    cart_rows = db.session.query(Cart.user_id, Cart.product_id).order_by(Cart.user_id, Cart.added_at)
+    yield from group_baskets(cart_rows, CART_WEIGHT)
+    wishlist_rows = db.session.query(Wishlist.user_id, Wishlist.product_id).order_by(Wishlist.user_id, Wishlist.added_at)
+    yield from group_baskets(wishlist_rows, FAVORITE_WEIGHT)
+
+def refresh_product_neighbors(force=False):
+    """Пересчет таблицы соседей; без изменений в исходных данных пропускается.
+    
+    Выполняется одним процессом (recommend.py), а не воркерами веб-приложения;
+    отпечаток хранится в базе. Возвращает число записанных строк или None,
+    если пересчет не нужен."""
+    with app.app_context():
+        signature = recommendation_signature()
+        state = db.session.get(RecommenderState, 1)
+        if not force and state is not None and state.signature == signature:
+            return None
+        
+        neighbors = build_neighbors(collect_recommendation_baskets(), app.config['RECOMMENDER_TOP_K'])
+        built_at = datetime.utcnow()
+        rows = [
+            {'product_id': product_id, 'neighbor_id': neighbor_id, 'rank': rank, 'score': score, 'built_at': built_at}
+            for product_id, scored in neighbors.items()
+            for rank, (neighbor_id, score) in enumerate(scored)
+        ]
+        
+        # Таблица заменяется целиком в одной транзакции
+        ProductNeighbor.query.delete()
+        if rows:
+            db.session.execute(ProductNeighbor.__table__.insert(), rows)
+        if state is None:
+            state = RecommenderState(id=1)
+            db.session.add(state)
+        state.signature = signature
+        state.built_at = built_at
+        db.session.commit()
+        logger.info(f"Рекомендации пересчитаны: товаров {len(neighbors)}, связей {len(rows)}")
+        return len(rows)
+
+def get_recommended_products(product_id, limit=4):
+    """Рекомендованные товары: чтение K соседей по индексу и товаров по первичному ключу"""
+    ids = [neighbor_id for (neighbor_id,) in db.session.query(ProductNeighbor.neighbor_id)
+           .filter_by(product_id=product_id).order_by(ProductNeighbor.rank).limit(app.config['RECOMMENDER_TOP_K'])]
+    if not ids:
+        return []
+    products = {product.id: product for product in Product.query.filter(Product.id.in_(ids), Product.is_active == True)}
+    return [products[neighbor_id] for neighbor_id in ids if neighbor_id in products][:limit]
+
 # Главная страница
 @app.route('/')
 def index():
     try:
         new_products = Product.query.filter_by(is_new=True, is_active=True).order_by(Product.created_at.desc()).limit(8).all()
-        hit_products = Product.query.filter_by(is_hit=True, is_active=True).order_by(db.func.random()).limit(8).all()
-        exclusive_products = Product.query.filter_by(is_exclusive=True, is_active=True).order_by(db.func.random()).limit(8).all()
+        hit_products = showcase_products('hit', 8)
+        exclusive_products = showcase_products('exclusive', 8)
         
-        # Статистика магазина
-        total_products = Product.query.filter_by(is_active=True).count()
-        total_categories = db.session.query(Product.category).distinct().count()
+        # Статистика магазина - из кэшей текущего поколения каталога
+        total_products = cached_catalog_count()
+        total_categories = len(get_catalog_facets()['all_categories'])
         
         return render_template('index.html',
                              new_products=new_products,
@@ -872,42 +1816,34 @@ def index():
 def catalog_page():
     try:
         category = request.args.get('category', 'all')
-        page = request.args.get('page', 1, type=int)
-        per_page = 12
-        
-        query = Product.query.filter_by(is_active=True)
-        
-        if category != 'all':
-            query = query.filter_by(category=category)
+        page_token = request.args.get('page_token')
         
         # Сортировка
         sort = request.args.get('sort', 'newest')
-        if sort == 'price_low':
-            query = query.order_by(Product.price.asc())
-        elif sort == 'price_high':
-            query = query.order_by(Product.price.desc())
-        elif sort == 'discount':
-            query = query.filter(Product.discount > 0).order_by(Product.discount.desc())
-        elif sort == 'popular':
-            query = query.order_by(Product.is_hit.desc(), Product.created_at.desc())
-        else:  # newest
-            query = query.order_by(Product.created_at.desc())
-        
-        products = query.paginate(
-            page=page, per_page=per_page, error_out=False
-        )
-        
-        # Получаем все категории для фильтра
-        categories = db.session.query(Product.category).distinct().all()
-        categories = [c[0] for c in categories if c[0]]
+        if sort not in CATALOG_SORTS:
+            sort = 'newest'
         
-        # Получаем бренды
-        brands = db.session.query(Product.brand).distinct().all()
-        brands = [b[0] for b in brands if b[0]]
+        # Первая страница выборки встраивается в шаблон, остальные catalog.js догружает
+        # из /api/products по next_page_token с теми же category и sort.
+        # Общее количество - из кэша поколения каталога для той же выборки.
+        try:
+            products, next_page_token = keyset_page(catalog_query(category, sort), sort, page_token, CATALOG_PAGE_SIZE)
+        except ValueError:
+            products, next_page_token = keyset_page(catalog_query(category, sort), sort, None, CATALOG_PAGE_SIZE)
+        total_products = cached_catalog_count(category, sort)
+        initial_page = {
+            'products': [product_serializer.serialize(product, 'list') for product in products],
+            'next_page_token': next_page_token,
+            'category': category,
+            'sort': sort
+        }
         
-        # Получаем цены для фильтра
-        min_price = db.session.query(db.func.min(Product.price)).filter_by(is_active=True).scalar() or 0
-        max_price = db.session.query(db.func.max(Product.price)).filter_by(is_active=True).scalar() or 100000
+        # Категории, бренды и цены для фильтра - из кэша фасетов
+        facets = get_catalog_facets()
+        categories = facets['all_categories']
+        brands = facets['all_brands']
+        min_price = facets['min_price'] or 0
+        max_price = facets['max_price'] or 100000
         
         return render_template('catalog.html',
                              products=products,
@@ -915,9 +1851,11 @@ def catalog_page():
                              brands=brands,
                              min_price=int(min_price),
                              max_price=int(max_price),
+                             total_products=total_products,
+                             next_page_token=next_page_token,
+                             initial_page=initial_page,
                              current_category=category,
-                             current_sort=sort,
-                             current_page=page)
+                             current_sort=sort)
     except Exception as e:
         logger.error(f"Ошибка загрузки каталога: {e}")
         flash('Произошла ошибка при загрузке каталога', 'error')
@@ -938,12 +1876,11 @@ def product_detail(product_id):
         if product.image_url and product.image_url not in images:
             images.insert(0, product.image_url)
         
-        # Аналогичные товары
-        similar_products = Product.query.filter(
-            Product.category == product.category,
-            Product.id != product.id,
-            Product.is_active == True
-        ).order_by(db.func.random()).limit(4).all()
+        # Аналогичные товары: рекомендации, недостающие - из пула категории
+        similar_products = get_recommended_products(product.id, 4)
+        if len(similar_products) < 4:
+            exclude = {product.id} | {similar.id for similar in similar_products}
+            similar_products += showcase_products(f'category:{product.category}', 4 - len(similar_products), exclude)
         
         # Получаем размеры и цвета
         sizes = []
@@ -988,7 +1925,7 @@ def product_detail(product_id):
 @login_required
 def cart_page():
     try:
-        cart_items = Cart.query.filter_by(user_id=current_user.id).all()
+        cart_items = load_cart_items(current_user.id)
         
         # Проверяем доступность товаров
         unavailable_items = []
@@ -1011,6 +1948,7 @@ def cart_page():
             db.session.delete(item)
         
         if unavailable_items:
+            refresh_cart_summary(current_user.id)
             db.session.commit()
             flash(f'{len(unavailable_items)} товар(ов) были удалены из корзины (закончились или недоступны)', 'warning')
         
@@ -1034,7 +1972,7 @@ def cart_page():
 @login_required
 def checkout():
     try:
-        cart_items = Cart.query.filter_by(user_id=current_user.id).all()
+        cart_items = load_cart_items(current_user.id)
         
         if not cart_items:
             flash('Ваша корзина пуста', 'warning')
@@ -1083,6 +2021,7 @@ def checkout():
                     'product_id': item.product_id,
                     'name': item.product.name,
                     'article': item.product.article,
+                    'category': item.product.category,
                     'price': item.product.price,
                     'quantity': item.quantity,
                     'size': item.selected_size,
@@ -1113,6 +2052,7 @@ def checkout():
             
             # Очищаем корзину
             Cart.query.filter_by(user_id=current_user.id).delete()
+            refresh_cart_summary(current_user.id)
             
             # Обновляем статистику пользователя
             current_user.total_orders += 1
@@ -1217,11 +2157,10 @@ def admin_panel():
         return redirect(url_for('index'))
     
     try:
-        # Статистика
+        # Статистика (заказы и выручка - из агрегатов)
         total_users = User.query.count()
-        total_products = Product.query.filter_by(is_active=True).count()
-        total_orders = Order.query.count()
-        total_revenue = db.session.query(db.func.sum(Order.final_amount)).scalar() or 0
+        total_products = cached_catalog_count()
+        total_orders, total_revenue = get_order_totals()
         
         # Последние заказы
         recent_orders = Order.query.order_by(Order.created_at.desc()).limit(10).all()
@@ -1236,23 +2175,17 @@ def admin_panel():
             db.func.sum(Product.price * Product.stock).label('total_value')
         ).filter_by(is_active=True).group_by(Product.category).all()
         
-        # Статистика по дням
+        # Статистика по дням: одно чтение дневного агрегата, дни без заказов - нули
+        today = datetime.utcnow().date()
+        rollups = get_daily_rollups(today - timedelta(days=6))
         daily_stats = []
         for i in range(7):
-            day = datetime.now().date() - timedelta(days=i)
-            day_start = datetime.combine(day, datetime.min.time())
-            day_end = datetime.combine(day, datetime.max.time())
-            
-            day_orders = Order.query.filter(
-                Order.created_at >= day_start,
-                Order.created_at <= day_end
-            ).all()
-            
-            day_revenue = sum(order.final_amount for order in day_orders)
+            day = today - timedelta(days=i)
+            rollup = rollups.get(day)
             daily_stats.append({
                 'date': day,
-                'orders': len(day_orders),
-                'revenue': day_revenue
+                'orders': rollup.orders_count if rollup else 0,
+                'revenue': rollup.revenue if rollup else 0
             })
         
         return render_template('admin.html',
@@ -1273,62 +2206,51 @@ def admin_panel():
 
 # API для управления товарами
 @app.route('/api/products', methods=['GET'])
+@conditional_get(products_version)
 @api_response
 def api_products():
     """API для получения списка товаров"""
     try:
+        if 'updated_since' in request.args or 'cursor' in request.args:
+            return api_products_delta()
+        
         category = request.args.get('category', None)
-        limit = request.args.get('limit', 100, type=int)
+        limit = min(max(request.args.get('limit', 100, type=int), 1), 500)
         offset = request.args.get('offset', 0, type=int)
-        
-        query = Product.query.filter_by(is_active=True)
-        
-        if category:
-            query = query.filter_by(category=category)
-        
-        products = query.offset(offset).limit(limit).all()
-        
-        products_data = []
-        for product in products:
-            product_data = {
-                'id': product.id,
-                'article': product.article,
-                'name': product.name,
-                'description': product.description or '',
-                'detailed_description': product.detailed_description or '',
-                'price': product.price,
-                'old_price': product.old_price,
-                'discount': product.discount,
-                'category': product.category,
-                'subcategory': product.subcategory,
-                'brand': product.brand or '',
-                'image_url': product.image_url or '/static/img/placeholder.jpg',
-                'images': product.get_images_list(),
-                'stock': product.stock,
-                'is_new': product.is_new,
-                'is_hit': product.is_hit,
-                'is_exclusive': product.is_exclusive,
-                'is_limited': product.is_limited,
-                'color': product.color or '',
-                'size': product.size or '',
-                'material': product.material or '',
-                'country': product.country or '',
-                'season': product.season or '',
-                'created_at': product.created_at.isoformat() if product.created_at else None,
-                'updated_at': product.updated_at.isoformat() if product.updated_at else None
-            }
-            products_data.append(product_data)
-        
-        total_products = Product.query.filter_by(is_active=True).count()
-        
-        return {
-            'success': True,
-            'products': products_data,
-            'count': len(products_data),
-            'total': total_products,
-            'offset': offset,
-            'limit': limit
-        }
+        sort = request.args.get('sort', 'newest')
+        if sort not in CATALOG_SORTS:
+            return {'success': False, 'message': 'Некорректный параметр sort'}, 400
+        
+        query = catalog_query(category, sort)
+        next_page_token = None
+        if offset and 'page_token' not in request.args:
+            # Совместимость со старыми клиентами: постраничный обход по offset
+            # Строка сверх limit - признак следующей страницы; курсор от последней
+            # строки позволяет клиенту продолжить уже по page_token
+            descending = CATALOG_SORTS[sort][0]
+            order = [column.desc() if descending else column.asc() for column in catalog_sort_columns(sort)]
+            products = query.order_by(*order).offset(offset).limit(limit + 1).all()
+            if len(products) > limit:
+                products = products[:limit]
+                next_page_token = encode_page_token(sort, catalog_sort_values(sort, products[-1]))
+        else:
+            try:
+                products, next_page_token = keyset_page(query, sort, request.args.get('page_token'), limit)
+            except ValueError:
+                return {'success': False, 'message': 'Некорректный курсор страницы'}, 400
+        
+        # Точное количество - по запросу (include_total=0 отключает), из кэша поколения
+        extra = {}
+        if request.args.get('include_total', '1') != '0':
+            extra['total'] = cached_catalog_count(category, sort)
+        
+        # Ответ собирается из готовых JSON-фрагментов товаров
+        body = product_serializer.envelope(
+            'products', products, 'list',
+            count=len(products), offset=offset, limit=limit,
+            has_more=next_page_token is not None, next_page_token=next_page_token, **extra
+        )
+        return Response(body, mimetype='application/json')
     except Exception as e:
         logger.error(f"Ошибка API /api/products: {e}")
         return {
@@ -1337,8 +2259,131 @@ def api_products():
             'products': []
         }, 500
 
+def change_position():
+    """Позиция синхронизации из параметров cursor или updated_since.
+    
+    Возвращает (updated_at, id), None - с начала, False - некорректный параметр.
+    updated_since (прежние клиенты) означает все изменения начиная с этой метки."""
+    cursor = request.args.get('cursor')
+    updated_since = request.args.get('updated_since')
+    if cursor:
+        position = decode_cursor(cursor)
+        if not position or not parse_timestamp(position[0]):
+            return False
+        return parse_timestamp(position[0]), position[1]
+    if updated_since:
+        since = parse_timestamp(updated_since)
+        return (since, 0) if since else False
+    return None
+
+def product_changes(position=None):
+    """Изменения товаров после позиции (updated_at, id) в порядке (время, id).
+    
+    Тройки (время, id, товар) для измененных товаров и (время, id, None) для
+    удаленных: две упорядоченные выборки сливаются без сортировки в памяти."""
+    products = Product.query
+    tombstones = ProductTombstone.query
+    if position:
+        since, last_id = position
+        products = products.filter(db.or_(
+            Product.updated_at > since,
+            db.and_(Product.updated_at == since, Product.id > last_id)
+        ))
+        tombstones = tombstones.filter(db.or_(
+            ProductTombstone.deleted_at > since,
+            db.and_(ProductTombstone.deleted_at == since, ProductTombstone.product_id > last_id)
+        ))
+    
+    products = products.order_by(Product.updated_at, Product.id).yield_per(500)
+    tombstones = tombstones.order_by(ProductTombstone.deleted_at, ProductTombstone.product_id).yield_per(500)
+    return heapq.merge(
+        ((product.updated_at or datetime.min, product.id, product) for product in products),
+        ((tombstone.deleted_at, tombstone.product_id, None) for tombstone in tombstones),
+        key=lambda change: change[:2]
+    )
+
+def api_products_delta():
+    """Дельта-выгрузка товаров, измененных после позиции cursor (или updated_since).
+    
+    Возвращает и активные, и деактивированные товары в порядке (updated_at, id),
+    удаленные - списком id в deleted. Следующая страница запрашивается по
+    next_cursor; sync_cursor клиент передает как cursor при следующей синхронизации."""
+    limit = min(max(request.args.get('limit', 500, type=int), 1), 1000)
+    position = change_position()
+    if position is False:
+        return {'success': False, 'message': 'Некорректный курсор или параметр updated_since'}, 400
+    
+    changes = list(itertools.islice(product_changes(position), limit + 1))
+    has_more = len(changes) > limit
+    changes = changes[:limit]
+    products = [product for _, _, product in changes if product is not None]
+    deleted = [product_id for _, product_id, product in changes if product is None]
+    
+    sync_cursor = request.args.get('cursor')
+    watermark = request.args.get('updated_since')
+    if changes:
+        sync_cursor = encode_cursor(changes[-1][0], changes[-1][1])
+        watermark = changes[-1][0].isoformat()
+    
+    body = product_serializer.envelope(
+        'products', products, 'sync',
+        count=len(products), deleted=deleted, has_more=has_more,
+        next_cursor=sync_cursor if has_more else None, sync_cursor=sync_cursor, watermark=watermark
+    )
+    return Response(body, mimetype='application/json')
+
+# Потоковая выгрузка каталога в формате NDJSON (один товар на строку)
+@app.route('/api/products/export', methods=['GET'])
+@conditional_get(export_version)
+def api_products_export():
+    """Потоковая выгрузка товаров для массовых потребителей.
+    
+    Строки читаются из базы порциями (yield_per) и сразу отдаются клиенту,
+    поэтому память не зависит от размера каталога. С параметром cursor
+    (или updated_since) выгружаются изменения после этой позиции, включая
+    деактивированные товары и строки {"id": ..., "_deleted": true} удаленных.
+    Последняя строка - служебная {"_eof": true, "count": ..., "cursor": ...}:
+    без нее выгрузка считается оборванной."""
+    position = change_position()
+    if position is False:
+        return jsonify({'success': False, 'message': 'Некорректный курсор или параметр updated_since'}), 400
+    incremental = 'cursor' in request.args or 'updated_since' in request.args
+    
+    if incremental:
+        changes = product_changes(position)
+    else:
+        query = Product.query
+        if request.args.get('include_inactive') != '1':
+            query = query.filter(Product.is_active == True)
+        changes = ((product.updated_at or datetime.min, product.id, product)
+                   for product in query.order_by(Product.updated_at, Product.id).yield_per(500))
+    
+    def generate():
+        count = 0
+        deleted = 0
+        cursor = request.args.get('cursor')
+        watermark = request.args.get('updated_since')
+        try:
+            for changed_at, product_id, product in changes:
+                cursor = encode_cursor(changed_at, product_id)
+                watermark = changed_at.isoformat()
+                if product is None:
+                    deleted += 1
+                    yield json.dumps({'id': product_id, '_deleted': True, 'deleted_at': watermark}).encode('utf-8') + b'\n'
+                    continue
+                count += 1
+                yield product_serializer.serialize_bytes(product, 'sync') + b'\n'
+            footer = {'_eof': True, 'count': count, 'deleted': deleted, 'cursor': cursor, 'watermark': watermark}
+            yield json.dumps(footer).encode('utf-8') + b'\n'
+        except Exception as e:
+            # Заголовки уже отправлены - клиент распознает обрыв по отсутствию _eof
+            logger.error(f"Ошибка потоковой выгрузки товаров: {e}")
+    
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
 # API для получения товара по ID
 @app.route('/api/products/<int:product_id>', methods=['GET'])
+@conditional_get(product_version)
 @api_response
 def api_get_product_by_id(product_id):
     """API для получения товара по ID"""
@@ -1351,42 +2396,14 @@ def api_get_product_by_id(product_id):
                 'message': 'Товар не найден'
             }, 404
         
-        # Формируем ответ
-        images = product.get_images_list()
-        if product.image_url and product.image_url not in images:
-            images.insert(0, product.image_url)
-        
-        product_data = {
-            'id': product.id,
-            'article': product.article,
-            'name': product.name,
-            'description': product.description or '',
-            'detailed_description': product.detailed_description or '',
-            'price': product.price,
-            'old_price': product.old_price,
-            'discount': product.discount,
-            'category': product.category,
-            'subcategory': product.subcategory or '',
-            'brand': product.brand or '',
-            'image_url': product.image_url or '/static/img/placeholder.jpg',
-            'images': images,
-            'stock': product.stock,
-            'is_new': product.is_new,
-            'is_hit': product.is_hit,
-            'is_exclusive': product.is_exclusive,
-            'is_limited': product.is_limited,
-            'color': product.color or '',
-            'size': product.size or '',
-            'material': product.material or '',
-            'country': product.country or '',
-            'season': product.season or '',
-            'created_at': product.created_at.isoformat() if product.created_at else None,
-            'updated_at': product.updated_at.isoformat() if product.updated_at else None
-        }
+        product_data = product_serializer.serialize(product, 'detail')
+        recommendations = [product_serializer.serialize(similar, 'card')
+                           for similar in get_recommended_products(product_id, 8)]
         
         return {
             'success': True,
-            'product': product_data
+            'product': product_data,
+            'recommendations': recommendations
         }
             
     except Exception as e:
@@ -1450,13 +2467,10 @@ def api_add_to_cart():
             )
             db.session.add(cart_item)
         
+        # Итоги корзины обновляются в той же транзакции
+        cart_count, cart_total = refresh_cart_summary(current_user.id)
         db.session.commit()
         
-        # Получаем обновленное количество товаров в корзине
-        cart_count = Cart.query.filter_by(user_id=current_user.id).count()
-        cart_items = Cart.query.filter_by(user_id=current_user.id).all()
-        cart_total = sum(item.product.price * item.quantity for item in cart_items if item.product)
-        
         return {
             'success': True,
             'message': 'Товар добавлен в корзину',
@@ -1497,11 +2511,10 @@ def api_update_cart():
                 return {'success': False, 'message': 'Недостаточно товара на складе'}, 400
             cart_item.quantity = quantity
         
+        # Пересчитываем итоги в той же транзакции
+        cart_count, total = refresh_cart_summary(current_user.id)
         db.session.commit()
         
-        # Пересчитываем итоги
-        cart_items = Cart.query.filter_by(user_id=current_user.id).all()
-        total = sum(item.product.price * item.quantity for item in cart_items if item.product)
         delivery_cost = 0 if total >= FREE_DELIVERY_THRESHOLD else DELIVERY_COST
         final_amount = total + delivery_cost
         
@@ -1511,7 +2524,7 @@ def api_update_cart():
             'total': total,
             'delivery_cost': delivery_cost,
             'final_amount': final_amount,
-            'cart_count': len(cart_items)
+            'cart_count': cart_count
         }
     except Exception as e:
         logger.error(f"Ошибка обновления корзины: {e}")
@@ -1529,12 +2542,10 @@ def api_remove_from_cart(cart_item_id):
             return {'success': False, 'message': 'Элемент корзины не найден'}, 404
         
         db.session.delete(cart_item)
-        db.session.commit()
         
-        # Пересчитываем итоги
-        cart_items = Cart.query.filter_by(user_id=current_user.id).all()
-        total = sum(item.product.price * item.quantity for item in cart_items if item.product)
-        cart_count = len(cart_items)
+        # Пересчитываем итоги в той же транзакции
+        cart_count, total = refresh_cart_summary(current_user.id)
+        db.session.commit()
         
         return {
             'success': True,
@@ -1556,7 +2567,7 @@ def api_cart_sync_handler():
     try:
         if request.method == 'GET':
             # Получение текущей корзины
-            cart_items = Cart.query.filter_by(user_id=current_user.id).all()
+            cart_items = load_cart_items(current_user.id)
             cart_data = []
             
             for item in cart_items:
@@ -1564,14 +2575,10 @@ def api_cart_sync_handler():
                     cart_data.append({
                         'id': item.id,
                         'product_id': item.product_id,
-                        'product_name': item.product.name,
-                        'product_article': item.product.article,
+                        **product_serializer.serialize(item.product, 'cart_sync_line'),
                         'quantity': item.quantity,
-                        'price': item.product.price,
                         'selected_size': item.selected_size,
                         'selected_color': item.selected_color,
-                        'image_url': item.product.image_url or '/static/img/placeholder.jpg',
-                        'stock': item.product.stock,
                         'is_available': item.product.is_active and item.product.stock >= item.quantity
                     })
             
@@ -1593,12 +2600,18 @@ def api_cart_sync_handler():
             # Очищаем текущую корзину пользователя
             Cart.query.filter_by(user_id=current_user.id).delete()
             
+            # Товары запроса читаются одним запросом
+            product_ids = [item_data.get('product_id') for item_data in items]
+            products = {product.id: product for product in Product.query.options(
+                load_only(Product.id, Product.price, Product.is_active)
+            ).filter(Product.id.in_(product_ids))}
+            
             # Добавляем товары из запроса
             for item_data in items:
                 product_id = item_data.get('product_id')
                 quantity = item_data.get('quantity', 1)
                 
-                product = Product.query.get(product_id)
+                product = products.get(product_id)
                 if product and product.is_active:
                     cart_item = Cart(
                         user_id=current_user.id,
@@ -1610,10 +2623,11 @@ def api_cart_sync_handler():
                     )
                     db.session.add(cart_item)
             
+            refresh_cart_summary(current_user.id)
             db.session.commit()
             
             # Получаем обновленную корзину
-            cart_items = Cart.query.filter_by(user_id=current_user.id).all()
+            cart_items = load_cart_items(current_user.id)
             cart_data = []
             
             for item in cart_items:
@@ -1621,10 +2635,8 @@ def api_cart_sync_handler():
                     cart_data.append({
                         'id': item.id,
                         'product_id': item.product_id,
-                        'name': item.product.name,
+                        **product_serializer.serialize(item.product, 'cart_line'),
                         'quantity': item.quantity,
-                        'price': item.product.price,
-                        'image_url': item.product.image_url or '/static/img/placeholder.jpg',
                         'selected_size': item.selected_size,
                         'selected_color': item.selected_color
                     })
@@ -1656,7 +2668,7 @@ def api_get_cart():
         
         # Если пользователь авторизован - получаем из базы
         if current_user.is_authenticated:
-            cart_items_query = Cart.query.filter_by(user_id=current_user.id).all()
+            cart_items_query = load_cart_items(current_user.id)
             cart_count = len(cart_items_query)
             cart_total = sum(item.product.price * item.quantity for item in cart_items_query if item.product)
             
@@ -1666,13 +2678,10 @@ def api_get_cart():
                     cart_items.append({
                         'id': item.id,
                         'product_id': item.product_id,
-                        'name': item.product.name,
+                        **product_serializer.serialize(item.product, 'cart_line'),
                         'quantity': item.quantity,
-                        'price': item.product.price,
-                        'image_url': item.product.image_url or '/static/img/placeholder.jpg',
                         'size': item.selected_size,
                         'color': item.selected_color,
-                        'stock': item.product.stock,
                         'is_available': item.product.is_active and item.product.stock >= item.quantity
                     })
         
@@ -1702,7 +2711,7 @@ def api_wishlist_handler():
     try:
         if request.method == 'GET':
             # Получаем избранное пользователя
-            wishlist_items = Wishlist.query.filter_by(user_id=current_user.id).all()
+            wishlist_items = load_wishlist_items(current_user.id)
             wishlist_data = []
             
             for item in wishlist_items:
@@ -1710,10 +2719,7 @@ def api_wishlist_handler():
                     wishlist_data.append({
                         'id': item.id,
                         'product_id': item.product_id,
-                        'product_name': item.product.name,
-                        'product_price': item.product.price,
-                        'product_image': item.product.image_url or '/static/img/placeholder.jpg',
-                        'product_category': item.product.category,
+                        **product_serializer.serialize(item.product, 'item_ref'),
                         'added_at': item.added_at.isoformat() if item.added_at else None
                     })
             
@@ -1816,10 +2822,7 @@ def api_compare_handler():
                     compare_data.append({
                         'id': item.id,
                         'product_id': item.product_id,
-                        'product_name': item.product.name,
-                        'product_price': item.product.price,
-                        'product_image': item.product.image_url or '/static/img/placeholder.jpg',
-                        'product_category': item.product.category,
+                        **product_serializer.serialize(item.product, 'item_ref'),
                         'added_at': item.added_at.isoformat() if item.added_at else None
                     })
             
@@ -1905,6 +2908,82 @@ def api_compare_handler():
             'message': 'Ошибка работы со списком сравнения'
         }, 500
 
+# ==================== УВЕДОМЛЕНИЯ ====================
+
+# Период, в течение которого пользователь относится к сегменту new
+NEW_USER_PERIOD = timedelta(days=30)
+
+def broadcast_query_for(user):
+    """Рассылки, адресованные пользователю: отправленные после его регистрации
+    и подходящие по сегменту.
+    
+    Сегмент new определяется датой регистрации на момент рассылки, а сегмент vip -
+    текущим статусом пользователя: получатели не фиксируются при создании рассылки,
+    поэтому vip-рассылки видны и тем, кто стал VIP позже, и скрываются у тех,
+    кто перестал им быть."""
+    query = BroadcastNotification.query
+    if user.created_at:
+        query = query.filter(BroadcastNotification.created_at >= user.created_at)
+    
+    segments = [BroadcastNotification.segment == 'all']
+    if user.is_vip:
+        segments.append(BroadcastNotification.segment == 'vip')
+    if user.created_at:
+        segments.append(db.and_(
+            BroadcastNotification.segment == 'new',
+            BroadcastNotification.created_at <= user.created_at + NEW_USER_PERIOD
+        ))
+    return query.filter(db.or_(*segments))
+
+def get_read_cursor(user_id):
+    """Id последней прочитанной пользователем рассылки"""
+    cursor = db.session.get(NotificationCursor, user_id)
+    return cursor.last_read_broadcast_id if cursor else 0
+
+def notification_to_dict(notification, is_read, broadcast=False):
+    return {
+        'id': notification.id,
+        'title': notification.title,
+        'message': notification.message,
+        'type': notification.type,
+        'is_read': is_read,
+        'broadcast': broadcast,
+        'created_at': notification.created_at.isoformat() if notification.created_at else None
+    }
+
+def get_user_notifications(user, unread_only=False, limit=None):
+    """Личные уведомления пользователя вместе с адресованными ему рассылками,
+    от новых к старым"""
+    personal = Notification.query.filter_by(user_id=user.id)
+    if unread_only:
+        personal = personal.filter_by(is_read=False)
+    personal = personal.order_by(Notification.created_at.desc()).limit(limit)
+    
+    broadcasts = []
+    read_cursor = get_read_cursor(user.id)
+    if user.notification_enabled:
+        query = broadcast_query_for(user)
+        if unread_only:
+            query = query.filter(BroadcastNotification.id > read_cursor)
+        broadcasts = query.order_by(BroadcastNotification.created_at.desc()).limit(limit).all()
+    
+    items = [notification_to_dict(n, n.is_read) for n in personal]
+    items.extend(notification_to_dict(b, b.id <= read_cursor, broadcast=True) for b in broadcasts)
+    items.sort(key=lambda item: item['created_at'] or '', reverse=True)
+    return items[:limit] if limit else items
+
+def mark_broadcasts_read(user):
+    """Сдвиг курсора прочтения на последнюю адресованную пользователю рассылку"""
+    latest = broadcast_query_for(user).with_entities(db.func.max(BroadcastNotification.id)).scalar()
+    if not latest:
+        return
+    
+    cursor = db.session.get(NotificationCursor, user.id)
+    if cursor is None:
+        db.session.add(NotificationCursor(user_id=user.id, last_read_broadcast_id=latest))
+    elif cursor.last_read_broadcast_id < latest:
+        cursor.last_read_broadcast_id = latest
+
 # API для получения непрочитанных уведомлений
 @app.route('/api/notifications/unread', methods=['GET'])
 @login_required
@@ -1912,20 +2991,8 @@ def api_compare_handler():
 def api_get_unread_notifications():
     """API для получения непрочитанных уведомлений"""
     try:
-        notifications = Notification.query.filter_by(
-            user_id=current_user.id,
-            is_read=False
-        ).order_by(Notification.created_at.desc()).limit(10).all()
-        
-        notifications_data = []
-        for notification in notifications:
-            notifications_data.append({
-                'id': notification.id,
-                'title': notification.title,
-                'message': notification.message,
-                'type': notification.type,
-                'created_at': notification.created_at.isoformat() if notification.created_at else None
-            })
+        # Личные уведомления и непрочитанные рассылки по курсору пользователя
+        notifications_data = get_user_notifications(current_user, unread_only=True, limit=10)
         
         return {
             'success': True,
@@ -2003,8 +3070,7 @@ def api_login():
         
         if user and user.check_password(password):
             login_user(user, remember=True)
-            user.last_activity = datetime.utcnow()
-            db.session.commit()
+            activity_buffer.touch(user.id, datetime.utcnow())
             
             user_data = {
                 'id': user.id,
@@ -2084,14 +3150,12 @@ def api_analytics_track():
 
 # API для получения категорий
 @app.route('/api/categories', methods=['GET'])
+@conditional_get(facets_version)
 @api_response
 def api_get_categories():
     """API для получения категорий товаров"""
     try:
-        categories = db.session.query(
-            Product.category,
-            db.func.count(Product.id).label('count')
-        ).filter_by(is_active=True).group_by(Product.category).all()
+        categories = get_catalog_facets()['categories']
         
         categories_data = []
         for category, count in categories:
@@ -2117,18 +3181,12 @@ def api_get_categories():
 
 # API для получения брендов
 @app.route('/api/brands', methods=['GET'])
+@conditional_get(facets_version)
 @api_response
 def api_get_brands():
     """API для получения брендов"""
     try:
-        brands = db.session.query(
-            Product.brand,
-            db.func.count(Product.id).label('count')
-        ).filter(
-            Product.is_active == True,
-            Product.brand.isnot(None),
-            Product.brand != ''
-        ).group_by(Product.brand).all()
+        brands = get_catalog_facets()['brands']
         
         brands_data = []
         for brand, count in brands:
@@ -2157,42 +3215,15 @@ def api_get_brands():
 def api_get_filters():
     """API для получения доступных фильтров"""
     try:
-        # Цены
-        min_price_result = db.session.query(db.func.min(Product.price)).filter_by(is_active=True).scalar()
-        max_price_result = db.session.query(db.func.max(Product.price)).filter_by(is_active=True).scalar()
-        
-        min_price = int(min_price_result) if min_price_result else 0
-        max_price = int(max_price_result) if max_price_result else 100000
-        
-        # Цвета
-        color_rows = db.session.query(Product.color).filter(
-            Product.is_active == True,
-            Product.color.isnot(None),
-            Product.color != ''
-        ).distinct().all()
-        
-        colors = []
-        for row in color_rows:
-            if row[0]:
-                color_list = [c.strip() for c in row[0].split(',') if c.strip()]
-                colors.extend(color_list)
+        facets = get_catalog_facets()
         
-        colors = list(set(colors))[:20]  # Уникальные цвета, максимум 20
-        
-        # Размеры
-        size_rows = db.session.query(Product.size).filter(
-            Product.is_active == True,
-            Product.size.isnot(None),
-            Product.size != ''
-        ).distinct().all()
-        
-        sizes = []
-        for row in size_rows:
-            if row[0]:
-                size_list = [s.strip() for s in row[0].split(',') if s.strip()]
-                sizes.extend(size_list)
+        # Цены
+        min_price = int(facets['min_price']) if facets['min_price'] else 0
+        max_price = int(facets['max_price']) if facets['max_price'] else 100000
         
-        sizes = list(set(sizes))
+        # Цвета и размеры (уникальные, цветов максимум 20)
+        colors = facets['colors'][:20]
+        sizes = facets['sizes']
         
         return {
             'success': True,
@@ -2228,27 +3259,26 @@ def api_search():
                 'count': 0
             }
         
-        # Поиск товаров
-        search_query = f"%{query}%"
-        products = Product.query.filter(
-            Product.is_active == True,
-            (Product.name.ilike(search_query)) |
-            (Product.description.ilike(search_query)) |
-            (Product.category.ilike(search_query)) |
-            (Product.brand.ilike(search_query))
-        ).limit(limit).all()
+        # Полнотекстовый поиск с ранжированием, без FTS5 - поиск по подстроке
+        product_ids = search_product_ids(query, limit)
+        if product_ids is not None:
+            found = {product.id: product for product in Product.query.filter(Product.id.in_(product_ids)).all()}
+            products = [found[product_id] for product_id in product_ids if product_id in found]
+        else:
+            search_query = f"%{query}%"
+            products = Product.query.filter(
+                Product.is_active == True,
+                (Product.name.ilike(search_query)) |
+                (Product.description.ilike(search_query)) |
+                (Product.category.ilike(search_query)) |
+                (Product.brand.ilike(search_query))
+            ).limit(limit).all()
         
         results = []
         for product in products:
-            results.append({
-                'id': product.id,
-                'name': product.name,
-                'category': product.category,
-                'price': product.price,
-                'discount': product.discount,
-                'image_url': product.image_url or '/static/img/placeholder.jpg',
-                'url': url_for('product_detail', product_id=product.id)
-            })
+            result = product_serializer.serialize(product, 'card')
+            result['url'] = url_for('product_detail', product_id=product.id)
+            results.append(result)
         
         return {
             'success': True,
@@ -2264,6 +3294,86 @@ def api_search():
             'results': []
         }, 500
 
+# Индекс подсказок поиска в памяти процесса, догоняющий изменения каталога
+_suggest_lock = threading.Lock()
+_suggest_state = {'index': None, 'version': None, 'watermark': None, 'deleted_watermark': None}
+
+def _suggest_display(product):
+    """Данные подсказки (хранятся в индексе, чтобы не обращаться к базе)"""
+    data = product_serializer.serialize(product, 'card')
+    data['url'] = f'/product/{product.id}'
+    return data
+
+def get_suggest_index():
+    """Индекс подсказок: полная сборка при первом обращении, далее - только
+    товары, измененные после последней отметки updated_at, и удаленные товары
+    (по таблице product_tombstones).
+    
+    Обновление проверяется по версии данных товаров, а не по поколению
+    каталога: подсказки содержат остатки, которые поколение не меняют."""
+    version = products_data_version()[0]
+    with _suggest_lock:
+        index = _suggest_state['index']
+        if index is not None and _suggest_state['version'] == version:
+            return index
+        
+        deleted_watermark = _suggest_state['deleted_watermark']
+        if index is None:
+            # Отметка удалений берется до чтения товаров: удаленные позже уберутся при следующем обновлении
+            deleted_watermark = db.session.query(db.func.max(ProductTombstone.deleted_at)).scalar()
+            index = SearchIndex()
+            products = Product.query.filter_by(is_active=True).yield_per(1000)
+        else:
+            tombstones = ProductTombstone.query.filter(ProductTombstone.deleted_at >= deleted_watermark).all()
+            for tombstone in tombstones:
+                index.remove(tombstone.product_id)
+                if tombstone.deleted_at > deleted_watermark:
+                    deleted_watermark = tombstone.deleted_at
+            products = Product.query.filter(Product.updated_at >= _suggest_state['watermark']).all()
+        
+        watermark = _suggest_state['watermark']
+        for product in products:
+            if product.is_active:
+                fields = {'name': product.name, 'brand': product.brand,
+                          'category': product.category, 'article': product.article}
+                index.upsert(product.id, fields, _suggest_display(product))
+            else:
+                index.remove(product.id)
+            if product.updated_at and (watermark is None or product.updated_at > watermark):
+                watermark = product.updated_at
+        
+        _suggest_state.update(index=index, version=version, watermark=watermark or datetime.min,
+                              deleted_watermark=deleted_watermark or datetime.min)
+        return index
+
+# API подсказок поиска по мере ввода (с учетом опечаток и транслитерации)
+@app.route('/api/search/suggest', methods=['GET'])
+@api_response
+def api_search_suggest():
+    """API подсказок поиска"""
+    try:
+        query = request.args.get('q', '').strip()
+        limit = min(request.args.get('limit', 8, type=int), 20)
+        
+        if not query:
+            return {'success': True, 'suggestions': [], 'count': 0}
+        
+        suggestions = get_suggest_index().suggest(query, limit=limit)
+        
+        return {
+            'success': True,
+            'suggestions': suggestions,
+            'count': len(suggestions),
+            'query': query
+        }
+    except Exception as e:
+        logger.error(f"Ошибка подсказок поиска: {e}")
+        return {
+            'success': False,
+            'message': 'Ошибка подсказок поиска',
+            'suggestions': []
+        }, 500
+
 # API для проверки промокода
 @app.route('/api/promo/check', methods=['POST'])
 @api_response
@@ -2421,7 +3531,7 @@ def api_create_order():
             return {'success': False, 'message': 'Отсутствуют данные'}, 400
         
         # Получаем товары из корзины
-        cart_items = Cart.query.filter_by(user_id=current_user.id).all()
+        cart_items = load_cart_items(current_user.id)
         
         if not cart_items:
             return {'success': False, 'message': 'Корзина пуста'}, 400
@@ -2468,6 +3578,7 @@ def api_create_order():
                 'product_id': item.product_id,
                 'name': item.product.name,
                 'article': item.product.article,
+                'category': item.product.category,
                 'price': item.product.price,
                 'quantity': item.quantity,
                 'size': item.selected_size,
@@ -2498,6 +3609,7 @@ def api_create_order():
         
         # Очищаем корзину
         Cart.query.filter_by(user_id=current_user.id).delete()
+        refresh_cart_summary(current_user.id)
         
         # Обновляем статистику пользователя
         current_user.total_orders += 1
@@ -2534,31 +3646,38 @@ def api_stats():
         return {'success': False, 'message': 'Доступ запрещен'}, 403
     
     try:
-        # Общая статистика
+        # Общая статистика (заказы и выручка - из агрегатов)
         total_users = User.query.count()
-        total_products = Product.query.filter_by(is_active=True).count()
-        total_orders = Order.query.count()
-        total_revenue = db.session.query(db.func.sum(Order.final_amount)).scalar() or 0
+        total_products = cached_catalog_count()
+        total_orders, total_revenue = get_order_totals()
         
         # Статистика за последние 30 дней
         thirty_days_ago = datetime.utcnow() - timedelta(days=30)
+        since_day = thirty_days_ago.date()
         
         recent_users = User.query.filter(User.created_at >= thirty_days_ago).count()
-        recent_orders = Order.query.filter(Order.created_at >= thirty_days_ago).count()
-        recent_revenue = db.session.query(db.func.sum(Order.final_amount)).filter(
-            Order.created_at >= thirty_days_ago
-        ).scalar() or 0
-        
-        # Статистика по категориям
-        category_stats = []
-        categories = db.session.query(Product.category).distinct().all()
-        for category in categories:
-            if category[0]:
-                count = Product.query.filter_by(category=category[0], is_active=True).count()
-                category_stats.append({
-                    'category': category[0],
-                    'count': count
-                })
+        daily_rollups = get_daily_rollups(since_day).values()
+        recent_orders = sum(rollup.orders_count for rollup in daily_rollups)
+        recent_revenue = sum(rollup.revenue for rollup in daily_rollups)
+        
+        # Статистика по категориям (активные товары - из кэша фасетов)
+        facets = get_catalog_facets()
+        active_counts = dict(facets['categories'])
+        category_stats = [{'category': category, 'count': active_counts.get(category, 0)}
+                          for category in facets['all_categories']]
+        
+        # Продажи по категориям за 30 дней
+        category_sales = db.session.query(
+            OrderCategoryRollup.category,
+            db.func.sum(OrderCategoryRollup.units),
+            db.func.sum(OrderCategoryRollup.revenue)
+        ).filter(OrderCategoryRollup.day >= since_day).group_by(OrderCategoryRollup.category).all()
+        category_sales_data = [{'category': category, 'units': units, 'revenue': revenue}
+                               for category, units, revenue in sorted(category_sales, key=lambda row: -row[2])]
+        
+        # Заказы по статусам
+        status_stats = [{'status': rollup.status, 'orders': rollup.orders_count, 'revenue': rollup.revenue}
+                        for rollup in OrderStatusRollup.query.filter(OrderStatusRollup.orders_count > 0)]
         
         # Топ товаров
         top_products = Product.query.filter_by(is_active=True).order_by(
@@ -2587,6 +3706,8 @@ def api_stats():
                 'recent_orders': recent_orders,
                 'recent_revenue': recent_revenue,
                 'category_stats': category_stats,
+                'category_sales': category_sales_data,
+                'status_stats': status_stats,
                 'top_products': top_products_data
             }
         }
@@ -2614,34 +3735,32 @@ def api_send_notification():
         if not message:
             return {'success': False, 'message': 'Не указано сообщение'}, 400
         
-        # Получаем пользователей для рассылки
-        if target == 'vip':
-            users = User.query.filter_by(is_vip=True, notification_enabled=True).all()
-        elif target == 'new':
-            thirty_days_ago = datetime.utcnow() - timedelta(days=30)
-            users = User.query.filter(
-                User.created_at >= thirty_days_ago,
-                User.notification_enabled == True
-            ).all()
-        else:  # all
-            users = User.query.filter_by(notification_enabled=True).all()
-        
-        # Создаем уведомления для каждого пользователя
-        for user in users:
-            notification = Notification(
-                user_id=user.id,
-                title='Сообщение от администратора',
-                message=message,
-                type='info'
-            )
-            db.session.add(notification)
+        if target not in ('all', 'vip', 'new'):
+            target = 'all'
         
+        # Одна запись на рассылку: пользователи получают ее при чтении уведомлений
+        broadcast = BroadcastNotification(
+            title='Сообщение от администратора',
+            message=message,
+            type='info',
+            segment=target
+        )
+        db.session.add(broadcast)
         db.session.commit()
         
+        # Количество получателей - только для отчета администратору
+        recipients = User.query.filter_by(notification_enabled=True)
+        if target == 'vip':
+            recipients = recipients.filter_by(is_vip=True)
+        elif target == 'new':
+            recipients = recipients.filter(User.created_at >= broadcast.created_at - NEW_USER_PERIOD)
+        recipients_count = recipients.count()
+        
         return {
             'success': True,
-            'message': f'Уведомление отправлено {len(users)} пользователям',
-            'recipients_count': len(users)
+            'message': f'Уведомление отправлено {recipients_count} пользователям',
+            'recipients_count': recipients_count,
+            'broadcast_id': broadcast.id
         }
         
     except Exception as e:
@@ -2670,8 +3789,7 @@ def login():
         
         if user and user.check_password(password):
             login_user(user, remember=remember)
-            user.last_activity = datetime.utcnow()
-            db.session.commit()
+            activity_buffer.touch(user.id, datetime.utcnow())
             
             flash(f'Добро пожаловать, {user.first_name}!', 'success')
             
@@ -2769,7 +3887,8 @@ def logout():
 @login_required
 def wishlist_page():
     try:
-        wishlist_items = Wishlist.query.filter_by(user_id=current_user.id).all()
+        # Страница выводит полные карточки товаров - все столбцы
+        wishlist_items = load_wishlist_items(current_user.id, columns=None)
         products = [item.product for item in wishlist_items if item.product and item.product.is_active]
         
         return render_template('wishlist.html', products=products)
@@ -2802,13 +3921,12 @@ def compare_page():
 @login_required
 def notifications_page():
     try:
-        notifications = Notification.query.filter_by(user_id=current_user.id)\
-            .order_by(Notification.created_at.desc()).all()
+        notifications = get_user_notifications(current_user)
         
-        # Помечаем все как прочитанные
-        for notification in notifications:
-            if not notification.is_read:
-                notification.is_read = True
+        # Помечаем все как прочитанные: личные - флагом, рассылки - курсором
+        Notification.query.filter_by(user_id=current_user.id, is_read=False)\
+            .update({'is_read': True}, synchronize_session=False)
+        mark_broadcasts_read(current_user)
         
         db.session.commit()
         
@@ -2835,6 +3953,56 @@ def internal_server_error(e):
     logger.error(f"Internal Server Error: {e}")
     return render_template('500.html'), 500
 
+# ==================== TELEGRAM WEBHOOK ====================
+
+# Экземпляр бота для режима webhook (создается при первом обновлении)
+_webhook_bot_lock = threading.Lock()
+_webhook_bot = {'instance': None}
+
+def get_webhook_bot():
+    """Бот, обрабатывающий обновления webhook в процессе веб-приложения.
+    
+    Состояния диалогов и очереди чатов бота хранятся в памяти процесса,
+    поэтому режим webhook требует одного процесса веб-приложения. Фоновые
+    задачи и возобновление рассылок запускаются только здесь: bot.py в этом
+    режиме лишь регистрирует webhook, процесс worker из Procfile не нужен."""
+    with _webhook_bot_lock:
+        if _webhook_bot['instance'] is None:
+            if int(os.environ.get('WEB_CONCURRENCY', 1)) > 1:
+                logger.warning("Режим webhook рассчитан на один процесс: состояния диалогов не разделяются между воркерами")
+            from bot import VogueEliteBot
+            instance = VogueEliteBot(background_tasks=app.config['BOT_BACKGROUND_TASKS'])
+            instance.start_webhook()
+            _webhook_bot['instance'] = instance
+        return _webhook_bot['instance']
+
+@app.route('/telegram/webhook', methods=['POST'])
+def telegram_webhook():
+    """Прием обновлений Telegram: проверка секрета и постановка в конвейер бота"""
+    secret = app.config['TELEGRAM_WEBHOOK_SECRET']
+    if app.config['BOT_MODE'] != 'webhook' or not secret:
+        return jsonify({'success': False, 'message': 'Webhook отключен'}), 404
+    
+    received = request.headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+    if not hmac.compare_digest(received.encode('utf-8'), secret.encode('utf-8')):
+        logger.warning(f"Webhook: неверный секретный токен от {request.remote_addr}")
+        return jsonify({'success': False, 'message': 'Forbidden'}), 403
+    
+    payload = request.get_json(silent=True)
+    if not isinstance(payload, dict) or 'update_id' not in payload:
+        return jsonify({'success': False, 'message': 'Некорректное обновление'}), 400
+    
+    try:
+        accepted = get_webhook_bot().handle_webhook_update(payload)
+    except Exception as e:
+        logger.error(f"Ошибка обработки webhook: {e}")
+        return jsonify({'success': False, 'message': 'Ошибка обработки обновления'}), 500
+    
+    if not accepted:
+        # Очередь переполнена - Telegram повторит доставку позже
+        return jsonify({'success': False, 'message': 'Очередь обновлений переполнена'}), 503
+    return jsonify({'success': True})
+
 # Health check
 @app.route('/health')
 @api_response
@@ -2856,7 +4024,8 @@ def health_check():
             'database': 'connected',
             'tables': tables_ok,
             'timestamp': datetime.utcnow().isoformat(),
-            'version': '1.0.0'
+            'version': '1.0.0',
+            'activity_buffer': activity_buffer.stats()
         }
     except Exception as e:
         logger.error(f"Health check failed: {e}")
@@ -2878,9 +4047,25 @@ def api_test():
     }
 
 # Статические файлы
-@app.route('/static/<path:filename>')
+@app.route('/static/<path:filename>', endpoint='static')
 def static_files(filename):
-    return send_from_directory('static', filename)
+    """Статика: URL с актуальным хэшем кэшируется навсегда, сжатая копия - по Accept-Encoding"""
+    relative, immutable = asset_manifest.resolve(filename)
+    variant = asset_manifest.variant(relative, lambda encoding: request.accept_encodings[encoding])
+    if variant is None:
+        return send_from_directory('static', filename)
+    
+    path, encoding, mimetype = variant
+    response = send_file(path, mimetype=mimetype, conditional=True)
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    response.vary.add('Accept-Encoding')
+    if immutable:
+        response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    else:
+        # Обычный URL (например, изображения товаров) кэшируется ненадолго, затем проверяется по ETag
+        response.headers['Cache-Control'] = f"public, max-age={app.config['STATIC_MAX_AGE']}"
+    return response
 
 # Главная функция запуска
 if __name__ == '__main__':
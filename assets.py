@@ -0,0 +1,200 @@
+# assets.py - Статические файлы с хэшем содержимого в имени и предсжатыми копиями
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import re
+import threading
+
+try:
+    import brotli
+except ImportError:
+    # Без пакета brotli отдаются только gzip-копии
+    brotli = None
+
+# Типы файлов, которые имеет смысл сжимать
+COMPRESSIBLE_EXTENSIONS = ('.css', '.js', '.mjs', '.svg', '.json', '.txt', '.html', '.xml', '.map', '.ico')
+MIN_COMPRESS_SIZE = 1024
+
+# Каталоги static/, которые не входят в манифест (загрузки пользователей)
+EXCLUDED_DIRS = ('uploads',)
+
+DIGEST_LENGTH = 12
+
+# Кодировки в порядке предпочтения: расширение копии и функция сжатия
+ENCODINGS = [('gzip', '.gz', lambda data: gzip.compress(data, compresslevel=9, mtime=0))]
+if brotli is not None:
+    ENCODINGS.insert(0, ('br', '.br', lambda data: brotli.compress(data, quality=11)))
+
+FINGERPRINT_RE = re.compile(r'^(?P<stem>.+)\.(?P<digest>[0-9a-f]{%d})(?P<ext>\.[^./]+)$' % DIGEST_LENGTH)
+
+
+def _write_atomic(path, data):
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+def fingerprint(relative, digest):
+    """css/style.css -> css/style.<хэш>.css"""
+    stem, ext = os.path.splitext(relative)
+    return f'{stem}.{digest}{ext}'
+
+
+class AssetManifest:
+    """Манифест файлов static/: хэш содержимого и сжатые копии.
+
+    URL вида /static/css/style.<хэш>.css меняется вместе с содержимым, поэтому
+    ответ по нему кэшируется навсегда (immutable). Копии gzip и brotli
+    создаются заранее (build при развертывании) в cache_dir и выбираются по
+    Accept-Encoding; процессы приложения только читают манифест (load).
+    Хэш пересчитывается при изменении файла, поэтому правки видны без
+    перезапуска."""
+
+    def __init__(self, static_root, cache_dir):
+        self.static_root = os.path.abspath(static_root)
+        self.cache_dir = cache_dir
+        self.manifest_path = os.path.join(cache_dir, 'manifest.json')
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def source_path(self, relative):
+        """Путь к файлу в static/ или None, если файла нет или он вне каталога"""
+        path = os.path.abspath(os.path.join(self.static_root, relative))
+        if not path.startswith(self.static_root + os.sep) or not os.path.isfile(path):
+            return None
+        return path
+
+    def digest(self, relative):
+        """Хэш содержимого файла (пересчитывается только при изменении) или None"""
+        path = self.source_path(relative)
+        if path is None:
+            return None
+        stat = os.stat(path)
+        key = (stat.st_mtime_ns, stat.st_size)
+        cached = self._entries.get(relative)
+        if cached and cached[0] == key:
+            return cached[1]
+        with open(path, 'rb') as f:
+            digest = hashlib.sha256(f.read()).hexdigest()[:DIGEST_LENGTH]
+        with self._lock:
+            self._entries[relative] = (key, digest)
+        return digest
+
+    def url(self, relative):
+        """URL файла с хэшем в имени; для отсутствующих файлов - обычный URL"""
+        digest = self.digest(relative)
+        if digest is None:
+            return f'/static/{relative}'
+        return f'/static/{fingerprint(relative, digest)}'
+
+    def resolve(self, requested):
+        """Исходный файл для запрошенного пути: (путь в static/, неизменяемый ли URL).
+
+        Неизменяемым считается только URL с актуальным хэшем; устаревший хэш
+        (страница из кэша после обновления) получает текущий файл без immutable."""
+        match = FINGERPRINT_RE.match(requested)
+        if match and self.source_path(requested) is None:
+            relative = match.group('stem') + match.group('ext')
+            return relative, self.digest(relative) == match.group('digest')
+        return requested, False
+
+    def _compressible(self, relative, path):
+        return relative.lower().endswith(COMPRESSIBLE_EXTENSIONS) and os.path.getsize(path) >= MIN_COMPRESS_SIZE
+
+    def _variant_path(self, digest, relative, suffix):
+        return os.path.join(self.cache_dir, digest[:2], f'{digest}{os.path.splitext(relative)[1]}{suffix}')
+
+    def compress(self, relative):
+        """Создание недостающих сжатых копий файла; возвращает число созданных"""
+        path = self.source_path(relative)
+        digest = self.digest(relative)
+        if path is None or not self._compressible(relative, path):
+            return 0
+
+        created = 0
+        data = None
+        for _, suffix, compress in ENCODINGS:
+            target = self._variant_path(digest, relative, suffix)
+            if os.path.exists(target):
+                continue
+            if data is None:
+                with open(path, 'rb') as f:
+                    data = f.read()
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            _write_atomic(target, compress(data))
+            created += 1
+        return created
+
+    def files(self):
+        """Пути всех файлов манифеста относительно static/"""
+        for root, dirs, names in os.walk(self.static_root):
+            if root == self.static_root:
+                dirs[:] = [name for name in dirs if name not in EXCLUDED_DIRS]
+            for name in names:
+                yield os.path.relpath(os.path.join(root, name), self.static_root).replace(os.sep, '/')
+
+    def build(self):
+        """Хэши всех файлов и их сжатые копии; манифест пишется в cache_dir/manifest.json.
+
+        В манифесте вместе с хэшем хранятся время изменения и размер файла:
+        по ним load проверяет, что файл не менялся после сборки."""
+        os.makedirs(self.cache_dir, exist_ok=True)
+        manifest = {}
+        compressed = 0
+        for relative in sorted(self.files()):
+            compressed += self.compress(relative)
+            digest = self.digest(relative)
+            (mtime_ns, size), _ = self._entries[relative]
+            manifest[relative] = {'file': fingerprint(relative, digest), 'digest': digest,
+                                  'mtime_ns': mtime_ns, 'size': size}
+        _write_atomic(self.manifest_path, json.dumps(manifest, ensure_ascii=False, indent=2).encode('utf-8'))
+        return {'files': len(manifest), 'compressed': compressed,
+                'encodings': [encoding for encoding, _, _ in ENCODINGS]}
+
+    def load(self):
+        """Хэши из манифеста, собранного build, без чтения самих файлов.
+
+        Возвращает число файлов или None, если манифест не собран (тогда
+        хэш файла считается при первом обращении к нему)."""
+        try:
+            with open(self.manifest_path, encoding='utf-8') as f:
+                manifest = json.load(f)
+        except FileNotFoundError:
+            return None
+        with self._lock:
+            for relative, entry in manifest.items():
+                self._entries[relative] = ((entry['mtime_ns'], entry['size']), entry['digest'])
+        return len(manifest)
+
+    def variant(self, relative, accepts):
+        """Файл для отдачи с учетом Accept-Encoding: (путь, кодировка или None, MIME-тип).
+
+        accepts(кодировка) -> качество из заголовка Accept-Encoding. Сжатая
+        копия создается при первом запросе, если build ее еще не создал."""
+        path = self.source_path(relative)
+        if path is None:
+            return None
+        mimetype = mimetypes.guess_type(relative)[0] or 'application/octet-stream'
+        if not self._compressible(relative, path):
+            return path, None, mimetype
+
+        digest = self.digest(relative)
+        for encoding, suffix, _ in ENCODINGS:
+            if accepts(encoding) > 0:
+                target = self._variant_path(digest, relative, suffix)
+                if not os.path.exists(target):
+                    self.compress(relative)
+                return target, encoding, mimetype
+        return path, None, mimetype
+
+
+if __name__ == '__main__':
+    # Сборка при развертывании: python assets.py
+    base_dir = os.path.dirname(os.path.abspath(__file__))
+    result = AssetManifest(os.path.join(base_dir, 'static'),
+                           os.path.join(base_dir, 'instance', 'asset_cache')).build()
+    print(f"Файлов в манифесте: {result['files']}, создано сжатых копий: {result['compressed']}, "
+          f"кодировки: {', '.join(result['encodings'])}")
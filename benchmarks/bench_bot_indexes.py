@@ -0,0 +1,159 @@
+# benchmarks/bench_bot_indexes.py
+"""
+Бенчмарк индексов базы данных бота.
+
+Заполняет временную базу 1M действий пользователей (плюс корзины, избранное,
+историю просмотров и заказы) и сравнивает время типовых запросов BotDatabase
+без индексов и после применения миграций схемы.
+
+Запуск из корня проекта:
+    python benchmarks/bench_bot_indexes.py --actions 1000000
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from bot import BotDatabase  # noqa: E402
+
+
+def seed(db, actions, users, products):
+    """Заполнение базы тестовыми данными"""
+    rnd = random.Random(42)
+    now = datetime.utcnow()
+    cursor = db.conn.cursor()
+
+    def ts(max_days):
+        return (now - timedelta(seconds=rnd.randint(0, max_days * 86400))).strftime('%Y-%m-%d %H:%M:%S')
+
+    user_ids = list(range(1000000, 1000000 + users))
+    product_ids = list(range(1, products + 1))
+
+    cursor.executemany('''
+        INSERT OR IGNORE INTO bot_products_cache (id, article, name, price, category, is_active, created_at)
+        VALUES (?, ?, ?, ?, ?, 1, ?)
+    ''', [(pid, f'BENCH{pid:06d}', f'Товар {pid}', rnd.randint(1000, 500000),
+           rnd.choice(['Платья', 'Костюмы', 'Сумки', 'Обувь', 'Блузы']), ts(365))
+          for pid in product_ids if pid > 5])
+
+    cursor.executemany('''
+        INSERT OR IGNORE INTO bot_users (telegram_id, first_name, referral_code, last_activity)
+        VALUES (?, ?, ?, ?)
+    ''', [(uid, f'User{uid}', f'BENCH{uid}', ts(30)) for uid in user_ids])
+
+    action_types = ['start_command', 'view_product', 'view_category', 'add_to_cart', 'search']
+    batch = []
+    for _ in range(actions):
+        batch.append((rnd.choice(user_ids), rnd.choice(action_types), None, ts(365)))
+        if len(batch) >= 50000:
+            cursor.executemany('''
+                INSERT INTO bot_user_actions (user_id, action_type, action_data, created_at)
+                VALUES (?, ?, ?, ?)
+            ''', batch)
+            batch = []
+    if batch:
+        cursor.executemany('''
+            INSERT INTO bot_user_actions (user_id, action_type, action_data, created_at)
+            VALUES (?, ?, ?, ?)
+        ''', batch)
+
+    cursor.executemany('''
+        INSERT INTO bot_view_history (user_id, product_id, viewed_at) VALUES (?, ?, ?)
+    ''', [(rnd.choice(user_ids), rnd.choice(product_ids), ts(180)) for _ in range(actions // 4)])
+
+    cursor.executemany('''
+        INSERT INTO bot_cart (user_id, product_id, quantity, added_at) VALUES (?, ?, 1, ?)
+    ''', [(rnd.choice(user_ids), rnd.choice(product_ids), ts(30)) for _ in range(actions // 20)])
+
+    cursor.executemany('''
+        INSERT OR IGNORE INTO bot_favorites (user_id, product_id, added_at) VALUES (?, ?, ?)
+    ''', [(rnd.choice(user_ids), rnd.choice(product_ids), ts(90)) for _ in range(actions // 20)])
+
+    cursor.executemany('''
+        INSERT INTO bot_orders (order_number, user_id, total_amount, final_amount, items_json, created_at)
+        VALUES (?, ?, ?, ?, '[]', ?)
+    ''', [(f'BENCH{i}', rnd.choice(user_ids), 1000, 1000, ts(365)) for i in range(actions // 50)])
+
+    db.conn.commit()
+    return user_ids
+
+
+def drop_indexes(db):
+    """Удаление индексов, созданных миграциями"""
+    cursor = db.conn.cursor()
+    cursor.execute("SELECT name FROM sqlite_master WHERE type = 'index' AND name LIKE 'idx_bot_%'")
+    for row in cursor.fetchall():
+        cursor.execute(f'DROP INDEX {row["name"]}')
+    cursor.execute('DELETE FROM bot_schema_version')
+    cursor.execute('ANALYZE')
+    db.conn.commit()
+
+
+def measure(db, user_ids, rounds):
+    """Замер времени типовых запросов, мс на вызов"""
+    rnd = random.Random(7)
+    sample = [rnd.choice(user_ids) for _ in range(rounds)]
+    cursor = db.conn.cursor()
+
+    queries = {
+        'get_user_stats': lambda uid: db.get_user_stats(uid),
+        'get_cart': lambda uid: db.get_cart(uid),
+        'get_view_history': lambda uid: db.get_view_history(uid),
+        'get_favorites': lambda uid: db.get_favorites(uid),
+        'get_products(category)': lambda uid: db.get_products(category='Сумки', limit=6, offset=0),
+        'cleanup scan (actions)': lambda uid: cursor.execute(
+            'SELECT COUNT(*) FROM bot_user_actions WHERE created_at < datetime("now", "-180 days")').fetchone(),
+        'cleanup scan (views)': lambda uid: cursor.execute(
+            'SELECT COUNT(*) FROM bot_view_history WHERE viewed_at < datetime("now", "-90 days")').fetchone(),
+    }
+
+    results = {}
+    for name, query in queries.items():
+        calls = sample if not name.startswith('cleanup') else sample[:max(1, rounds // 10)]
+        started = time.perf_counter()
+        for uid in calls:
+            query(uid)
+        results[name] = (time.perf_counter() - started) * 1000 / len(calls)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Бенчмарк индексов базы данных бота')
+    parser.add_argument('--actions', type=int, default=1000000, help='Количество строк bot_user_actions')
+    parser.add_argument('--users', type=int, default=20000, help='Количество пользователей')
+    parser.add_argument('--products', type=int, default=5000, help='Количество товаров')
+    parser.add_argument('--rounds', type=int, default=200, help='Количество вызовов каждого запроса')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db = BotDatabase(db_path=os.path.join(tmp, 'bench.db'))
+
+        started = time.perf_counter()
+        user_ids = seed(db, args.actions, args.users, args.products)
+        print(f"Заполнение: {args.actions} действий за {time.perf_counter() - started:.1f} с")
+
+        drop_indexes(db)
+        before = measure(db, user_ids, args.rounds)
+
+        started = time.perf_counter()
+        db.run_migrations()
+        print(f"Миграции (создание индексов): {time.perf_counter() - started:.1f} с, "
+              f"версия схемы {db.get_schema_version()}")
+        after = measure(db, user_ids, args.rounds)
+
+        print()
+        print(f"{'Запрос':<26}{'без индексов, мс':>18}{'с индексами, мс':>18}{'ускорение':>12}")
+        for name in before:
+            speedup = before[name] / after[name] if after[name] else float('inf')
+            print(f"{name:<26}{before[name]:>18.3f}{after[name]:>18.3f}{speedup:>11.1f}x")
+
+        db.close()
+
+
+if __name__ == '__main__':
+    main()
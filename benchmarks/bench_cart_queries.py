@@ -0,0 +1,109 @@
+# benchmarks/bench_cart_queries.py
+"""
+Проверка числа SQL-запросов страниц корзины и избранного.
+
+Во временной базе веб-приложения заполняет корзину и избранное пользователя
+одной позицией, затем N позициями и считает выполненные запросы
+(событие before_cursor_execute). Число запросов не должно зависеть от
+количества позиций: товары загружаются вместе с позициями одним JOIN.
+Оба запуска должны отвечать HTTP 200: число запросов перенаправления на
+страницу ошибки ничего не доказывает.
+
+Запуск из корня проекта:
+    python benchmarks/bench_cart_queries.py --lines 50
+"""
+import argparse
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+TMP_DIR = tempfile.mkdtemp(prefix='bench_cart_')
+os.environ['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(TMP_DIR, 'bench.db')
+
+from sqlalchemy import event  # noqa: E402
+from werkzeug.security import generate_password_hash  # noqa: E402
+
+import app as web  # noqa: E402
+
+EMAIL = 'bench@example.com'
+PASSWORD = 'bench123'
+
+ENDPOINTS = [
+    ('/cart', 'GET'),
+    ('/checkout', 'GET'),
+    ('/api/cart', 'GET'),
+    ('/api/cart/sync', 'GET'),
+    ('/api/wishlist', 'GET'),
+    ('/wishlist', 'GET'),
+]
+
+
+def seed(lines):
+    """Пользователь и активные товары в количестве, достаточном для N позиций"""
+    user = web.User(first_name='Bench', email=EMAIL, password_hash=generate_password_hash(PASSWORD))
+    web.db.session.add(user)
+    for number in range(lines):
+        web.db.session.add(web.Product(article=f'BENCH{number:05d}', name=f'Товар {number}', price=1000 + number,
+                                       category='Платья', stock=100, is_active=True))
+    web.db.session.commit()
+    product_ids = [product_id for (product_id,) in web.db.session.query(web.Product.id).filter(
+        web.Product.article.like('BENCH%')).order_by(web.Product.id)]
+    return user.id, product_ids
+
+
+def fill(user_id, product_ids):
+    """Корзина и избранное пользователя из заданных товаров"""
+    web.Cart.query.filter_by(user_id=user_id).delete()
+    web.Wishlist.query.filter_by(user_id=user_id).delete()
+    for product_id in product_ids:
+        web.db.session.add(web.Cart(user_id=user_id, product_id=product_id, quantity=1))
+        web.db.session.add(web.Wishlist(user_id=user_id, product_id=product_id))
+    web.refresh_cart_summary(user_id)
+    web.db.session.commit()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Число SQL-запросов корзины и избранного')
+    parser.add_argument('--lines', type=int, default=50, help='Позиций в корзине и избранном')
+    args = parser.parse_args()
+
+    web.init_database()
+    statements = {'count': 0}
+
+    with web.app.app_context():
+        user_id, product_ids = seed(args.lines)
+        event.listen(web.db.engine, 'before_cursor_execute',
+                     lambda *_: statements.__setitem__('count', statements['count'] + 1))
+
+    client = web.app.test_client()
+    client.post('/login', data={'email': EMAIL, 'password': PASSWORD})
+
+    results = {}
+    for lines in (1, args.lines):
+        for path, method in ENDPOINTS:
+            with web.app.app_context():
+                fill(user_id, product_ids[:lines])
+            statements['count'] = 0
+            response = client.open(path, method=method)
+            results.setdefault(path, []).append((response.status_code, statements['count']))
+
+    print(f"{'Маршрут':<20}{'1 позиция':>12}{f'{args.lines} позиций':>14}{'статус':>10}")
+    passed = True
+    for path, _ in ENDPOINTS:
+        (status_one, one), (status_many, many) = results[path]
+        if status_one != 200 or status_many != 200:
+            mark = 'ОШИБКА'
+        elif one != many:
+            mark = 'РАСТЕТ'
+        else:
+            mark = 'OK'
+        passed = passed and mark == 'OK'
+        print(f"{path:<20}{one:>12}{many:>14}{mark:>10}   HTTP {status_one}/{status_many}")
+
+    sys.exit(0 if passed else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+# benchmarks/bench_search.py
+"""
+Бенчмарк поиска товаров: FTS5 с ранжированием bm25 против LIKE '%q%'.
+
+Заполняет временную базу бота каталогом из 100k товаров и сравнивает время
+BotDatabase.search_products (FTS5) и BotDatabase.search_products_like.
+
+Запуск из корня проекта:
+    python benchmarks/bench_search.py --products 100000
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from bot import BotDatabase  # noqa: E402
+
+BRANDS = ['Gucci', 'Chanel', 'Dior', 'Prada', 'Versace', 'Armani', 'Burberry', 'Balenciaga',
+          'Saint Laurent', 'Valentino', 'Fendi', 'Hermès', 'Bottega Veneta', 'Max Mara']
+CATEGORIES = ['Платья', 'Костюмы', 'Блузы', 'Брюки', 'Юбки', 'Пальто', 'Сумки', 'Обувь', 'Украшения']
+ADJECTIVES = ['вечернее', 'шелковое', 'кашемировое', 'кожаная', 'классический', 'летнее',
+              'эксклюзивная', 'замшевые', 'льняная', 'бархатный']
+NOUNS = ['платье', 'пальто', 'сумка', 'костюм', 'блуза', 'туфли', 'юбка', 'жакет', 'браслет', 'клатч']
+WORDS = ['коллекция', 'сезон', 'итальянский', 'ручная', 'работа', 'премиальный', 'шелк', 'кашемир',
+         'кожа', 'вышивка', 'кристаллы', 'подкладка', 'силуэт', 'элегантный', 'вечер']
+
+QUERIES = ['gucci', 'кашемировое пальто', 'плать', 'Balenciaga сумка', 'вышивка кристаллы',
+           'BENCH0042', 'несуществующийтовар']
+
+
+def seed(db, products):
+    """Заполнение кэша товаров (индекс FTS поддерживается триггерами)"""
+    rnd = random.Random(42)
+    rows = []
+    for pid in range(1000, 1000 + products):
+        brand = rnd.choice(BRANDS)
+        name = f'{rnd.choice(ADJECTIVES).capitalize()} {rnd.choice(NOUNS)} {brand}'
+        description = ' '.join(rnd.choice(WORDS) for _ in range(25))
+        rows.append((pid, f'BENCH{pid:06d}', name, description, rnd.randint(1000, 500000),
+                     rnd.choice(CATEGORIES), brand))
+
+    started = time.perf_counter()
+    with db.transaction() as conn:
+        conn.executemany('''
+            INSERT INTO bot_products_cache (id, article, name, description, price, category, brand, is_active)
+            VALUES (?, ?, ?, ?, ?, ?, ?, 1)
+        ''', rows)
+    return time.perf_counter() - started
+
+
+def measure(search, rounds):
+    """Среднее время запроса, мс"""
+    results = {}
+    for query in QUERIES:
+        started = time.perf_counter()
+        for _ in range(rounds):
+            found = search(query, limit=10)
+        results[query] = ((time.perf_counter() - started) * 1000 / rounds, len(found))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Бенчмарк поиска товаров')
+    parser.add_argument('--products', type=int, default=100000, help='Количество товаров')
+    parser.add_argument('--rounds', type=int, default=20, help='Количество повторов каждого запроса')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db = BotDatabase(db_path=os.path.join(tmp, 'bench.db'))
+        if not db.fts_enabled:
+            print("FTS5 недоступен в этой сборке SQLite")
+            return
+
+        elapsed = seed(db, args.products)
+        print(f"Заполнение: {args.products} товаров за {elapsed:.1f} с (включая индекс FTS)")
+
+        like = measure(db.search_products_like, args.rounds)
+        fts = measure(db.search_products, args.rounds)
+
+        print()
+        print(f"{'Запрос':<24}{'LIKE, мс':>12}{'FTS5, мс':>12}{'ускорение':>12}{'найдено':>10}")
+        for query in QUERIES:
+            speedup = like[query][0] / fts[query][0] if fts[query][0] else float('inf')
+            print(f"{query:<24}{like[query][0]:>12.3f}{fts[query][0]:>12.3f}{speedup:>11.1f}x"
+                  f"{like[query][1]:>5}/{fts[query][1]:<4}")
+
+        db.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,178 @@
+# benchmarks/replay_webhook.py
+"""
+Нагрузочный прогон обработки обновлений через webhook без сети.
+
+Записанные обновления Telegram (JSON-файлы, каталоги с ними или JSONL)
+отправляются в маршрут /telegram/webhook веб-приложения через тестовый
+клиент Flask. Запросы бота к Bot API перехватываются и получают
+фиктивные ответы (с необязательной задержкой, имитирующей сеть), база
+бота создается во временном каталоге.
+
+Запуск из корня проекта:
+    python benchmarks/replay_webhook.py updates/ --latency-ms 30
+    python benchmarks/replay_webhook.py --generate 5000 --chats 200
+"""
+import argparse
+import glob
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, ROOT)
+
+SECRET = 'replay-secret'
+
+MENU_TEXTS = ['👗 Каталог', '🛍️ Корзина', '📦 Заказы', '👤 Профиль', '💖 Избранное',
+              '🏷️ Скидки', '📞 Поддержка', '🏠 Главная']
+CALLBACKS = ['show_catalog', 'view_cart', 'show_favorites']
+
+
+class FakeResponse:
+    """Ответ Bot API, подходящий для любого метода (Message, User или True)"""
+    status_code = 200
+    reason = 'OK'
+
+    def __init__(self, chat_id):
+        self._payload = {'ok': True, 'result': {
+            'message_id': random.randint(1, 10 ** 6), 'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private'},
+            'id': 1, 'is_bot': True, 'first_name': 'VogueEliteBot', 'username': 'vogue_elite_bot'
+        }}
+        self.text = json.dumps(self._payload)
+        self.content = self.text.encode('utf-8')
+
+    def json(self):
+        return self._payload
+
+
+def install_fake_api(latency_ms):
+    """Перехват запросов telebot к Bot API"""
+    import telebot.apihelper as apihelper
+    counter = {'calls': 0}
+    lock = threading.Lock()
+
+    def sender(method, url, params=None, **kwargs):
+        if latency_ms:
+            time.sleep(latency_ms / 1000)
+        with lock:
+            counter['calls'] += 1
+        chat_id = (params or {}).get('chat_id', 1)
+        return FakeResponse(int(chat_id) if str(chat_id).lstrip('-').isdigit() else 1)
+
+    apihelper.CUSTOM_REQUEST_SENDER = sender
+    return counter
+
+
+def load_updates(paths):
+    """Чтение записанных обновлений из файлов и каталогов"""
+    updates = []
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(sorted(glob.glob(os.path.join(path, '*.json*'))))
+        else:
+            files.append(path)
+
+    for file_path in files:
+        with open(file_path, encoding='utf-8') as f:
+            if file_path.endswith('.jsonl'):
+                updates.extend(json.loads(line) for line in f if line.strip())
+            else:
+                data = json.load(f)
+                updates.extend(data if isinstance(data, list) else [data])
+    return updates
+
+
+def generate_updates(count, chats):
+    """Синтетические обновления: /start, кнопки меню и callback-запросы"""
+    rnd = random.Random(42)
+    updates = []
+    for update_id in range(1, count + 1):
+        chat_id = 5000000 + rnd.randrange(chats)
+        user = {'id': chat_id, 'is_bot': False, 'first_name': f'User{chat_id}', 'language_code': 'ru'}
+        chat = {'id': chat_id, 'type': 'private'}
+        kind = rnd.random()
+        if kind < 0.1:
+            updates.append({'update_id': update_id, 'message': {
+                'message_id': update_id, 'date': int(time.time()), 'chat': chat, 'from': user,
+                'text': '/start', 'entities': [{'type': 'bot_command', 'offset': 0, 'length': 6}]}})
+        elif kind < 0.7:
+            updates.append({'update_id': update_id, 'message': {
+                'message_id': update_id, 'date': int(time.time()), 'chat': chat, 'from': user,
+                'text': rnd.choice(MENU_TEXTS)}})
+        else:
+            updates.append({'update_id': update_id, 'callback_query': {
+                'id': str(update_id), 'from': user, 'chat_instance': str(chat_id),
+                'data': rnd.choice(CALLBACKS),
+                'message': {'message_id': update_id, 'date': int(time.time()), 'chat': chat, 'text': '...'}}})
+    return updates
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Прогон записанных обновлений через webhook')
+    parser.add_argument('paths', nargs='*', help='JSON/JSONL-файлы или каталоги с обновлениями')
+    parser.add_argument('--generate', type=int, default=0, help='Сгенерировать N синтетических обновлений')
+    parser.add_argument('--chats', type=int, default=100, help='Количество чатов для генерации')
+    parser.add_argument('--latency-ms', type=float, default=0, help='Имитация задержки Bot API, мс')
+    parser.add_argument('--workers', type=int, default=None, help='Количество воркеров конвейера')
+    args = parser.parse_args()
+
+    updates = load_updates(args.paths)
+    if args.generate:
+        updates.extend(generate_updates(args.generate, args.chats))
+    if not updates:
+        parser.error('нет обновлений: укажите файлы или --generate')
+
+    with tempfile.TemporaryDirectory() as tmp:
+        # Логи и база бота создаются во временном каталоге
+        os.chdir(tmp)
+        os.environ['BOT_MODE'] = 'webhook'
+        os.environ['WEBHOOK_SECRET'] = SECRET
+
+        import bot
+        if args.workers:
+            bot.Config.UPDATE_WORKERS = args.workers
+        api_calls = install_fake_api(args.latency_ms)
+
+        import app as web
+        app = web.app
+        app.config['BOT_BACKGROUND_TASKS'] = False
+        client = app.test_client()
+        headers = {'X-Telegram-Bot-Api-Secret-Token': SECRET}
+
+        # Первое обновление создает бота: в замер не входит
+        client.post('/telegram/webhook', json=updates[0], headers=headers)
+        dispatcher = web.get_webhook_bot().dispatcher
+        baseline = dispatcher.metrics()['processed']
+
+        statuses = {}
+        started = time.perf_counter()
+        for update in updates[1:]:
+            response = client.post('/telegram/webhook', json=update, headers=headers)
+            statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+        ingested = time.perf_counter() - started
+
+        accepted = statuses.get(200, 0)
+        while dispatcher.metrics()['processed'] - baseline < accepted:
+            time.sleep(0.01)
+        total = time.perf_counter() - started
+
+        metrics = dispatcher.metrics()
+        dispatcher.stop()
+
+        print(f"Обновлений: {len(updates) - 1}, ответы: {statuses}")
+        print(f"Прием через webhook: {ingested:.2f} с ({(len(updates) - 1) / ingested:.0f} обновлений/с)")
+        print(f"Полная обработка: {total:.2f} с ({accepted / total:.0f} обновлений/с), "
+              f"запросов к Bot API: {api_calls['calls']}")
+        print(f"Метрики конвейера: {metrics}")
+
+        os.chdir(ROOT)
+
+
+if __name__ == '__main__':
+    main()
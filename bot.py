@@ -5,14 +5,25 @@ import logging
 from datetime import datetime, timedelta
 import time
 import threading
+import queue
 import random
 import sqlite3
 import os
 import requests
 import hashlib
+import tempfile
 import urllib.parse
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from typing import Optional, Dict, List, Any
 
+from search import create_fts_index, fts_table_exists, build_match_query, search_sql, SearchIndex
+from writebehind import CoalescingBuffer, BatchWriter
+from statestore import StateStore
+from recommender import (build_neighbors, group_baskets, order_basket, ORDER_WEIGHT, CART_WEIGHT,
+                         FAVORITE_WEIGHT, VIEW_WEIGHT)
+
 # Настройка логирования
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
@@ -40,6 +51,35 @@ class Config:
     DATABASE_PATH = 'fashion_store.db'
     CURRENCY = "₽"
     SYNC_INTERVAL = 300  # 5 минут
+    UPDATE_WORKERS = 8  # Воркеры обработки обновлений
+    UPDATE_QUEUE_SIZE = 100  # Размер очереди каждого воркера
+    METRICS_INTERVAL = 60  # Период записи метрик конвейера, с
+    BROADCAST_RATE = 25  # Сообщений рассылки в секунду (лимит Telegram - 30)
+    BROADCAST_WORKERS = 8  # Потоки отправки рассылки
+    BROADCAST_PROGRESS_INTERVAL = 3  # Период обновления прогресса рассылки, с
+    ACTIVITY_FLUSH_INTERVAL = 5  # Период сброса времени активности пользователей, с
+    ACTION_LOG_INTERVAL = 1  # Период записи журнала действий, с
+    ACTION_LOG_QUEUE_SIZE = 10000  # Размер очереди журнала действий
+    ACTION_LOG_SPILL_PATH = 'bot_actions_spill.jsonl'  # Файл переполнения очереди журнала
+    STATE_TTL = 86400  # Время жизни состояния диалога, с
+    STATE_MAX_ENTRIES = 50000  # Состояний в памяти
+    STATE_WRITE_THROUGH = True  # Копия состояний в базе для восстановления после перезапуска
+    # Чат для предварительной загрузки изображений товаров (по умолчанию - первый администратор)
+    MEDIA_WARMUP_CHAT_ID = int(os.environ.get('MEDIA_WARMUP_CHAT_ID', 0)) or (ADMIN_IDS[0] if ADMIN_IDS else None)
+    MEDIA_WARMUP_BATCH = 50  # Изображений за один проход прогрева
+    RECOMMENDER_INTERVAL = 3600  # Период пересчета рекомендаций, с
+    RECOMMENDER_TOP_K = 10  # Соседей товара в таблице рекомендаций
+    RECOMMENDER_VIEW_DAYS = 90  # Глубина истории просмотров для рекомендаций, дней
+    # Режим получения обновлений: polling (процесс bot.py) или webhook (через веб-приложение).
+    # Состояния диалогов и очереди чатов живут в памяти процесса, поэтому в режиме
+    # webhook веб-приложение должно работать одним процессом (gunicorn --workers 1).
+    # В режиме webhook фоновые задачи и рассылки запускает веб-приложение, а
+    # python bot.py только регистрирует webhook и завершается: процесс worker
+    # из Procfile в этом режиме нужно убрать (heroku ps:scale worker=0)
+    BOT_MODE = os.environ.get('BOT_MODE', 'polling')
+    WEBHOOK_URL = os.environ.get('WEBHOOK_URL', WEB_APP_URL)
+    WEBHOOK_SECRET = os.environ.get('WEBHOOK_SECRET', '')
+    WEBHOOK_PATH = '/telegram/webhook'
 
 class Emoji:
     LOGO = "✨"
@@ -134,25 +174,209 @@ class Emoji:
     PACKAGE = "📦"
     EYES = "👀"
 
+# Пул соединений SQLite: отдельное соединение на каждый поток
+class ConnectionPool:
+    PRAGMAS = (
+        'PRAGMA journal_mode=WAL',
+        'PRAGMA synchronous=NORMAL',
+        'PRAGMA cache_size=-16000',       # 16 MB страничного кэша
+        'PRAGMA mmap_size=268435456',     # 256 MB memory-mapped I/O
+        'PRAGMA temp_store=MEMORY',
+        'PRAGMA busy_timeout=5000',
+        # INSERT OR REPLACE должен вызывать триггеры удаления (индекс FTS)
+        'PRAGMA recursive_triggers=ON',
+    )
+    
+    def __init__(self, db_path: str, timeout: float = 30.0):
+        self.db_path = db_path
+        self.timeout = timeout
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._connections: Dict[int, sqlite3.Connection] = {}
+    
+    def _connect(self) -> sqlite3.Connection:
+        """Открытие нового соединения с настройками производительности"""
+        conn = sqlite3.connect(self.db_path, timeout=self.timeout, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        for pragma in self.PRAGMAS:
+            conn.execute(pragma)
+        return conn
+    
+    def connection(self) -> sqlite3.Connection:
+        """Соединение текущего потока (создается при первом обращении)"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._connect()
+            self._local.conn = conn
+            with self._lock:
+                # Идентификатор завершившегося потока может быть выдан повторно
+                stale = self._connections.get(threading.get_ident())
+                self._connections[threading.get_ident()] = conn
+            if stale is not None:
+                stale.close()
+        return conn
+    
+    @contextmanager
+    def transaction(self):
+        """Транзакция с захватом блокировки записи (BEGIN IMMEDIATE).
+        
+        Вложенные вызовы выполняются в рамках внешней транзакции."""
+        conn = self.connection()
+        if conn.in_transaction:
+            yield conn
+            return
+        
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield conn
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+    
+    def close_all(self):
+        """Закрытие соединений всех потоков"""
+        with self._lock:
+            connections = list(self._connections.values())
+            self._connections.clear()
+        for conn in connections:
+            try:
+                conn.close()
+            except Exception as e:
+                logger.error(f"Ошибка закрытия соединения: {e}")
+        self._local = threading.local()
+
 # Класс для работы с базой данных бота
 class BotDatabase:
+    # Версионные миграции схемы: (версия, описание, SQL-выражения или функции от курсора)
+    SCHEMA_MIGRATIONS = [
+        (1, 'Индексы для корзины, избранного, истории, действий, заказов и каталога', [
+            'CREATE INDEX IF NOT EXISTS idx_bot_cart_user_added ON bot_cart (user_id, added_at)',
+            'CREATE INDEX IF NOT EXISTS idx_bot_favorites_user_added ON bot_favorites (user_id, added_at)',
+            'CREATE INDEX IF NOT EXISTS idx_bot_view_history_user_viewed ON bot_view_history (user_id, viewed_at, product_id)',
+            'CREATE INDEX IF NOT EXISTS idx_bot_view_history_viewed ON bot_view_history (viewed_at)',
+            'CREATE INDEX IF NOT EXISTS idx_bot_user_actions_user_created ON bot_user_actions (user_id, created_at)',
+            'CREATE INDEX IF NOT EXISTS idx_bot_user_actions_created ON bot_user_actions (created_at)',
+            'CREATE INDEX IF NOT EXISTS idx_bot_orders_user_created ON bot_orders (user_id, created_at)',
+            'CREATE INDEX IF NOT EXISTS idx_bot_orders_created ON bot_orders (created_at)',
+            'CREATE INDEX IF NOT EXISTS idx_bot_user_states_created ON bot_user_states (created_at)',
+            'CREATE INDEX IF NOT EXISTS idx_bot_users_last_activity ON bot_users (last_activity)',
+            'CREATE INDEX IF NOT EXISTS idx_bot_products_category_active_created ON bot_products_cache (category, is_active, created_at)',
+            'CREATE INDEX IF NOT EXISTS idx_bot_products_active_created ON bot_products_cache (is_active, created_at)',
+        ]),
+        (2, 'Состояние инкрементальной синхронизации', [
+            '''CREATE TABLE IF NOT EXISTS bot_sync_state (
+                key TEXT PRIMARY KEY,
+                value TEXT,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )''',
+        ]),
+        (3, 'Полнотекстовый поиск по товарам (FTS5)', [
+            lambda cursor: create_fts_index(cursor, 'bot_products_fts', 'bot_products_cache'),
+        ]),
+        (4, 'Задания рассылки с курсором по получателям', [
+            '''CREATE TABLE IF NOT EXISTS bot_broadcast_jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                admin_id INTEGER NOT NULL,
+                target_type TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                status TEXT DEFAULT 'running',
+                total_count INTEGER DEFAULT 0,
+                sent_count INTEGER DEFAULT 0,
+                failed_count INTEGER DEFAULT 0,
+                progress_message_id INTEGER,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                finished_at TIMESTAMP
+            )''',
+            '''CREATE TABLE IF NOT EXISTS bot_broadcast_recipients (
+                job_id INTEGER NOT NULL,
+                telegram_id INTEGER NOT NULL,
+                status TEXT DEFAULT 'pending',
+                attempts INTEGER DEFAULT 0,
+                error TEXT,
+                sent_at TIMESTAMP,
+                PRIMARY KEY (job_id, telegram_id)
+            )''',
+            'CREATE INDEX IF NOT EXISTS idx_bot_broadcast_recipients_status ON bot_broadcast_recipients (job_id, status, telegram_id)',
+            'CREATE INDEX IF NOT EXISTS idx_bot_broadcast_jobs_status ON bot_broadcast_jobs (status)',
+        ]),
+        (5, 'Кэш file_id изображений Telegram', [
+            '''CREATE TABLE IF NOT EXISTS bot_media_cache (
+                image_url TEXT PRIMARY KEY,
+                file_id TEXT NOT NULL,
+                file_unique_id TEXT,
+                content_hash TEXT,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )''',
+        ]),
+        (6, 'Индексы keyset-пагинации каталога', [
+            # Индекс v1 с тем же началом ключа заменяется индексом с id под другим именем
+            'DROP INDEX IF EXISTS idx_bot_products_active_created',
+            'CREATE INDEX IF NOT EXISTS idx_bot_products_active_created_id ON bot_products_cache(is_active, created_at, id)',
+            'CREATE INDEX IF NOT EXISTS idx_bot_products_active_category_created '
+            'ON bot_products_cache(is_active, category, created_at, id)',
+        ]),
+        (7, 'Рекомендации: соседи товаров', [
+            '''CREATE TABLE IF NOT EXISTS bot_product_neighbors (
+                product_id INTEGER NOT NULL,
+                neighbor_id INTEGER NOT NULL,
+                rank INTEGER NOT NULL,
+                score REAL NOT NULL,
+                built_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (product_id, neighbor_id)
+            )''',
+            'CREATE INDEX IF NOT EXISTS idx_bot_product_neighbors_rank ON bot_product_neighbors (product_id, rank)',
+        ]),
+        (8, 'Индекс keyset-пагинации для баз, где v6 не создала его из-за совпадения имени', [
+            'DROP INDEX IF EXISTS idx_bot_products_active_created',
+            'CREATE INDEX IF NOT EXISTS idx_bot_products_active_created_id ON bot_products_cache(is_active, created_at, id)',
+        ]),
+    ]
+
     def __init__(self, db_path=Config.DATABASE_PATH):
         self.db_path = db_path
         self.web_app_url = Config.WEB_APP_URL
-        self.conn = None
+        self.pool = None
+        self._fts_enabled = None
+        self._search_index = None
+        self._search_index_lock = threading.Lock()
+        self._media_cache = None
+        self._recommendation_state = None
+        # Время активности пользователей пишется пакетами в фоне
+        self.activity = CoalescingBuffer(self._flush_activity, Config.ACTIVITY_FLUSH_INTERVAL, 'bot-activity')
+        # Журнал действий пишется фоновым потоком, при перегрузке - в файл
+        self.action_log = BatchWriter(self._write_actions, Config.ACTION_LOG_INTERVAL, Config.ACTION_LOG_QUEUE_SIZE,
+                                      spill_path=Config.ACTION_LOG_SPILL_PATH, name='bot-action-log')
+        # Состояния диалогов: в памяти, сроки истекают по колесу таймеров
+        self.states = StateStore(ttl=Config.STATE_TTL, max_entries=Config.STATE_MAX_ENTRIES,
+                                 loader=self._load_persisted_state, on_expire=self._delete_persisted_states)
         self.init_connection()
         self.init_db()
+        if Config.STATE_WRITE_THROUGH:
+            self.restore_user_states()
+        self.states.start()
     
     def init_connection(self):
-        """Инициализация соединения с базой данных"""
+        """Инициализация пула соединений с базой данных"""
         try:
-            self.conn = sqlite3.connect(self.db_path, check_same_thread=False)
-            self.conn.row_factory = sqlite3.Row
-            logger.info(f"Подключение к базе данных установлено: {self.db_path}")
+            self.pool = ConnectionPool(self.db_path)
+            self.pool.connection()
+            logger.info(f"Подключение к базе данных установлено: {self.db_path} (WAL)")
         except Exception as e:
             logger.error(f"Ошибка подключения к базе данных: {e}")
             raise
     
+    @property
+    def conn(self) -> sqlite3.Connection:
+        """Соединение текущего потока"""
+        return self.pool.connection()
+    
+    def transaction(self):
+        """Контекстный менеджер транзакции на соединении текущего потока"""
+        return self.pool.transaction()
+    
     def init_db(self):
         """Инициализация структуры базы данных"""
         cursor = self.conn.cursor()
@@ -416,9 +640,62 @@ class BotDatabase:
                 (code, description, discount_percent, discount_amount, min_order_amount, usage_limit, used_count, valid_from, valid_until)
                 VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
             ''', promo)
-        
+
         self.conn.commit()
         logger.info("База данных бота инициализирована с тестовыми данными")
+
+        # Применяем миграции схемы
+        self.run_migrations()
+
+    def get_schema_version(self) -> int:
+        """Текущая версия схемы базы данных"""
+        cursor = self.conn.cursor()
+        cursor.execute('SELECT COALESCE(MAX(version), 0) AS version FROM bot_schema_version')
+        return cursor.fetchone()['version']
+
+    def run_migrations(self):
+        """Применение версионных миграций схемы (идемпотентно)"""
+        cursor = self.conn.cursor()
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS bot_schema_version (
+                version INTEGER PRIMARY KEY,
+                description TEXT,
+                applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+
+        current_version = self.get_schema_version()
+        applied = 0
+
+        for version, description, statements in self.SCHEMA_MIGRATIONS:
+            if version <= current_version:
+                continue
+
+            try:
+                for statement in statements:
+                    if callable(statement):
+                        statement(cursor)
+                    else:
+                        cursor.execute(statement)
+
+                cursor.execute('''
+                    INSERT INTO bot_schema_version (version, description)
+                    VALUES (?, ?)
+                ''', (version, description))
+                self.conn.commit()
+                applied += 1
+                logger.info(f"Применена миграция схемы v{version}: {description}")
+            except Exception as e:
+                logger.error(f"Ошибка применения миграции v{version}: {e}")
+                self.conn.rollback()
+                raise
+
+        if applied:
+            # Обновляем статистику планировщика после создания индексов
+            cursor.execute('ANALYZE')
+            self.conn.commit()
+
+        logger.info(f"Версия схемы базы данных: {self.get_schema_version()}")
     
     def sync_with_webapp(self):
         """Синхронизация с веб-приложением"""
@@ -441,84 +718,176 @@ class BotDatabase:
             logger.error(f"Ошибка синхронизации с веб-приложением: {e}")
             return False
     
-    def sync_products(self):
-        """Синхронизация товаров с веб-приложением"""
+    # Колонки кэша товаров, заполняемые при синхронизации
+    PRODUCT_SYNC_COLUMNS = (
+        'id', 'article', 'name', 'description', 'detailed_description', 'price', 'old_price',
+        'discount', 'category', 'subcategory', 'size', 'color', 'material', 'brand', 'season',
+        'country', 'image_url', 'images', 'is_new', 'is_hit', 'is_exclusive', 'is_limited',
+        'is_active', 'stock', 'weight', 'dimensions', 'care_instructions', 'created_at', 'updated_at'
+    )
+    
+    @staticmethod
+    def _product_sync_row(product: Dict[str, Any]) -> tuple:
+        """Преобразование товара из API в строку bot_products_cache"""
+        # Преобразуем изображения в JSON строку
+        images = json.dumps(product.get('images', [])) if product.get('images') else None
+        return (
+            product['id'],
+            product.get('article', ''),
+            product.get('name', ''),
+            product.get('description', ''),
+            product.get('detailed_description', ''),
+            product.get('price', 0),
+            product.get('old_price'),
+            product.get('discount', 0),
+            product.get('category', ''),
+            product.get('subcategory'),
+            product.get('size'),
+            product.get('color'),
+            product.get('material'),
+            product.get('brand'),
+            product.get('season'),
+            product.get('country'),
+            product.get('image_url', ''),
+            images,
+            product.get('is_new', False),
+            product.get('is_hit', False),
+            product.get('is_exclusive', False),
+            product.get('is_limited', False),
+            product.get('is_active', True),
+            product.get('stock', 0),
+            product.get('weight'),
+            product.get('dimensions'),
+            product.get('care_instructions'),
+            product.get('created_at'),
+            product.get('updated_at')
+        )
+    
+    def get_sync_state(self, key: str) -> Optional[str]:
+        """Получение сохраненного значения состояния синхронизации"""
+        cursor = self.conn.cursor()
+        cursor.execute('SELECT value FROM bot_sync_state WHERE key = ?', (key,))
+        row = cursor.fetchone()
+        return row['value'] if row else None
+    
+    def set_sync_state(self, key: str, value: Optional[str]):
+        """Сохранение значения состояния синхронизации (в текущей транзакции)"""
+        self.conn.execute('''
+            INSERT INTO bot_sync_state (key, value, updated_at)
+            VALUES (?, ?, CURRENT_TIMESTAMP)
+            ON CONFLICT(key) DO UPDATE SET value = excluded.value, updated_at = excluded.updated_at
+        ''', (key, value))
+    
+    def _upsert_product_rows(self, conn: sqlite3.Connection, rows: List[tuple]):
+        """Пакетная запись строк кэша товаров"""
+        columns = ', '.join(self.PRODUCT_SYNC_COLUMNS)
+        placeholders = ', '.join('?' * len(self.PRODUCT_SYNC_COLUMNS))
+        conn.executemany(f'''
+            INSERT OR REPLACE INTO bot_products_cache ({columns}, last_synced)
+            VALUES ({placeholders}, CURRENT_TIMESTAMP)
+        ''', rows)
+    
+    def sync_products(self, batch_size: int = 500):
+        """Инкрементальная синхронизация товаров с веб-приложением.
+        
+        Потоковая NDJSON-выгрузка товаров, измененных после сохраненного
+        курсора (updated_at, id), включая деактивированные и удаленные,
+        сначала целиком читается во временный файл. Только после проверки
+        строки _eof товары пишутся пачками одной транзакцией вместе с новым
+        курсором, поэтому блокировка записи не удерживается на время
+        сетевого чтения.
+        ETag прошлого ответа передается в If-None-Match: неизменный каталог
+        отвечает 304 без тела."""
         try:
-            url = f"{self.web_app_url}/api/products"
-            logger.info(f"Запрос товаров с {url}")
-            
-            response = requests.get(url, timeout=30)
-            
-            if response.status_code == 200:
-                data = response.json()
-                if data.get('success'):
-                    products = data.get('products', [])
-                    
-                    cursor = self.conn.cursor()
-                    synced_count = 0
+            url = f"{self.web_app_url}/api/products/export"
+            cursor = self.get_sync_state('products_cursor')
+            watermark = self.get_sync_state('products_watermark')
+            etag = self.get_sync_state('products_etag')
+            logger.info(f"Запрос изменений товаров с {url} (с отметки {watermark or 'начала'})")
+            
+            if cursor:
+                params = {'cursor': cursor}
+            else:
+                # Первая синхронизация по курсору продолжает с прежней отметки updated_at
+                params = {'updated_since': watermark or '1970-01-01T00:00:00'}
+            headers = {'If-None-Match': etag} if etag else {}
+            with tempfile.TemporaryFile() as spool:
+                with requests.get(url, params=params, headers=headers, stream=True, timeout=30) as response:
+                    if response.status_code == 304:
+                        logger.info("Каталог не изменился (304)")
+                        return True
+                    if response.status_code != 200:
+                        logger.warning(f"Ошибка HTTP при синхронизации товаров: {response.status_code}")
+                        # Если API недоступно, используем локальные данные
+                        return True
                     
-                    for product in products:
+                    last_line = None
+                    for line in response.iter_lines():
+                        if line:
+                            spool.write(line + b'\n')
+                            last_line = line
+                    etag = response.headers.get('ETag')
+                
+                # Оборванная выгрузка не применяется и повторится с прежней отметки
+                footer = json.loads(last_line) if last_line else None
+                if not footer or not footer.get('_eof'):
+                    raise ValueError("Выгрузка товаров оборвана до завершения")
+                
+                synced_count = 0
+                deleted_count = 0
+                batch = []
+                index_changes = []
+                spool.seek(0)
+                
+                with self.transaction() as conn:
+                    for line in spool:
+                        product = json.loads(line)
+                        if product.get('_eof'):
+                            break
+                        
+                        if product.get('_deleted'):
+                            # Порядок изменений сохраняется: накопленная пачка пишется до удаления
+                            if batch:
+                                self._upsert_product_rows(conn, batch)
+                                synced_count += len(batch)
+                                batch = []
+                            conn.execute('DELETE FROM bot_products_cache WHERE id = ?', (product['id'],))
+                            index_changes.append((product['id'], None))
+                            deleted_count += 1
+                            continue
+                        
                         try:
-                            # Преобразуем изображения в JSON строку
-                            images = json.dumps(product.get('images', [])) if product.get('images') else None
-                            
-                            cursor.execute('''
-                                INSERT OR REPLACE INTO bot_products_cache 
-                                (id, article, name, description, detailed_description, price, old_price, 
-                                 discount, category, subcategory, size, color, material, brand, season, 
-                                 country, image_url, images, is_new, is_hit, is_exclusive, is_limited, 
-                                 is_active, stock, weight, dimensions, care_instructions, created_at, updated_at, last_synced)
-                                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
-                            ''', (
-                                product['id'],
-                                product.get('article', ''),
-                                product.get('name', ''),
-                                product.get('description', ''),
-                                product.get('detailed_description', ''),
-                                product.get('price', 0),
-                                product.get('old_price'),
-                                product.get('discount', 0),
-                                product.get('category', ''),
-                                product.get('subcategory'),
-                                product.get('size'),
-                                product.get('color'),
-                                product.get('material'),
-                                product.get('brand'),
-                                product.get('season'),
-                                product.get('country'),
-                                product.get('image_url', ''),
-                                images,
-                                product.get('is_new', False),
-                                product.get('is_hit', False),
-                                product.get('is_exclusive', False),
-                                product.get('is_limited', False),
-                                True,  # is_active
-                                product.get('stock', 0),
-                                product.get('weight'),
-                                product.get('dimensions'),
-                                product.get('care_instructions'),
-                                product.get('created_at'),
-                                product.get('updated_at')
-                            ))
-                            
-                            if cursor.rowcount > 0:
-                                synced_count += 1
-                                
+                            batch.append(self._product_sync_row(product))
+                            index_changes.append((product['id'], self._search_fields(product)
+                                                  if product.get('is_active', True) else None))
                         except Exception as e:
                             logger.error(f"Ошибка синхронизации товара {product.get('id')}: {e}")
+                        
+                        if len(batch) >= batch_size:
+                            self._upsert_product_rows(conn, batch)
+                            synced_count += len(batch)
+                            batch = []
                     
-                    self.conn.commit()
-                    logger.info(f"Синхронизировано товаров: {synced_count}")
-                    return True
-                else:
-                    logger.warning(f"API вернуло ошибку: {data.get('message')}")
-                    # Если API недоступно, используем локальные данные
-                    return True
+                    if batch:
+                        self._upsert_product_rows(conn, batch)
+                        synced_count += len(batch)
+                    
+                    if footer.get('cursor'):
+                        self.set_sync_state('products_cursor', footer['cursor'])
+                    if footer.get('watermark'):
+                        self.set_sync_state('products_watermark', footer['watermark'])
+                    self.set_sync_state('products_etag', etag)
+            
+            # Индекс в памяти обновляется только после фиксации транзакции
+            self.apply_search_index_changes(index_changes)
+            
+            if synced_count or deleted_count:
+                logger.info(f"Синхронизировано изменений товаров: {synced_count}, удалено: {deleted_count}, "
+                            f"отметка {footer.get('watermark')}")
             else:
-                logger.warning(f"Ошибка HTTP при синхронизации товаров: {response.status_code}")
-                # Если API недоступно, используем локальные данные
-                return True
-                
+                logger.info("Изменений товаров нет")
+            return True
+        
         except requests.exceptions.RequestException as e:
             logger.error(f"Ошибка сети при синхронизации товаров: {e}")
             # Если API недоступно, используем локальные данные
@@ -526,7 +895,7 @@ class BotDatabase:
         except Exception as e:
             logger.error(f"Неожиданная ошибка при синхронизации товаров: {e}")
             return True
-    
+
     def sync_users(self):
         """Синхронизация пользователей с веб-приложением"""
         try:
@@ -580,6 +949,7 @@ class BotDatabase:
     def force_clear_all_states(self):
         """Принудительная очистка всех состояний пользователей (экстренная функция)"""
         try:
+            self.states.clear()
             cursor = self.conn.cursor()
             cursor.execute('DELETE FROM bot_user_states')
             self.conn.commit()
@@ -592,11 +962,12 @@ class BotDatabase:
     def clear_user_state_by_id(self, user_id: int):
         """Принудительная очистка состояния конкретного пользователя"""
         try:
+            in_memory = self.states.delete(user_id)
             cursor = self.conn.cursor()
             cursor.execute('DELETE FROM bot_user_states WHERE user_id = ?', (user_id,))
             self.conn.commit()
             logger.info(f"Состояние пользователя {user_id} очищено принудительно")
-            return cursor.rowcount > 0
+            return in_memory or cursor.rowcount > 0
         except Exception as e:
             logger.error(f"Ошибка очистки состояния пользователя: {e}")
             return False
@@ -643,13 +1014,10 @@ class BotDatabase:
                 ''', (telegram_id, username, first_name, last_name, language_code, referral_code))
                 
                 # Логируем действие
-                cursor.execute('''
-                    INSERT INTO bot_user_actions (user_id, action_type, action_data)
-                    VALUES (?, ?, ?)
-                ''', (telegram_id, 'registration', json.dumps({
+                self.log_user_action(telegram_id, 'registration', {
                     'referral_code': referral_code,
                     'source': 'telegram_bot'
-                })))
+                })
                 
                 is_new = True
                 logger.info(f"Новый пользователь зарегистрирован: {first_name} (@{username}) ID: {telegram_id}")
@@ -672,17 +1040,18 @@ class BotDatabase:
             return {'success': False, 'error': str(e)}
     
     def update_user_activity(self, telegram_id: int):
-        """Обновление времени последней активности пользователя"""
-        try:
-            cursor = self.conn.cursor()
-            cursor.execute('''
+        """Обновление времени последней активности пользователя (отложенная запись)"""
+        # Формат совпадает с CURRENT_TIMESTAMP SQLite
+        self.activity.touch(telegram_id, datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S'))
+    
+    def _flush_activity(self, items: List[tuple]):
+        """Пакетная запись накопленного времени активности: [(telegram_id, время)]"""
+        with self.transaction() as conn:
+            conn.executemany('''
                 UPDATE bot_users 
-                SET last_activity = CURRENT_TIMESTAMP 
+                SET last_activity = ? 
                 WHERE telegram_id = ?
-            ''', (telegram_id,))
-            self.conn.commit()
-        except Exception as e:
-            logger.error(f"Ошибка обновления активности пользователя: {e}")
+            ''', [(last_activity, telegram_id) for telegram_id, last_activity in items])
     
     def get_user(self, telegram_id: int) -> Optional[Dict[str, Any]]:
         """Получение данных пользователя"""
@@ -717,8 +1086,15 @@ class BotDatabase:
             return None
     
     def get_products(self, category: str = None, limit: int = 10, offset: int = 0, 
-                    filters: Dict[str, Any] = None) -> List[Dict[str, Any]]:
-        """Получение товаров с фильтрацией"""
+                    filters: Dict[str, Any] = None, after_id: int = None,
+                    before_id: int = None) -> List[Dict[str, Any]]:
+        """Получение товаров с фильтрацией.
+        
+        Порядок - (created_at, id) по убыванию. after_id/before_id - keyset-страница
+        после или перед товаром с этим id: условие по индексу вместо OFFSET.
+        Для before_id последней строкой идет первый товар начиная с before_id,
+        если он есть: как и в остальных случаях, строка сверх limit - 1 означает
+        следующую страницу."""
         try:
             cursor = self.conn.cursor()
             query = 'SELECT * FROM bot_products_cache WHERE is_active = 1'
@@ -745,12 +1121,28 @@ class BotDatabase:
                     query += ' AND brand = ?'
                     params.append(filters['brand'])
             
-            query += ' ORDER BY created_at DESC LIMIT ? OFFSET ?'
-            params.extend([limit, offset])
+            anchor = 'SELECT created_at, id FROM bot_products_cache WHERE id = ?'
+            if after_id:
+                query += f' AND (created_at, id) < ({anchor}) ORDER BY created_at DESC, id DESC LIMIT ?'
+                params.extend([after_id, limit])
+            elif before_id:
+                # Предыдущая страница читается в обратном порядке, к ней добавляется
+                # первая строка от before_id - признак следующей страницы
+                query = (
+                    f'SELECT * FROM ({query} AND (created_at, id) > ({anchor}) '
+                    f'ORDER BY created_at ASC, id ASC LIMIT ?) '
+                    f'UNION ALL '
+                    f'SELECT * FROM ({query} AND (created_at, id) <= ({anchor}) '
+                    f'ORDER BY created_at DESC, id DESC LIMIT 1) '
+                    f'ORDER BY created_at DESC, id DESC'
+                )
+                params = params + [before_id, max(limit - 1, 0)] + params + [before_id]
+            else:
+                query += ' ORDER BY created_at DESC, id DESC LIMIT ? OFFSET ?'
+                params.extend([limit, offset])
             
             cursor.execute(query, params)
-            rows = cursor.fetchall()
-            return [dict(row) for row in rows]
+            return [dict(row) for row in cursor.fetchall()]
         except Exception as e:
             logger.error(f"Ошибка получения товаров: {e}")
             return []
@@ -767,7 +1159,93 @@ class BotDatabase:
             return None
     
     def search_products(self, query: str, limit: int = 10) -> List[Dict[str, Any]]:
-        """Поиск товаров"""
+        """Поиск товаров с ранжированием по релевантности (FTS5, иначе LIKE)"""
+        products = None
+        match = build_match_query(query)
+        if match and self.fts_enabled:
+            try:
+                cursor = self.conn.cursor()
+                cursor.execute(
+                    search_sql('bot_products_fts', 'bot_products_cache', where='p.is_active = 1'),
+                    (match, limit)
+                )
+                products = [dict(row) for row in cursor.fetchall()]
+            except sqlite3.OperationalError as e:
+                logger.error(f"Ошибка полнотекстового поиска, используется LIKE: {e}")
+        
+        if products is None:
+            products = self.search_products_like(query, limit)
+        
+        # Ничего не нашлось - возможно, опечатка или бренд написан по-русски
+        if not products:
+            products = self.fuzzy_search_products(query, limit)
+        return products
+    
+    @staticmethod
+    def _search_fields(product: Dict[str, Any]) -> Dict[str, Any]:
+        """Поля товара для индекса поиска с опечатками"""
+        return {
+            'name': product.get('name'),
+            'brand': product.get('brand'),
+            'category': product.get('category'),
+            'article': product.get('article')
+        }
+    
+    @property
+    def search_index(self) -> SearchIndex:
+        """Индекс поиска с опечатками (строится из кэша товаров при первом обращении)"""
+        if self._search_index is None:
+            with self._search_index_lock:
+                # Индекс мог построить другой поток, пока этот ждал блокировку
+                if self._search_index is None:
+                    index = SearchIndex()
+                    cursor = self.conn.cursor()
+                    cursor.execute('SELECT id, name, brand, category, article FROM bot_products_cache WHERE is_active = 1')
+                    for row in cursor.fetchall():
+                        index.upsert(row['id'], self._search_fields(dict(row)))
+                    self._search_index = index
+                    logger.info(f"Индекс поиска построен: {len(index)} товаров")
+        return self._search_index
+    
+    def apply_search_index_changes(self, changes: List[tuple]):
+        """Инкрементальное обновление индекса: (id, поля) или (id, None) для удаления"""
+        # Блокировка не дает изменениям проскочить между чтением кэша и публикацией индекса
+        with self._search_index_lock:
+            if self._search_index is None:
+                return
+            for product_id, fields in changes:
+                if fields is None:
+                    self._search_index.remove(product_id)
+                else:
+                    self._search_index.upsert(product_id, fields)
+    
+    def fuzzy_search_products(self, query: str, limit: int = 10) -> List[Dict[str, Any]]:
+        """Поиск с учетом опечаток и транслитерации по индексу в памяти"""
+        try:
+            product_ids = self.search_index.search(query, limit=limit)
+            if not product_ids:
+                return []
+            
+            cursor = self.conn.cursor()
+            placeholders = ', '.join('?' * len(product_ids))
+            cursor.execute(f'''
+                SELECT * FROM bot_products_cache WHERE id IN ({placeholders}) AND is_active = 1
+            ''', product_ids)
+            found = {row['id']: dict(row) for row in cursor.fetchall()}
+            return [found[product_id] for product_id in product_ids if product_id in found]
+        except Exception as e:
+            logger.error(f"Ошибка поиска с опечатками: {e}")
+            return []
+    
+    @property
+    def fts_enabled(self) -> bool:
+        """Создан ли полнотекстовый индекс товаров"""
+        if self._fts_enabled is None:
+            self._fts_enabled = fts_table_exists(self.conn, 'bot_products_fts')
+        return self._fts_enabled
+    
+    def search_products_like(self, query: str, limit: int = 10) -> List[Dict[str, Any]]:
+        """Поиск товаров по подстроке (без индекса)"""
         try:
             cursor = self.conn.cursor()
             search_term = f'%{query}%'
@@ -824,15 +1302,12 @@ class BotDatabase:
             self.update_user_activity(user_id)
             
             # Логируем действие
-            cursor.execute('''
-                INSERT INTO bot_user_actions (user_id, action_type, action_data)
-                VALUES (?, ?, ?)
-            ''', (user_id, 'add_to_cart', json.dumps({
+            self.log_user_action(user_id, 'add_to_cart', {
                 'product_id': product_id,
                 'quantity': quantity,
                 'size': size,
                 'color': color
-            })))
+            })
             
             self.conn.commit()
             return True
@@ -916,13 +1391,10 @@ class BotDatabase:
                 cursor.execute('UPDATE bot_cart SET quantity = ? WHERE id = ?', (quantity, cart_item_id))
             
             # Логируем действие
-            cursor.execute('''
-                INSERT INTO bot_user_actions (user_id, action_type, action_data)
-                VALUES (?, ?, ?)
-            ''', (user_id, 'update_cart', json.dumps({
+            self.log_user_action(user_id, 'update_cart', {
                 'cart_item_id': cart_item_id,
                 'quantity': quantity
-            })))
+            })
             
             self.conn.commit()
             return True
@@ -946,12 +1418,9 @@ class BotDatabase:
             cursor.execute('DELETE FROM bot_cart WHERE id = ?', (cart_item_id,))
             
             # Логируем действие
-            cursor.execute('''
-                INSERT INTO bot_user_actions (user_id, action_type, action_data)
-                VALUES (?, ?, ?)
-            ''', (user_id, 'remove_from_cart', json.dumps({
+            self.log_user_action(user_id, 'remove_from_cart', {
                 'cart_item_id': cart_item_id
-            })))
+            })
             
             self.conn.commit()
             return True
@@ -968,10 +1437,7 @@ class BotDatabase:
             cursor.execute('DELETE FROM bot_cart WHERE user_id = ?', (user_id,))
             
             # Логируем действие
-            cursor.execute('''
-                INSERT INTO bot_user_actions (user_id, action_type, action_data)
-                VALUES (?, ?, ?)
-            ''', (user_id, 'clear_cart', json.dumps({})))
+            self.log_user_action(user_id, 'clear_cart', {})
             
             self.conn.commit()
             return True
@@ -990,12 +1456,9 @@ class BotDatabase:
             ''', (user_id, product_id))
             
             # Логируем действие
-            cursor.execute('''
-                INSERT INTO bot_user_actions (user_id, action_type, action_data)
-                VALUES (?, ?, ?)
-            ''', (user_id, 'add_to_favorites', json.dumps({
+            self.log_user_action(user_id, 'add_to_favorites', {
                 'product_id': product_id
-            })))
+            })
             
             self.conn.commit()
             return True
@@ -1012,12 +1475,9 @@ class BotDatabase:
                          (user_id, product_id))
             
             # Логируем действие
-            cursor.execute('''
-                INSERT INTO bot_user_actions (user_id, action_type, action_data)
-                VALUES (?, ?, ?)
-            ''', (user_id, 'remove_from_favorites', json.dumps({
+            self.log_user_action(user_id, 'remove_from_favorites', {
                 'product_id': product_id
-            })))
+            })
             
             self.conn.commit()
             return cursor.rowcount > 0
@@ -1075,31 +1535,99 @@ class BotDatabase:
             logger.error(f"Ошибка получения истории просмотров: {e}")
             return []
     
+    # ==================== РЕКОМЕНДАЦИИ ====================
+    
+    def _recommendation_signature(self) -> tuple:
+        """Отпечаток исходных данных рекомендаций (число и максимальный id строк)"""
+        cursor = self.conn.cursor()
+        signature = []
+        for table in ('bot_orders', 'bot_cart', 'bot_favorites', 'bot_view_history'):
+            cursor.execute(f'SELECT COUNT(*), MAX(id) FROM {table}')
+            signature.append(tuple(cursor.fetchone()))
+        return tuple(signature)
+    
+    def _recommendation_baskets(self):
+        """Корзины для расчета: заказы, корзины, избранное и история просмотров"""
+        cursor = self.conn.cursor()
+        cursor.execute('SELECT items_json FROM bot_orders')
+        for row in cursor.fetchall():
+            yield ORDER_WEIGHT, order_basket(row['items_json'])
+        
+        cursor.execute('SELECT user_id, product_id FROM bot_cart ORDER BY user_id, added_at')
+        yield from group_baskets(cursor.fetchall(), CART_WEIGHT)
+        cursor.execute('SELECT user_id, product_id FROM bot_favorites ORDER BY user_id, added_at')
+        yield from group_baskets(cursor.fetchall(), FAVORITE_WEIGHT)
+        cursor.execute('''
+            SELECT user_id, product_id FROM bot_view_history
+            WHERE viewed_at >= datetime('now', ?)
+            ORDER BY user_id, viewed_at
+        ''', (f'-{Config.RECOMMENDER_VIEW_DAYS} days',))
+        yield from group_baskets(cursor.fetchall(), VIEW_WEIGHT)
+    
+    def refresh_product_neighbors(self, force: bool = False) -> Optional[int]:
+        """Пересчет таблицы соседей; без новых заказов, корзин и просмотров пропускается.
+        
+        Возвращает число записанных строк или None, если пересчет не нужен."""
+        signature = self._recommendation_signature()
+        if not force and signature == self._recommendation_state:
+            return None
+        
+        neighbors = build_neighbors(self._recommendation_baskets(), Config.RECOMMENDER_TOP_K)
+        rows = [
+            (product_id, neighbor_id, rank, score)
+            for product_id, scored in neighbors.items()
+            for rank, (neighbor_id, score) in enumerate(scored)
+        ]
+        
+        # Таблица заменяется целиком в одной транзакции
+        with self.transaction() as conn:
+            conn.execute('DELETE FROM bot_product_neighbors')
+            conn.executemany('''
+                INSERT INTO bot_product_neighbors (product_id, neighbor_id, rank, score)
+                VALUES (?, ?, ?, ?)
+            ''', rows)
+        self._recommendation_state = signature
+        logger.info(f"Рекомендации пересчитаны: товаров {len(neighbors)}, связей {len(rows)}")
+        return len(rows)
+    
+    def get_product_neighbors(self, product_id: int, limit: int = 3) -> List[Dict[str, Any]]:
+        """Рекомендованные к товару активные товары по убыванию оценки"""
+        try:
+            cursor = self.conn.cursor()
+            cursor.execute('''
+                SELECT p.* FROM bot_product_neighbors n
+                JOIN bot_products_cache p ON p.id = n.neighbor_id
+                WHERE n.product_id = ? AND p.is_active = 1
+                ORDER BY n.rank
+                LIMIT ?
+            ''', (product_id, limit))
+            return [dict(row) for row in cursor.fetchall()]
+        except Exception as e:
+            logger.error(f"Ошибка получения рекомендаций для товара {product_id}: {e}")
+            return []
+    
     def save_user_state(self, user_id: int, state: str, data: Dict[str, Any] = None):
         """Сохранение состояния пользователя"""
         try:
-            cursor = self.conn.cursor()
-            data_json = json.dumps(data) if data else None
+            self.states.set(user_id, state, data or None)
             
-            cursor.execute('''
-                INSERT OR REPLACE INTO bot_user_states (user_id, state, data)
-                VALUES (?, ?, ?)
-            ''', (user_id, state, data_json))
-            self.conn.commit()
+            if Config.STATE_WRITE_THROUGH:
+                # Копия в базе нужна только для восстановления после перезапуска
+                self.conn.execute('''
+                    INSERT OR REPLACE INTO bot_user_states (user_id, state, data)
+                    VALUES (?, ?, ?)
+                ''', (user_id, state, json.dumps(data) if data else None))
+                self.conn.commit()
         except Exception as e:
             logger.error(f"Ошибка сохранения состояния пользователя: {e}")
     
     def get_user_state(self, user_id: int) -> Optional[Dict[str, Any]]:
         """Получение состояния пользователя"""
         try:
-            cursor = self.conn.cursor()
-            cursor.execute('SELECT state, data FROM bot_user_states WHERE user_id = ?', (user_id,))
-            row = cursor.fetchone()
-            
-            if row:
-                data = json.loads(row['data']) if row['data'] else None
-                return {'state': row['state'], 'data': data}
-            return None
+            entry = self.states.get(user_id)
+            if entry is None:
+                return None
+            return {'state': entry[0], 'data': entry[1]}
         except Exception as e:
             logger.error(f"Ошибка получения состояния пользователя: {e}")
             return None
@@ -1107,26 +1635,73 @@ class BotDatabase:
     def clear_user_state(self, user_id: int):
         """Очистка состояния пользователя"""
         try:
-            cursor = self.conn.cursor()
-            cursor.execute('DELETE FROM bot_user_states WHERE user_id = ?', (user_id,))
-            self.conn.commit()
+            self.states.delete(user_id)
+            # Запись в базе удаляется всегда: вытесненное из памяти состояние
+            # иначе вернулось бы через _load_persisted_state
+            if Config.STATE_WRITE_THROUGH:
+                self.conn.execute('DELETE FROM bot_user_states WHERE user_id = ?', (user_id,))
+                self.conn.commit()
         except Exception as e:
             logger.error(f"Ошибка очистки состояния пользователя: {e}")
     
+    def _load_persisted_state(self, user_id: int) -> Optional[tuple]:
+        """Состояние из базы: (state, data, возраст в секундах)"""
+        cursor = self.conn.cursor()
+        cursor.execute('''
+            SELECT state, data, (julianday('now') - julianday(created_at)) * 86400 AS age
+            FROM bot_user_states WHERE user_id = ?
+        ''', (user_id,))
+        row = cursor.fetchone()
+        if not row:
+            return None
+        return row['state'], json.loads(row['data']) if row['data'] else None, row['age'] or 0.0
+    
+    def _delete_persisted_states(self, user_ids: List[int]):
+        """Удаление истекших состояний из базы"""
+        if not Config.STATE_WRITE_THROUGH:
+            return
+        with self.transaction() as conn:
+            conn.executemany('DELETE FROM bot_user_states WHERE user_id = ?', [(user_id,) for user_id in user_ids])
+    
+    def restore_user_states(self):
+        """Загрузка неистекших состояний из базы после перезапуска"""
+        cursor = self.conn.cursor()
+        with self.transaction() as conn:
+            conn.execute('''
+                DELETE FROM bot_user_states
+                WHERE created_at < datetime('now', ?)
+            ''', (f'-{Config.STATE_TTL} seconds',))
+        
+        cursor.execute('''
+            SELECT user_id, state, data, (julianday('now') - julianday(created_at)) * 86400 AS age
+            FROM bot_user_states
+        ''')
+        restored = 0
+        for row in cursor.fetchall():
+            data = json.loads(row['data']) if row['data'] else None
+            self.states.set(row['user_id'], row['state'], data, row['age'] or 0.0)
+            restored += 1
+        if restored:
+            logger.info(f"Восстановлено состояний пользователей: {restored}")
+    
     def log_user_action(self, user_id: int, action_type: str, action_data: Dict[str, Any] = None):
-        """Логирование действий пользователя"""
+        """Логирование действий пользователя (асинхронная пакетная запись)"""
         try:
-            cursor = self.conn.cursor()
             data_json = json.dumps(action_data) if action_data else None
-            
-            cursor.execute('''
-                INSERT INTO bot_user_actions (user_id, action_type, action_data)
-                VALUES (?, ?, ?)
-            ''', (user_id, action_type, data_json))
-            self.conn.commit()
+            # Время фиксируется в момент действия, а не записи пачки
+            created_at = datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
+            self.action_log.put((user_id, action_type, data_json, created_at))
         except Exception as e:
             logger.error(f"Ошибка логирования действия пользователя: {e}")
     
+    def _write_actions(self, rows: List[tuple]):
+        """Запись пачки действий одной транзакцией"""
+        with self.transaction() as conn:
+            conn.executemany('''
+                INSERT INTO bot_user_actions (user_id, action_type, action_data, created_at)
+                VALUES (?, ?, ?, ?)
+            ''', rows)
+    
     def get_promo_code(self, code: str) -> Optional[Dict[str, Any]]:
         """Получение информации о промокоде"""
         try:
@@ -1232,75 +1807,71 @@ class BotDatabase:
                 items_data.append(item_data)
             
             # Создаем заказ
-            cursor = self.conn.cursor()
-            cursor.execute('''
-                INSERT INTO bot_orders 
-                (order_number, user_id, total_amount, discount_amount, delivery_cost, final_amount,
-                 delivery_address, delivery_type, payment_method, promo_code, customer_notes, items_json)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-            ''', (
-                order_number,
-                user_id,
-                subtotal,
-                discount,
-                delivery_cost,
-                final_amount,
-                order_data.get('address', ''),
-                order_data.get('delivery_type', 'courier'),
-                order_data.get('payment_method', 'card'),
-                promo_code,
-                order_data.get('notes', ''),
-                json.dumps(items_data)
-            ))
+            with self.transaction() as conn:
+                cursor = conn.cursor()
+                cursor.execute('''
+                    INSERT INTO bot_orders 
+                    (order_number, user_id, total_amount, discount_amount, delivery_cost, final_amount,
+                     delivery_address, delivery_type, payment_method, promo_code, customer_notes, items_json)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ''', (
+                    order_number,
+                    user_id,
+                    subtotal,
+                    discount,
+                    delivery_cost,
+                    final_amount,
+                    order_data.get('address', ''),
+                    order_data.get('delivery_type', 'courier'),
+                    order_data.get('payment_method', 'card'),
+                    promo_code,
+                    order_data.get('notes', ''),
+                    json.dumps(items_data)
+                ))
             
-            order_id = cursor.lastrowid
+                order_id = cursor.lastrowid
             
-            # Обновляем остатки товаров
-            for item in cart_items:
-                cursor.execute('''
-                    UPDATE bot_products_cache 
-                    SET stock = stock - ? 
-                    WHERE id = ?
-                ''', (item['quantity'], item['product_id']))
+                # Обновляем остатки товаров
+                for item in cart_items:
+                    cursor.execute('''
+                        UPDATE bot_products_cache 
+                        SET stock = stock - ? 
+                        WHERE id = ?
+                    ''', (item['quantity'], item['product_id']))
             
-            # Очищаем корзину
-            cursor.execute('DELETE FROM bot_cart WHERE user_id = ?', (user_id,))
+                # Очищаем корзину
+                cursor.execute('DELETE FROM bot_cart WHERE user_id = ?', (user_id,))
             
-            # Обновляем статистику пользователя
-            cursor.execute('''
-                UPDATE bot_users 
-                SET total_orders = total_orders + 1, 
-                    total_spent = total_spent + ?,
-                    last_activity = CURRENT_TIMESTAMP
-                WHERE telegram_id = ?
-            ''', (final_amount, user_id))
+                # Обновляем статистику пользователя
+                cursor.execute('''
+                    UPDATE bot_users 
+                    SET total_orders = total_orders + 1, 
+                        total_spent = total_spent + ?,
+                        last_activity = CURRENT_TIMESTAMP
+                    WHERE telegram_id = ?
+                ''', (final_amount, user_id))
             
-            # Присваиваем VIP статус при достижении порога
-            cursor.execute('SELECT total_spent FROM bot_users WHERE telegram_id = ?', (user_id,))
-            total_spent = cursor.fetchone()['total_spent']
+                # Присваиваем VIP статус при достижении порога
+                cursor.execute('SELECT total_spent FROM bot_users WHERE telegram_id = ?', (user_id,))
+                total_spent = cursor.fetchone()['total_spent']
             
-            if total_spent >= 100000:
-                cursor.execute('UPDATE bot_users SET is_vip = 1 WHERE telegram_id = ?', (user_id,))
+                if total_spent >= 100000:
+                    cursor.execute('UPDATE bot_users SET is_vip = 1 WHERE telegram_id = ?', (user_id,))
             
-            # Обновляем использование промокода
-            if promo_code:
-                cursor.execute('''
-                    UPDATE bot_promo_codes 
-                    SET used_count = used_count + 1 
-                    WHERE code = ?
-                ''', (promo_code,))
+                # Обновляем использование промокода
+                if promo_code:
+                    cursor.execute('''
+                        UPDATE bot_promo_codes 
+                        SET used_count = used_count + 1 
+                        WHERE code = ?
+                    ''', (promo_code,))
             
-            # Логируем действие
-            cursor.execute('''
-                INSERT INTO bot_user_actions (user_id, action_type, action_data)
-                VALUES (?, ?, ?)
-            ''', (user_id, 'create_order', json.dumps({
+            # Логируем действие после фиксации заказа
+            self.log_user_action(user_id, 'create_order', {
                 'order_number': order_number,
                 'order_id': order_id,
                 'amount': final_amount
-            })))
-            
-            self.conn.commit()
+            })
             
             # Получаем данные заказа
             cursor.execute('SELECT * FROM bot_orders WHERE id = ?', (order_id,))
@@ -1514,9 +2085,7 @@ class BotDatabase:
         try:
             cursor = self.conn.cursor()
             
-            # Очищаем старые состояния пользователей (старше 1 дня)
-            cursor.execute('DELETE FROM bot_user_states WHERE created_at < datetime("now", "-1 day")')
-            states_deleted = cursor.rowcount
+            # Состояния пользователей истекают в StateStore по TTL
             
             # Очищаем старую историю просмотров (старше 90 дней)
             cursor.execute('DELETE FROM bot_view_history WHERE viewed_at < datetime("now", "-90 days")')
@@ -1528,28 +2097,510 @@ class BotDatabase:
             
             self.conn.commit()
             
-            if any([states_deleted, views_deleted, actions_deleted]):
-                logger.info(f"Очищены данные: состояния={states_deleted}, просмотры={views_deleted}, действия={actions_deleted}")
+            if any([views_deleted, actions_deleted]):
+                logger.info(f"Очищены данные: просмотры={views_deleted}, действия={actions_deleted}")
             
         except Exception as e:
             logger.error(f"Ошибка очистки старых данных: {e}")
     
+    # ==================== КЭШ ИЗОБРАЖЕНИЙ ====================
+    
+    def get_media_file_id(self, image_url: str) -> Optional[str]:
+        """file_id Telegram для изображения (из памяти, при первом обращении - из базы)"""
+        if self._media_cache is None:
+            cursor = self.conn.cursor()
+            cursor.execute('SELECT image_url, file_id FROM bot_media_cache')
+            self._media_cache = {row['image_url']: row['file_id'] for row in cursor.fetchall()}
+        return self._media_cache.get(image_url)
+    
+    def save_media_file_id(self, image_url: str, file_id: str, file_unique_id: Optional[str] = None,
+                           content_hash: Optional[str] = None):
+        """Сохранение file_id, полученного при первой отправке изображения"""
+        try:
+            with self.transaction() as conn:
+                conn.execute('''
+                    INSERT INTO bot_media_cache (image_url, file_id, file_unique_id, content_hash)
+                    VALUES (?, ?, ?, ?)
+                    ON CONFLICT(image_url) DO UPDATE SET
+                        file_id = excluded.file_id,
+                        file_unique_id = excluded.file_unique_id,
+                        content_hash = COALESCE(excluded.content_hash, bot_media_cache.content_hash),
+                        updated_at = CURRENT_TIMESTAMP
+                ''', (image_url, file_id, file_unique_id, content_hash))
+            if self._media_cache is not None:
+                self._media_cache[image_url] = file_id
+        except Exception as e:
+            logger.error(f"Ошибка сохранения file_id изображения: {e}")
+    
+    def touch_media(self, image_url: str):
+        """Отметка проверки изображения, содержимое которого не изменилось"""
+        with self.transaction() as conn:
+            conn.execute('UPDATE bot_media_cache SET updated_at = CURRENT_TIMESTAMP WHERE image_url = ?', (image_url,))
+    
+    def invalidate_media(self, image_url: str):
+        """Удаление недействительного file_id"""
+        try:
+            with self.transaction() as conn:
+                conn.execute('DELETE FROM bot_media_cache WHERE image_url = ?', (image_url,))
+            if self._media_cache is not None:
+                self._media_cache.pop(image_url, None)
+        except Exception as e:
+            logger.error(f"Ошибка удаления file_id изображения: {e}")
+    
+    def get_media_to_warm(self, limit: int = 50) -> List[Dict[str, Any]]:
+        """Изображения активных товаров без file_id или измененные после его получения"""
+        cursor = self.conn.cursor()
+        cursor.execute('''
+            SELECT p.image_url, m.content_hash, m.image_url IS NOT NULL AS cached
+            FROM bot_products_cache p
+            LEFT JOIN bot_media_cache m ON m.image_url = p.image_url
+            WHERE p.is_active = 1 AND p.image_url IS NOT NULL AND p.image_url != ''
+              AND (m.image_url IS NULL OR m.updated_at < p.last_synced)
+            GROUP BY p.image_url
+            LIMIT ?
+        ''', (limit,))
+        return [dict(row) for row in cursor.fetchall()]
+    
+    # ==================== РАССЫЛКИ ====================
+    
+    # Условия выбора получателей рассылки
+    BROADCAST_TARGETS = {
+        'all': 'is_admin = 0',
+        'vip': 'is_vip = 1',
+    }
+    
+    def create_broadcast_job(self, admin_id: int, target_type: str, payload: Dict[str, Any]) -> Optional[int]:
+        """Создание задания рассылки вместе со списком получателей"""
+        condition = self.BROADCAST_TARGETS.get(target_type)
+        if condition is None:
+            return None
+        
+        with self.transaction() as conn:
+            cursor = conn.execute('''
+                INSERT INTO bot_broadcast_jobs (admin_id, target_type, payload)
+                VALUES (?, ?, ?)
+            ''', (admin_id, target_type, json.dumps(payload)))
+            job_id = cursor.lastrowid
+            
+            cursor = conn.execute(f'''
+                INSERT INTO bot_broadcast_recipients (job_id, telegram_id)
+                SELECT ?, telegram_id FROM bot_users WHERE {condition}
+            ''', (job_id,))
+            conn.execute('UPDATE bot_broadcast_jobs SET total_count = ? WHERE id = ?', (cursor.rowcount, job_id))
+        return job_id
+    
+    def get_broadcast_job(self, job_id: int) -> Optional[Dict[str, Any]]:
+        """Получение задания рассылки"""
+        cursor = self.conn.cursor()
+        cursor.execute('SELECT * FROM bot_broadcast_jobs WHERE id = ?', (job_id,))
+        row = cursor.fetchone()
+        if not row:
+            return None
+        job = dict(row)
+        job['payload'] = json.loads(job['payload'])
+        return job
+    
+    def get_unfinished_broadcast_jobs(self) -> List[int]:
+        """Задания, прерванные остановкой бота"""
+        cursor = self.conn.cursor()
+        cursor.execute("SELECT id FROM bot_broadcast_jobs WHERE status = 'running' ORDER BY id")
+        return [row['id'] for row in cursor.fetchall()]
+    
+    def get_pending_recipients(self, job_id: int, after_id: int = 0, limit: int = 100) -> List[int]:
+        """Очередная страница неотправленных получателей (курсор по telegram_id)"""
+        cursor = self.conn.cursor()
+        cursor.execute('''
+            SELECT telegram_id FROM bot_broadcast_recipients
+            WHERE job_id = ? AND status = 'pending' AND telegram_id > ?
+            ORDER BY telegram_id
+            LIMIT ?
+        ''', (job_id, after_id, limit))
+        return [row['telegram_id'] for row in cursor.fetchall()]
+    
+    def save_broadcast_results(self, job_id: int, results: List[tuple]):
+        """Запись результатов отправки: (telegram_id, status, attempts, error)"""
+        sent = sum(1 for _, status, _, _ in results if status == 'sent')
+        with self.transaction() as conn:
+            conn.executemany('''
+                UPDATE bot_broadcast_recipients
+                SET status = ?, attempts = ?, error = ?,
+                    sent_at = CASE WHEN ? = 'sent' THEN CURRENT_TIMESTAMP END
+                WHERE job_id = ? AND telegram_id = ?
+            ''', [(status, attempts, error, status, job_id, telegram_id)
+                  for telegram_id, status, attempts, error in results])
+            conn.execute('''
+                UPDATE bot_broadcast_jobs
+                SET sent_count = sent_count + ?, failed_count = failed_count + ?, updated_at = CURRENT_TIMESTAMP
+                WHERE id = ?
+            ''', (sent, len(results) - sent, job_id))
+    
+    def set_broadcast_status(self, job_id: int, status: str, progress_message_id: Optional[int] = None):
+        """Изменение статуса задания рассылки"""
+        with self.transaction() as conn:
+            conn.execute('''
+                UPDATE bot_broadcast_jobs
+                SET status = ?,
+                    progress_message_id = COALESCE(?, progress_message_id),
+                    updated_at = CURRENT_TIMESTAMP,
+                    finished_at = CASE WHEN ? IN ('done', 'cancelled') THEN CURRENT_TIMESTAMP END
+                WHERE id = ?
+            ''', (status, progress_message_id, status, job_id))
+    
     def close(self):
-        """Закрытие соединения с базой данных"""
-        if self.conn:
-            self.conn.close()
-            logger.info("Соединение с базой данных закрыто")
+        """Закрытие всех соединений с базой данных"""
+        # Сбрасываем отложенные записи до закрытия соединений
+        self.states.stop()
+        self.activity.stop()
+        self.action_log.stop()
+        if self.pool:
+            self.pool.close_all()
+            logger.info("Соединения с базой данных закрыты")
+
+# Конвейер обработки обновлений Telegram
+class UpdateDispatcher:
+    """Раздает обновления ограниченному пулу воркеров.
+    
+    У каждого воркера своя ограниченная очередь, воркер выбирается по chat_id:
+    обновления одного чата обрабатываются строго по порядку, разные чаты -
+    параллельно. Когда очередь заполнена, submit блокируется (backpressure)."""
+    
+    LATENCY_SAMPLES = 1000
+    
+    def __init__(self, bot: telebot.TeleBot, workers: int = 8, queue_size: int = 100):
+        self.bot = bot
+        self.queues = [queue.Queue(maxsize=queue_size) for _ in range(workers)]
+        self.threads: List[threading.Thread] = []
+        self._lock = threading.Lock()
+        self._latencies = deque(maxlen=self.LATENCY_SAMPLES)
+        self._processed = 0
+        self._failed = 0
+        self._latency_total = 0.0
+        self._latency_max = 0.0
+        self._wait_total = 0.0
+    
+    @staticmethod
+    def chat_key(update: types.Update) -> int:
+        """Ключ упорядочивания: чат (или пользователь) обновления"""
+        for message in (update.message, update.edited_message, update.channel_post):
+            if message is not None:
+                return message.chat.id
+        if update.callback_query is not None:
+            if update.callback_query.message is not None:
+                return update.callback_query.message.chat.id
+            return update.callback_query.from_user.id
+        for event in (update.inline_query, update.chosen_inline_result, update.pre_checkout_query,
+                      update.shipping_query, update.my_chat_member, update.chat_member):
+            if event is not None and getattr(event, 'from_user', None) is not None:
+                return event.from_user.id
+        return update.update_id
+    
+    def start(self):
+        for number, worker_queue in enumerate(self.queues):
+            thread = threading.Thread(target=self._worker, args=(worker_queue,),
+                                      name=f'update-worker-{number}', daemon=True)
+            thread.start()
+            self.threads.append(thread)
+        logger.info(f"Пул обработки обновлений запущен: воркеров={len(self.queues)}")
+    
+    def submit(self, update: types.Update, timeout: Optional[float] = None) -> bool:
+        """Постановка обновления в очередь; False, если очередь не освободилась за timeout"""
+        worker_queue = self.queues[self.chat_key(update) % len(self.queues)]
+        try:
+            worker_queue.put((update, time.monotonic()), timeout=timeout)
+            return True
+        except queue.Full:
+            return False
+    
+    def _worker(self, worker_queue: queue.Queue):
+        while True:
+            item = worker_queue.get()
+            if item is None:
+                worker_queue.task_done()
+                break
+            
+            update, enqueued_at = item
+            started = time.monotonic()
+            failed = False
+            try:
+                self.bot.process_new_updates([update])
+            except Exception as e:
+                failed = True
+                logger.error(f"Ошибка обработки обновления {update.update_id}: {e}")
+            finally:
+                finished = time.monotonic()
+                self._record(finished - started, started - enqueued_at, failed)
+                worker_queue.task_done()
+    
+    def _record(self, latency: float, wait: float, failed: bool):
+        with self._lock:
+            self._processed += 1
+            if failed:
+                self._failed += 1
+            self._latency_total += latency
+            self._latency_max = max(self._latency_max, latency)
+            self._wait_total += wait
+            self._latencies.append(latency)
+    
+    def metrics(self) -> Dict[str, Any]:
+        """Глубина очередей и задержки обработчиков"""
+        depths = [worker_queue.qsize() for worker_queue in self.queues]
+        with self._lock:
+            samples = sorted(self._latencies)
+            processed = self._processed
+            p95 = samples[int(len(samples) * 0.95) - 1] if samples else 0.0
+            return {
+                'workers': len(self.queues),
+                'queue_depth': sum(depths),
+                'queue_depth_max': max(depths) if depths else 0,
+                'processed': processed,
+                'failed': self._failed,
+                'latency_avg_ms': round(self._latency_total / processed * 1000, 2) if processed else 0.0,
+                'latency_p95_ms': round(p95 * 1000, 2),
+                'latency_max_ms': round(self._latency_max * 1000, 2),
+                'wait_avg_ms': round(self._wait_total / processed * 1000, 2) if processed else 0.0
+            }
+    
+    def stop(self, timeout: float = 10.0):
+        """Остановка воркеров после обработки уже поставленных обновлений"""
+        for worker_queue in self.queues:
+            worker_queue.put(None)
+        for thread in self.threads:
+            thread.join(timeout)
+        self.threads = []
+
+# Ограничитель скорости отправки
+class TokenBucket:
+    """Token bucket: не более rate операций в секунду с запасом capacity.
+    
+    pause() останавливает выдачу токенов всем потокам, например на время
+    retry_after из ответа 429."""
+    
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+    
+    def acquire(self):
+        """Ожидание свободного токена"""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    wait = self._paused_until - now
+                else:
+                    self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                    self._updated = now
+                    if self._tokens >= 1:
+                        self._tokens -= 1
+                        return
+                    wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+    
+    def pause(self, seconds: float):
+        """Приостановка выдачи токенов на seconds секунд"""
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+            self._tokens = 0
+            self._updated = self._paused_until
+
+# Рассылки
+class BroadcastEngine:
+    """Отправка рассылок по заданиям из базы бота.
+    
+    Получатели читаются страницами по курсору telegram_id и отправляются пулом
+    потоков через общий TokenBucket (глобальный лимит Telegram ~30 сообщений/с).
+    Результаты страницы записываются одной транзакцией, поэтому после
+    перезапуска задание продолжается с неотправленных получателей. На 429
+    весь пул ждет retry_after, прогресс администратору обновляется не чаще
+    раза в BROADCAST_PROGRESS_INTERVAL секунд."""
+    
+    MAX_ATTEMPTS = 5
+    TARGET_TEXTS = {'all': "всем пользователям", 'vip': "VIP пользователям"}
+    
+    def __init__(self, bot: telebot.TeleBot, db: BotDatabase, rate: float = Config.BROADCAST_RATE,
+                 workers: int = Config.BROADCAST_WORKERS):
+        self.bot = bot
+        self.db = db
+        self.workers = workers
+        self.bucket = TokenBucket(rate, capacity=max(1, rate / 5))
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='broadcast')
+        self._running = set()
+        self._lock = threading.Lock()
+    
+    def start_job(self, admin_id: int, payload: Dict[str, Any], target_type: str) -> Optional[int]:
+        """Создание задания и запуск отправки в фоне"""
+        job_id = self.db.create_broadcast_job(admin_id, target_type, payload)
+        if job_id is not None:
+            self._spawn(job_id)
+        return job_id
+    
+    def resume(self):
+        """Продолжение заданий, прерванных остановкой бота"""
+        for job_id in self.db.get_unfinished_broadcast_jobs():
+            logger.info(f"Продолжаю рассылку #{job_id}")
+            self._spawn(job_id)
+    
+    def cancel(self, job_id: int):
+        """Остановка задания: неотправленные получатели остаются в статусе pending"""
+        self.db.set_broadcast_status(job_id, 'cancelled')
+    
+    def _spawn(self, job_id: int):
+        with self._lock:
+            if job_id in self._running:
+                return
+            self._running.add(job_id)
+        threading.Thread(target=self._run, args=(job_id,), name=f'broadcast-job-{job_id}', daemon=True).start()
+    
+    def _run(self, job_id: int):
+        try:
+            job = self.db.get_broadcast_job(job_id)
+            if job is None:
+                return
+            
+            if job['total_count'] == 0:
+                # Получателей нет: вместо прогресса и итогового отчета - одно сообщение
+                self.db.set_broadcast_status(job_id, 'done')
+                self.bot.send_message(job['admin_id'], f"{Emoji.WARNING} Нет пользователей для рассылки.")
+                return
+            
+            progress_id = job['progress_message_id'] or self._send_progress(job)
+            if progress_id and not job['progress_message_id']:
+                self.db.set_broadcast_status(job_id, 'running', progress_id)
+            
+            last_report = time.monotonic()
+            after_id = 0
+            while True:
+                job = self.db.get_broadcast_job(job_id)
+                if job['status'] != 'running':
+                    break
+                
+                recipients = self.db.get_pending_recipients(job_id, after_id, limit=self.workers * 4)
+                if not recipients:
+                    self.db.set_broadcast_status(job_id, 'done')
+                    break
+                after_id = recipients[-1]
+                
+                results = list(self.executor.map(lambda telegram_id: self._deliver(telegram_id, job['payload']),
+                                                 recipients))
+                self.db.save_broadcast_results(job_id, results)
+                
+                if time.monotonic() - last_report >= Config.BROADCAST_PROGRESS_INTERVAL:
+                    self._update_progress(self.db.get_broadcast_job(job_id), progress_id)
+                    last_report = time.monotonic()
+            
+            self._finish(self.db.get_broadcast_job(job_id), progress_id)
+        except Exception as e:
+            logger.error(f"Ошибка выполнения рассылки #{job_id}: {e}")
+        finally:
+            with self._lock:
+                self._running.discard(job_id)
+    
+    def _deliver(self, telegram_id: int, payload: Dict[str, Any]) -> tuple:
+        """Отправка одному получателю: (telegram_id, status, attempts, error)"""
+        attempts = 0
+        while True:
+            attempts += 1
+            self.bucket.acquire()
+            try:
+                if payload['message_type'] == 'photo':
+                    self.bot.send_photo(telegram_id, payload['photo_id'], caption=payload['content'], parse_mode='HTML')
+                else:
+                    self.bot.send_message(telegram_id, payload['content'], parse_mode='HTML')
+                return telegram_id, 'sent', attempts, None
+            except telebot.apihelper.ApiTelegramException as e:
+                if e.error_code == 429 and attempts < self.MAX_ATTEMPTS:
+                    retry_after = (e.result_json or {}).get('parameters', {}).get('retry_after', 1)
+                    logger.warning(f"Рассылка: превышен лимит Telegram, пауза {retry_after} с")
+                    self.bucket.pause(retry_after)
+                    continue
+                # 403 - пользователь заблокировал бота, повтор бессмысленен
+                status = 'blocked' if e.error_code == 403 else 'failed'
+                return telegram_id, status, attempts, e.description
+            except Exception as e:
+                if attempts < self.MAX_ATTEMPTS:
+                    time.sleep(min(2 ** attempts, 30))
+                    continue
+                logger.error(f"Ошибка отправки рассылки пользователю {telegram_id}: {e}")
+                return telegram_id, 'failed', attempts, str(e)
+    
+    def _progress_text(self, job: Dict[str, Any]) -> str:
+        processed = job['sent_count'] + job['failed_count']
+        return (f"{Emoji.BROADCAST} <b>Рассылка в процессе...</b>\n\n"
+                f"Цель: {self.TARGET_TEXTS.get(job['target_type'], job['target_type'])}\n"
+                f"Количество пользователей: {job['total_count']}\n"
+                f"Отправлено: {processed}/{job['total_count']}\n"
+                f"Успешно: {job['sent_count']}\n"
+                f"Ошибок: {job['failed_count']}")
+    
+    def _progress_markup(self, job_id: int) -> types.InlineKeyboardMarkup:
+        markup = types.InlineKeyboardMarkup()
+        markup.add(types.InlineKeyboardButton(f"{Emoji.CANCEL} Остановить", callback_data=f"broadcast_stop_{job_id}"))
+        return markup
+    
+    def _send_progress(self, job: Dict[str, Any]) -> Optional[int]:
+        try:
+            message = self.bot.send_message(job['admin_id'], self._progress_text(job),
+                                            reply_markup=self._progress_markup(job['id']), parse_mode='HTML')
+            return message.message_id
+        except Exception as e:
+            logger.error(f"Ошибка отправки прогресса рассылки: {e}")
+            return None
+    
+    def _update_progress(self, job: Dict[str, Any], progress_id: Optional[int]):
+        if not progress_id:
+            return
+        try:
+            self.bot.edit_message_text(self._progress_text(job), job['admin_id'], progress_id,
+                                       reply_markup=self._progress_markup(job['id']), parse_mode='HTML')
+        except Exception:
+            pass
+    
+    def _finish(self, job: Dict[str, Any], progress_id: Optional[int]):
+        """Итоговый отчет администратору"""
+        total = job['total_count']
+        title = "РАССЫЛКА ЗАВЕРШЕНА!" if job['status'] == 'done' else "РАССЫЛКА ОСТАНОВЛЕНА"
+        try:
+            self.bot.send_message(
+                job['admin_id'],
+                f"{Emoji.CHECK} <b>{title}</b>\n\n"
+                f"Цель: {self.TARGET_TEXTS.get(job['target_type'], job['target_type'])}\n"
+                f"Всего пользователей: {total}\n"
+                f"Успешно отправлено: {job['sent_count']}\n"
+                f"Ошибок отправки: {job['failed_count']}\n"
+                f"Процент успеха: {job['sent_count'] / total * 100 if total else 0:.1f}%",
+                parse_mode='HTML'
+            )
+            if progress_id:
+                self.bot.delete_message(job['admin_id'], progress_id)
+        except Exception as e:
+            logger.error(f"Ошибка отправки отчета о рассылке: {e}")
+        
+        self.db.log_user_action(job['admin_id'], 'broadcast_sent', {
+            'job_id': job['id'],
+            'status': job['status'],
+            'target_type': job['target_type'],
+            'total_users': total,
+            'success_count': job['sent_count'],
+            'fail_count': job['failed_count']
+        })
 
 class VogueEliteBot:
-    def __init__(self):
+    def __init__(self, background_tasks: bool = True):
         # Проверяем токен бота
         if not Config.BOT_TOKEN:
             logger.error("Не указан токен бота!")
             raise ValueError("Токен бота не указан")
         
-        # Инициализация бота
-        self.bot = telebot.TeleBot(Config.BOT_TOKEN, parse_mode='HTML')
+        # Инициализация бота: обработчики вызываются воркерами конвейера
+        self.bot = telebot.TeleBot(Config.BOT_TOKEN, parse_mode='HTML', threaded=False)
+        self.dispatcher = UpdateDispatcher(self.bot, Config.UPDATE_WORKERS, Config.UPDATE_QUEUE_SIZE)
         self.db = BotDatabase()
+        self.broadcasts = BroadcastEngine(self.bot, self.db)
+        self.media_bucket = TokenBucket(1)
+        self._media_failures = set()
         self.web_app_url = Config.WEB_APP_URL
         
         # Интервалы для фоновых задач
@@ -1563,7 +2614,8 @@ class VogueEliteBot:
         self.setup_handlers()
         
         # Запуск фоновых задач
-        self.start_background_tasks()
+        if background_tasks:
+            self.start_background_tasks()
         
         logger.info("Бот VOGUE ÉLITE успешно инициализирован")
     
@@ -1583,10 +2635,61 @@ class VogueEliteBot:
         
     def run(self):
         try:
+            if Config.BOT_MODE == 'webhook':
+                # Обновления и фоновые задачи обслуживает веб-приложение, здесь только регистрация webhook
+                self.register_webhook()
+                logger.info("Режим webhook: процесс завершается, обновления принимает веб-приложение")
+                return
+            
             logger.info("Запускаю бота...")
-            self.bot.polling(none_stop=True, interval=0, timeout=20)
+            self.dispatcher.start()
+            self.poll_updates()
         except Exception as e:
             logger.error(f"Ошибка в работе бота: {e}")
+        finally:
+            self.dispatcher.stop()
+            self.db.close()
+    
+    def register_webhook(self):
+        """Регистрация webhook в Telegram с секретным токеном"""
+        if not Config.WEBHOOK_SECRET:
+            raise ValueError("Для режима webhook необходимо задать WEBHOOK_SECRET")
+        
+        url = f"{Config.WEBHOOK_URL.rstrip('/')}{Config.WEBHOOK_PATH}"
+        self.bot.set_webhook(url=url, secret_token=Config.WEBHOOK_SECRET)
+        logger.info(f"Webhook зарегистрирован: {url}")
+    
+    def start_webhook(self):
+        """Запуск конвейера для приема обновлений через webhook"""
+        self.dispatcher.start()
+        logger.info("Бот принимает обновления через webhook")
+    
+    def handle_webhook_update(self, payload: Dict[str, Any], timeout: float = 5.0) -> bool:
+        """Постановка обновления из webhook в конвейер; False - очередь переполнена"""
+        update = types.Update.de_json(payload)
+        return self.dispatcher.submit(update, timeout=timeout)
+    
+    def poll_updates(self):
+        """Long polling: обновления передаются в конвейер обработки"""
+        try:
+            # getUpdates не работает, пока зарегистрирован webhook
+            self.bot.remove_webhook()
+        except Exception as e:
+            logger.error(f"Ошибка удаления webhook: {e}")
+        
+        offset = None
+        while True:
+            try:
+                updates = self.bot.get_updates(offset=offset, timeout=20, long_polling_timeout=20)
+            except Exception as e:
+                logger.error(f"Ошибка получения обновлений: {e}")
+                time.sleep(3)
+                continue
+            
+            for update in updates:
+                offset = update.update_id + 1
+                # Блокируется, пока очередь чата заполнена
+                self.dispatcher.submit(update)
     
     def start_background_tasks(self):
         """Запуск фоновых задач"""
@@ -1594,6 +2697,8 @@ class VogueEliteBot:
             while True:
                 try:
                     self.db.sync_with_webapp()
+                    # Новые изображения загружаются в Telegram до первого показа
+                    self.warm_media_cache()
                 except Exception as e:
                     logger.error(f"Ошибка в задаче синхронизации: {e}")
                 time.sleep(self.sync_interval)
@@ -1606,12 +2711,137 @@ class VogueEliteBot:
                     logger.error(f"Ошибка в задаче очистки: {e}")
                 time.sleep(self.cleanup_interval)
         
+        def recommender_task():
+            while True:
+                try:
+                    self.db.refresh_product_neighbors()
+                except Exception as e:
+                    logger.error(f"Ошибка в задаче рекомендаций: {e}")
+                time.sleep(Config.RECOMMENDER_INTERVAL)
+        
+        def metrics_task():
+            while True:
+                time.sleep(Config.METRICS_INTERVAL)
+                metrics = self.dispatcher.metrics()
+                if metrics['processed'] or metrics['queue_depth']:
+                    logger.info(f"Конвейер обновлений: {metrics}")
+                activity = self.db.activity.stats()
+                if activity['touches']:
+                    logger.info(f"Буфер активности: {activity}")
+                action_log = self.db.action_log.stats()
+                if action_log['queued'] or action_log['dropped']:
+                    logger.info(f"Журнал действий: {action_log}")
+        
         # Запускаем задачи в отдельных потоках
         threading.Thread(target=sync_task, daemon=True).start()
         threading.Thread(target=cleanup_task, daemon=True).start()
+        threading.Thread(target=recommender_task, daemon=True).start()
+        threading.Thread(target=metrics_task, daemon=True).start()
+        
+        # Продолжаем рассылки, прерванные перезапуском
+        self.broadcasts.resume()
         
         logger.info("Фоновые задачи запущены")
     
+    # ==================== ИЗОБРАЖЕНИЯ ТОВАРОВ ====================
+    
+    def photo_url(self, image_url: str) -> str:
+        """Абсолютный URL изображения на сайте"""
+        if image_url.startswith(('http://', 'https://')):
+            return image_url
+        return f"{self.web_app_url.rstrip('/')}/{image_url.lstrip('/')}"
+    
+    def _remember_photo(self, image_url: str, message, content_hash: Optional[str] = None):
+        """Сохранение file_id из отправленного сообщения с фото"""
+        photo = getattr(message, 'photo', None)
+        if photo:
+            self.db.save_media_file_id(image_url, photo[-1].file_id, photo[-1].file_unique_id, content_hash)
+    
+    @staticmethod
+    def _is_media_error(error: Exception) -> bool:
+        """Telegram не принял file_id или не смог загрузить изображение"""
+        return (isinstance(error, telebot.apihelper.ApiTelegramException) and error.error_code == 400
+                and 'file' in (error.description or '').lower())
+    
+    def send_product_photo(self, chat_id: int, image_url: str, **kwargs):
+        """Отправка фото товара: по file_id из кэша, иначе по URL с сохранением file_id"""
+        file_id = self.db.get_media_file_id(image_url)
+        if file_id:
+            try:
+                return self.bot.send_photo(chat_id, file_id, **kwargs)
+            except Exception as e:
+                if not self._is_media_error(e):
+                    raise
+                self.db.invalidate_media(image_url)
+        
+        message = self.bot.send_photo(chat_id, self.photo_url(image_url), **kwargs)
+        self._remember_photo(image_url, message)
+        return message
+    
+    def edit_product_photo(self, image_url: str, caption: str, chat_id: int, message_id: int, reply_markup=None):
+        """Замена фото в сообщении: по file_id из кэша, иначе по URL с сохранением file_id"""
+        file_id = self.db.get_media_file_id(image_url)
+        if file_id:
+            try:
+                return self.bot.edit_message_media(
+                    types.InputMediaPhoto(file_id, caption=caption, parse_mode='HTML'),
+                    chat_id, message_id, reply_markup=reply_markup
+                )
+            except Exception as e:
+                if not self._is_media_error(e):
+                    raise
+                self.db.invalidate_media(image_url)
+        
+        message = self.bot.edit_message_media(
+            types.InputMediaPhoto(self.photo_url(image_url), caption=caption, parse_mode='HTML'),
+            chat_id, message_id, reply_markup=reply_markup
+        )
+        self._remember_photo(image_url, message)
+        return message
+    
+    def warm_media_cache(self) -> int:
+        """Предварительная загрузка новых и измененных изображений товаров в Telegram.
+        
+        Изображение скачивается с сайта и загружается файлом в служебный чат,
+        полученный file_id сохраняется вместе с хэшем содержимого. Если хэш
+        не изменился, повторная загрузка не выполняется."""
+        chat_id = Config.MEDIA_WARMUP_CHAT_ID
+        if not chat_id:
+            return 0
+        
+        warmed = 0
+        entries = self.db.get_media_to_warm(Config.MEDIA_WARMUP_BATCH + len(self._media_failures))
+        for entry in entries:
+            image_url = entry['image_url']
+            if image_url in self._media_failures:
+                continue
+            try:
+                response = requests.get(self.photo_url(image_url), timeout=30)
+                response.raise_for_status()
+                content_hash = hashlib.sha256(response.content).hexdigest()
+                
+                if entry['cached'] and entry['content_hash'] == content_hash:
+                    self.db.touch_media(image_url)
+                    continue
+                
+                # Не более одного сообщения в секунду в один чат
+                self.media_bucket.acquire()
+                message = self.bot.send_photo(chat_id, response.content, disable_notification=True)
+                self._remember_photo(image_url, message, content_hash)
+                try:
+                    self.bot.delete_message(chat_id, message.message_id)
+                except Exception:
+                    pass
+                warmed += 1
+            except Exception as e:
+                # Повторная попытка - после перезапуска бота
+                self._media_failures.add(image_url)
+                logger.error(f"Ошибка предварительной загрузки изображения {image_url}: {e}")
+        
+        if warmed:
+            logger.info(f"Предварительно загружено изображений: {warmed}")
+        return warmed
+    
     def setup_handlers(self):
         """Настройка обработчиков команд и сообщений"""
         # Обработчик команды /start
@@ -1672,7 +2902,6 @@ class VogueEliteBot:
                     
                     # Если это новый пользователь, отправляем дополнительные инструкции
                     if user_data.get('is_new'):
-                        time.sleep(1)
                         self.bot.send_message(
                             message.chat.id,
                             f"{Emoji.INFO} <b>Быстрый старт:</b>\n\n"
@@ -1973,7 +3202,11 @@ class VogueEliteBot:
                 if len(parts) >= 3:
                     category = parts[1]
                     page = int(parts[2])
-                    self.show_category_products(call, category, page)
+                    # page_{категория}_{страница}_{a|b}{id}: курсор после/перед товаром
+                    anchor = parts[3] if len(parts) > 3 else ''
+                    after_id = int(anchor[1:]) if anchor.startswith('a') else None
+                    before_id = int(anchor[1:]) if anchor.startswith('b') else None
+                    self.show_category_products(call, category, page, after_id, before_id)
 
             # Обработка добавления товаров
             elif callback_data.startswith("add_to_cart_"):
@@ -2050,6 +3283,9 @@ class VogueEliteBot:
                     self.send_broadcast_to_users(call.from_user.id, {}, 'all')
                 elif callback_data == "broadcast_send_vip":
                     self.send_broadcast_to_users(call.from_user.id, {}, 'vip')
+                elif callback_data.startswith("broadcast_stop_"):
+                    if call.from_user.id in Config.ADMIN_IDS:
+                        self.broadcasts.cancel(int(callback_data[15:]))
                 elif callback_data == "broadcast_cancel":
                     self.db.clear_user_state(call.from_user.id)
                     self.bot.edit_message_text(
@@ -2253,24 +3489,23 @@ class VogueEliteBot:
         }
         return emoji_map.get(category, Emoji.TAG)
     
-    def show_category_products(self, call, category, page=1):
+    def show_category_products(self, call, category, page=1, after_id=None, before_id=None):
         """Показать товары выбранной категории"""
         try:
             products_per_page = 6
-            offset = (page - 1) * products_per_page
-            
-            # Получаем товары из базы данных
-            if category == 'all':
-                products = self.db.get_products(
-                    limit=products_per_page,
-                    offset=offset
-                )
-            else:
-                products = self.db.get_products(
-                    category=category,
-                    limit=products_per_page,
-                    offset=offset
-                )
+            # Старые кнопки без курсора листаются по offset
+            offset = 0 if after_id or before_id else (page - 1) * products_per_page
+            
+            # Получаем товары из базы данных (на один больше - признак следующей страницы)
+            products = self.db.get_products(
+                category=category,
+                limit=products_per_page + 1,
+                offset=offset,
+                after_id=after_id,
+                before_id=before_id
+            )
+            has_more = len(products) > products_per_page
+            products = products[:products_per_page]
             
             if not products:
                 markup = types.InlineKeyboardMarkup()
@@ -2323,12 +3558,9 @@ class VogueEliteBot:
                         if i == 0:
                             # Для первого товара редактируем существующее сообщение
                             try:
-                                self.bot.edit_message_media(
-                                    types.InputMediaPhoto(
-                                        product['image_url'],
-                                        caption=product_text,
-                                        parse_mode='HTML'
-                                    ),
+                                self.edit_product_photo(
+                                    product['image_url'],
+                                    product_text,
                                     call.message.chat.id,
                                     call.message.message_id,
                                     reply_markup=markup
@@ -2337,7 +3569,7 @@ class VogueEliteBot:
                             except:
                                 pass
                         
-                        self.bot.send_photo(
+                        self.send_product_photo(
                             call.message.chat.id,
                             product['image_url'],
                             caption=product_text,
@@ -2369,21 +3601,19 @@ class VogueEliteBot:
                         parse_mode='HTML'
                     )
             
-            # Создаем пагинацию
-            total_count = len(products)
-            if total_count == products_per_page:
-                # Если показали полную страницу, возможно есть еще
+            # Создаем пагинацию: курсоры - id первого и последнего товара страницы
+            if has_more:
                 markup = types.InlineKeyboardMarkup(row_width=2)
                 
                 if page > 1:
                     markup.add(types.InlineKeyboardButton(
                         f"{Emoji.BACK} Назад",
-                        callback_data=f"page_{category}_{page-1}"
+                        callback_data=f"page_{category}_{page-1}_b{products[0]['id']}"
                     ))
                 
                 markup.add(types.InlineKeyboardButton(
                     f"{Emoji.NEXT} Еще товары",
-                    callback_data=f"page_{category}_{page+1}"
+                    callback_data=f"page_{category}_{page+1}_a{products[-1]['id']}"
                 ))
                 
                 self.bot.send_message(
@@ -2496,6 +3726,14 @@ class VogueEliteBot:
                 )
             )
             
+            # Рекомендации из таблицы соседей
+            for similar in self.db.get_product_neighbors(product_id, 3):
+                name = similar['name'] if len(similar['name']) <= 40 else similar['name'][:37] + '...'
+                markup.add(types.InlineKeyboardButton(
+                    f"{Emoji.STAR} {name}",
+                    callback_data=f"product_{similar['id']}"
+                ))
+            
             # Кнопка назад
             markup.add(types.InlineKeyboardButton(
                 f"{Emoji.BACK} Назад в каталог",
@@ -2505,12 +3743,9 @@ class VogueEliteBot:
             # Отправляем фото, если есть
             if product.get('image_url'):
                 try:
-                    self.bot.edit_message_media(
-                        types.InputMediaPhoto(
-                            product['image_url'],
-                            caption=product_text,
-                            parse_mode='HTML'
-                        ),
+                    self.edit_product_photo(
+                        product['image_url'],
+                        product_text,
                         call.message.chat.id,
                         call.message.message_id,
                         reply_markup=markup
@@ -3008,7 +4243,7 @@ class VogueEliteBot:
                 
                 if item.get('image_url'):
                     try:
-                        self.bot.send_photo(
+                        self.send_product_photo(
                             message.chat.id,
                             item['image_url'],
                             caption=item_text,
@@ -4096,7 +5331,7 @@ class VogueEliteBot:
                 
                 try:
                     if product.get('image_url'):
-                        self.bot.send_photo(
+                        self.send_product_photo(
                             message.chat.id,
                             product['image_url'],
                             caption=product_text,
@@ -4647,7 +5882,7 @@ class VogueEliteBot:
                 
                 try:
                     if product.get('image_url'):
-                        self.bot.send_photo(
+                        self.send_product_photo(
                             message.chat.id,
                             product['image_url'],
                             caption=product_text,
@@ -5536,115 +6771,28 @@ class VogueEliteBot:
             )
     
     def send_broadcast_to_users(self, admin_id, broadcast_data, target_type):
-        """Отправка рассылки пользователям"""
+        """Запуск рассылки пользователям: отправка выполняется в фоне заданием рассылки"""
         try:
-            # Получаем пользователей в зависимости от цели
-            if target_type == 'all':
-                users = self.db.get_all_users()
-                target_text = "всем пользователям"
-            elif target_type == 'vip':
-                users = self.db.get_vip_users()
-                target_text = "VIP пользователям"
-            else:
-                return
+            if not broadcast_data:
+                # Кнопки выбора аудитории не передают данные - берем их из состояния
+                state = self.db.get_user_state(admin_id)
+                broadcast_data = ((state or {}).get('data') or {}).get('broadcast_data')
             
-            total_users = len(users)
-            if total_users == 0:
+            if not broadcast_data:
                 self.bot.send_message(
                     admin_id,
-                    f"{Emoji.WARNING} Нет пользователей для рассылки."
+                    f"{Emoji.WARNING} Сообщение для рассылки не найдено. Создайте рассылку заново."
                 )
                 return
             
-            # Отправляем сообщение администратору о начале рассылки
-            progress_msg = self.bot.send_message(
-                admin_id,
-                f"{Emoji.BROADCAST} <b>Начинаю рассылку...</b>\n\n"
-                f"Цель: {target_text}\n"
-                f"Количество пользователей: {total_users}\n"
-                f"Отправлено: 0/{total_users}",
-                parse_mode='HTML'
-            )
-            
-            # Отправляем рассылку
-            success_count = 0
-            fail_count = 0
-            
-            for i, user in enumerate(users, 1):
-                try:
-                    telegram_id = user['telegram_id']
-                    
-                    if broadcast_data['message_type'] == 'photo':
-                        # Отправляем фото с подписью
-                        self.bot.send_photo(
-                            telegram_id,
-                            broadcast_data['photo_id'],
-                            caption=broadcast_data['content'],
-                            parse_mode='HTML'
-                        )
-                    else:
-                        # Отправляем текст
-                        self.bot.send_message(
-                            telegram_id,
-                            broadcast_data['content'],
-                            parse_mode='HTML'
-                        )
-                    
-                    success_count += 1
-                    
-                    # Обновляем прогресс каждые 10 пользователей
-                    if i % 10 == 0 or i == total_users:
-                        try:
-                            self.bot.edit_message_text(
-                                f"{Emoji.BROADCAST} <b>Рассылка в процессе...</b>\n\n"
-                                f"Цель: {target_text}\n"
-                                f"Количество пользователей: {total_users}\n"
-                                f"Отправлено: {i}/{total_users}\n"
-                                f"Успешно: {success_count}\n"
-                                f"Ошибок: {fail_count}",
-                                admin_id,
-                                progress_msg.message_id,
-                                parse_mode='HTML'
-                            )
-                        except:
-                            pass
-                    
-                    # Небольшая задержка, чтобы не превысить лимиты Telegram
-                    time.sleep(0.1)
-                    
-                except Exception as e:
-                    fail_count += 1
-                    logger.error(f"Ошибка отправки рассылки пользователю {user.get('telegram_id')}: {e}")
-            
-            # Отправляем итоговый отчет
-            self.bot.send_message(
-                admin_id,
-                f"{Emoji.CHECK} <b>РАССЫЛКА ЗАВЕРШЕНА!</b>\n\n"
-                f"Цель: {target_text}\n"
-                f"Всего пользователей: {total_users}\n"
-                f"Успешно отправлено: {success_count}\n"
-                f"Ошибок отправки: {fail_count}\n"
-                f"Процент успеха: {success_count/total_users*100:.1f}%",
-                parse_mode='HTML'
-            )
-            
-            # Удаляем сообщение о прогрессе
-            try:
-                self.bot.delete_message(admin_id, progress_msg.message_id)
-            except:
-                pass
+            # Прогресс и итоги (в том числе пустую аудиторию) сообщает задание рассылки
+            job_id = self.broadcasts.start_job(admin_id, broadcast_data, target_type)
+            if job_id is None:
+                return
             
             # Очищаем состояние пользователя
             self.db.clear_user_state(admin_id)
             
-            # Логируем действие
-            self.db.log_user_action(admin_id, 'broadcast_sent', {
-                'target_type': target_type,
-                'total_users': total_users,
-                'success_count': success_count,
-                'fail_count': fail_count
-            })
-            
         except Exception as e:
             logger.error(f"Ошибка отправки рассылки: {e}")
             self.bot.send_message(
@@ -5655,7 +6803,8 @@ class VogueEliteBot:
 # Запуск бота
 if __name__ == "__main__":
     try:
-        bot = VogueEliteBot()
+        # В режиме webhook фоновые задачи запускает процесс веб-приложения (get_webhook_bot)
+        bot = VogueEliteBot(background_tasks=Config.BOT_MODE != 'webhook')
         logger.info("Бот успешно запущен!")
         bot.run()
     except Exception as e:
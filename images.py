@@ -0,0 +1,211 @@
+# images.py - Производные изображения товаров (Pillow) с кэшем на диске
+import base64
+import hashlib
+import io
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+# Размеры производных: наибольшая ширина в пикселях
+VARIANTS = {
+    'thumb': 160,   # Корзина, оформление заказа, миниатюры галереи
+    'card': 480,    # Карточки каталога, подборки, поиск
+    'zoom': 1200,   # Страница товара и увеличение
+}
+
+# Формат в URL -> (формат Pillow, MIME-тип, параметры сохранения)
+FORMATS = {
+    'webp': ('WEBP', 'image/webp', {'quality': 80, 'method': 4}),
+    'jpg': ('JPEG', 'image/jpeg', {'quality': 82, 'optimize': True, 'progressive': True}),
+}
+
+# Размытая заглушка, встраиваемая в страницу до загрузки изображения
+PLACEHOLDER_WIDTH = 24
+PLACEHOLDER_BLUR = 2
+
+SOURCE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.webp')
+
+
+def _open_rgb(source, size_hint=None):
+    from PIL import Image, ImageOps
+
+    image = Image.open(source)
+    if size_hint and image.format == 'JPEG':
+        # Декодирование JPEG сразу в уменьшенном масштабе
+        image.draft('RGB', size_hint)
+    image = ImageOps.exif_transpose(image)
+    if image.mode not in ('RGB', 'L'):
+        background = Image.new('RGB', image.size, (255, 255, 255))
+        if 'A' in image.getbands():
+            background.paste(image, mask=image.getchannel('A'))
+        else:
+            background.paste(image.convert('RGB'))
+        image = background
+    return image.convert('RGB')
+
+
+def _write_atomic(path, data):
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+def render_placeholder(image):
+    """Размытая миниатюра декодированного изображения в виде data URI"""
+    from PIL import ImageFilter
+
+    image = image.copy()
+    image.thumbnail((PLACEHOLDER_WIDTH, PLACEHOLDER_WIDTH * 4))
+    image = image.filter(ImageFilter.GaussianBlur(PLACEHOLDER_BLUR))
+    buffer = io.BytesIO()
+    image.save(buffer, 'JPEG', quality=50)
+    return 'data:image/jpeg;base64,' + base64.b64encode(buffer.getvalue()).decode('ascii')
+
+
+def render_derivatives(source, target_prefix):
+    """Создание всех размеров и форматов и размытой заглушки за одно
+    декодирование исходника.
+
+    Выполняется в отдельном процессе; файлы называются
+    {target_prefix}-{размер}.{формат} и {target_prefix}-placeholder.txt."""
+    image = _open_rgb(source)
+    _write_atomic(f'{target_prefix}-placeholder.txt', render_placeholder(image).encode('ascii'))
+    for variant, width in VARIANTS.items():
+        resized = image.copy()
+        if resized.width > width:
+            resized.thumbnail((width, width * 4))
+        for extension, (pil_format, _, options) in FORMATS.items():
+            buffer = io.BytesIO()
+            resized.save(buffer, pil_format, **options)
+            _write_atomic(f'{target_prefix}-{variant}.{extension}', buffer.getvalue())
+    return target_prefix
+
+
+class ImagePipeline:
+    """Производные изображений из static/ с адресацией по хэшу содержимого.
+
+    URL производной содержит хэш исходного файла, поэтому ответы можно
+    кэшировать навсегда. Производные и заглушка создаются пулом процессов при
+    загрузке (process_upload) или при первом запросе и хранятся в cache_dir;
+    поток запроса изображения не декодирует."""
+
+    def __init__(self, static_root, cache_dir, workers=2):
+        self.static_root = os.path.abspath(static_root)
+        self.cache_dir = cache_dir
+        self.workers = workers
+        self._executor = None
+        self._lock = threading.Lock()
+        self._hashes = {}
+        self._placeholders = {}
+        self._pending = {}
+        self._failed = set()
+
+    def source_path(self, image_url):
+        """Путь к исходнику в static/ или None для внешних и отсутствующих файлов"""
+        if not image_url or not image_url.startswith('/static/'):
+            return None
+        relative = image_url[len('/static/'):].split('?', 1)[0]
+        path = os.path.abspath(os.path.join(self.static_root, relative))
+        if not path.startswith(self.static_root + os.sep) or not path.lower().endswith(SOURCE_EXTENSIONS):
+            return None
+        return path if os.path.isfile(path) else None
+
+    def content_hash(self, path):
+        """Хэш содержимого (пересчитывается только при изменении файла)"""
+        stat = os.stat(path)
+        key = (stat.st_mtime_ns, stat.st_size)
+        cached = self._hashes.get(path)
+        if cached and cached[0] == key:
+            return cached[1]
+        with open(path, 'rb') as f:
+            digest = hashlib.sha256(f.read()).hexdigest()[:16]
+        self._hashes[path] = (key, digest)
+        return digest
+
+    def _prefix(self, digest):
+        directory = os.path.join(self.cache_dir, digest[:2])
+        os.makedirs(directory, exist_ok=True)
+        return os.path.join(directory, digest)
+
+    def _submit(self, path, digest):
+        """Постановка создания производных в пул (одна задача на хэш)"""
+        with self._lock:
+            future = self._pending.get(digest)
+            if future is None:
+                if self._executor is None:
+                    self._executor = ProcessPoolExecutor(max_workers=self.workers)
+                future = self._executor.submit(render_derivatives, path, self._prefix(digest))
+                future.add_done_callback(lambda done: self._finish(digest, done))
+                self._pending[digest] = future
+            return future
+
+    def _finish(self, digest, future):
+        with self._lock:
+            self._pending.pop(digest, None)
+            if future.exception() is not None:
+                # Файл не является изображением: повторно не обрабатывается
+                self._failed.add(digest)
+
+    def process_upload(self, path):
+        """Фоновое создание производных для только что загруженного файла"""
+        return self._submit(path, self.content_hash(path))
+
+    def version(self, image_url):
+        """Текущий хэш исходника для URL производных или None"""
+        path = self.source_path(image_url)
+        return self.content_hash(path) if path is not None else None
+
+    def derivative(self, image_url, variant, extension, timeout=30):
+        """Путь к готовой производной (создается при первом запросе) или None"""
+        path = self.source_path(image_url)
+        if path is None or variant not in VARIANTS or extension not in FORMATS:
+            return None
+        digest = self.content_hash(path)
+        target = f'{self._prefix(digest)}-{variant}.{extension}'
+        if not os.path.exists(target):
+            self._submit(path, digest).result(timeout)
+        return target
+
+    def placeholder(self, path, digest):
+        """Размытая заглушка или None, пока пул процессов ее не создал"""
+        cached = self._placeholders.get(digest)
+        if cached is not None:
+            return cached
+        try:
+            with open(f'{self._prefix(digest)}-placeholder.txt', encoding='ascii') as f:
+                value = f.read()
+        except FileNotFoundError:
+            self._submit(path, digest)
+            return None
+        self._placeholders[digest] = value
+        return value
+
+    def cache_key(self, image_url):
+        """Версия результата variants: хэш исходника и готовность заглушки"""
+        path = self.source_path(image_url)
+        if path is None:
+            return None
+        digest = self.content_hash(path)
+        return digest, digest in self._failed or self.placeholder(path, digest) is not None
+
+    def variants(self, image_url):
+        """URL производных всех размеров и форматов и размытая заглушка
+        (None, пока она создается в пуле процессов).
+
+        Для внешних, отсутствующих и некорректных изображений возвращает None."""
+        path = self.source_path(image_url)
+        if path is None:
+            return None
+        digest = self.content_hash(path)
+        if digest in self._failed:
+            return None
+        placeholder = self.placeholder(path, digest)
+
+        relative = image_url[len('/static/'):].split('?', 1)[0]
+        result = {
+            variant: {extension: f'/img/{variant}/{digest}/{relative}.{extension}' for extension in FORMATS}
+            for variant in VARIANTS
+        }
+        result['placeholder'] = placeholder
+        return result
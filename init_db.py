@@ -1,9 +1,9 @@
 # init_db.py
-from app import app, db
+from app import app, db, upgrade_schema
 
 with app.app_context():
     print("Создание таблиц базы данных...")
-    db.create_all()
+    upgrade_schema()
     print("Таблицы успешно созданы!")
     
     # Проверим, что таблицы созданы
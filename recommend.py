@@ -0,0 +1,37 @@
+# recommend.py - Пересчет рекомендаций товаров отдельным процессом
+"""
+Таблица product_neighbors пересчитывается одним заданием, а не потоком в
+каждом воркере веб-приложения.
+
+Запуск из корня проекта:
+    python recommend.py            # однократный пересчет (cron, деплой)
+    python recommend.py --loop     # пересчет каждые RECOMMENDER_INTERVAL секунд
+    python recommend.py --force    # пересчет без проверки отпечатка данных
+"""
+import argparse
+import time
+
+from app import app, logger, refresh_product_neighbors
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Пересчет рекомендаций товаров')
+    parser.add_argument('--loop', action='store_true', help='Пересчитывать периодически')
+    parser.add_argument('--force', action='store_true', help='Пересчитать, даже если данные не менялись')
+    args = parser.parse_args()
+
+    interval = app.config['RECOMMENDER_INTERVAL'] or 3600
+    while True:
+        try:
+            written = refresh_product_neighbors(force=args.force)
+            if written is None:
+                logger.info("Рекомендации актуальны, пересчет не нужен")
+        except Exception as e:
+            logger.error(f"Ошибка пересчета рекомендаций: {e}")
+        if not args.loop:
+            break
+        time.sleep(interval)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+# recommender.py - Рекомендации товаров по совместной встречаемости (item-item)
+import heapq
+import itertools
+import json
+import math
+from collections import defaultdict
+
+try:
+    import numpy as np
+except ImportError:
+    # Без NumPy матрица встречаемости считается словарями на чистом Python
+    np = None
+
+DEFAULT_TOP_K = 10
+
+# Вес сигнала: покупка важнее добавления в корзину, просмотр - слабее всего
+ORDER_WEIGHT = 3.0
+CART_WEIGHT = 1.0
+FAVORITE_WEIGHT = 1.0
+VIEW_WEIGHT = 0.5
+
+# Длинные истории обрезаются: число пар растет квадратично
+MAX_BASKET_ITEMS = 50
+
+
+def order_basket(items_json):
+    """id товаров заказа из items_json"""
+    try:
+        items = json.loads(items_json or '[]')
+    except (TypeError, ValueError):
+        return []
+    return [item['product_id'] for item in items if isinstance(item, dict) and item.get('product_id')]
+
+
+def group_baskets(rows, weight):
+    """Корзины из строк (владелец, id товара), отсортированных по владельцу"""
+    for _, group in itertools.groupby(rows, key=lambda row: row[0]):
+        ids = [row[1] for row in group]
+        yield weight, ids[-MAX_BASKET_ITEMS:]
+
+
+def build_neighbors(baskets, top_k=DEFAULT_TOP_K):
+    """Top-K соседей каждого товара по нормированной совместной встречаемости.
+
+    baskets - пары (вес, id товаров): заказ, корзина, история просмотров.
+    Оценка пары - косинус: суммарный вес корзин с обоими товарами, деленный
+    на sqrt(вес корзин с первым * вес корзин со вторым), поэтому популярные
+    товары не становятся соседями всех подряд.
+    Возвращает {id: [(id соседа, оценка), ...]} по убыванию оценки."""
+    baskets = [(float(weight), sorted(set(ids))) for weight, ids in baskets if weight > 0 and ids]
+    items = sorted({item for _, ids in baskets for item in ids})
+    if len(items) < 2 or top_k < 1:
+        return {}
+    if np is not None:
+        return _build_numpy(baskets, items, top_k)
+    return _build_python(baskets, top_k)
+
+
+def _build_numpy(baskets, items, top_k):
+    """Разреженная матрица корзина x товар (CSR) и обратный индекс товар -> корзины.
+
+    Строка соседей товара собирается из корзин, где он встречается, поэтому
+    память пропорциональна числу позиций в корзинах, а не корзин x товаров."""
+    index = {item: position for position, item in enumerate(items)}
+    sizes = np.array([len(ids) for _, ids in baskets], dtype=np.int64)
+    indptr = np.zeros(len(baskets) + 1, dtype=np.int64)
+    np.cumsum(sizes, out=indptr[1:])
+    indices = np.fromiter((index[item] for _, ids in baskets for item in ids), dtype=np.int64, count=int(indptr[-1]))
+    weights = np.array([weight for weight, _ in baskets], dtype=np.float64)
+
+    # Обратный индекс (CSC): корзины каждого товара
+    entry_baskets = np.repeat(np.arange(len(baskets)), sizes)
+    item_baskets = entry_baskets[np.argsort(indices, kind='stable')]
+    item_ptr = np.zeros(len(items) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(indices, minlength=len(items)), out=item_ptr[1:])
+    degree = np.bincount(indices, weights=weights[entry_baskets], minlength=len(items))
+
+    neighbors = {}
+    for item in range(len(items)):
+        rows = item_baskets[item_ptr[item]:item_ptr[item + 1]]
+        starts, lengths = indptr[rows], sizes[rows]
+        # Позиции всех товаров этих корзин в indices
+        positions = np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+        others = indices[positions]
+        values = np.repeat(weights[rows], lengths)
+        mask = others != item
+        if not mask.any():
+            continue
+        others, inverse = np.unique(others[mask], return_inverse=True)
+        scores = np.bincount(inverse, weights=values[mask]) / np.sqrt(degree[item] * degree[others])
+        # По убыванию оценки, при равенстве - по возрастанию id
+        top = np.lexsort((others, -scores))[:top_k]
+        neighbors[items[item]] = [(items[others[column]], round(float(scores[column]), 6)) for column in top]
+    return neighbors
+
+
+def _build_python(baskets, top_k):
+    degree = defaultdict(float)
+    pairs = defaultdict(lambda: defaultdict(float))
+    for weight, ids in baskets:
+        for item in ids:
+            degree[item] += weight
+        for first, second in itertools.permutations(ids, 2):
+            pairs[first][second] += weight
+
+    neighbors = {}
+    for item, row in pairs.items():
+        scored = ((other, count / math.sqrt(degree[item] * degree[other])) for other, count in row.items())
+        top = heapq.nlargest(top_k, scored, key=lambda pair: (pair[1], -pair[0]))
+        neighbors[item] = [(other, round(score, 6)) for other, score in top]
+    return neighbors
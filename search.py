@@ -0,0 +1,390 @@
+# search.py - Полнотекстовый поиск товаров на SQLite FTS5
+import re
+import sqlite3
+import threading
+
+# Индексируемые колонки и веса bm25 (в том же порядке): совпадение в названии,
+# артикуле и бренде важнее совпадения в описании
+FTS_COLUMNS = ('name', 'brand', 'category', 'article', 'description')
+BM25_WEIGHTS = (10.0, 6.0, 4.0, 8.0, 1.0)
+
+# unicode61 корректно приводит к нижнему регистру кириллицу и латиницу,
+# префиксные индексы ускоряют запросы вида "бал*"
+FTS_TOKENIZE = 'unicode61 remove_diacritics 2'
+FTS_PREFIX = '2 3 4'
+
+_TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+
+
+def fts5_available(conn):
+    """Поддерживает ли сборка SQLite модуль FTS5"""
+    try:
+        conn.execute('CREATE VIRTUAL TABLE IF NOT EXISTS temp._fts5_probe USING fts5(x)')
+        conn.execute('DROP TABLE IF EXISTS temp._fts5_probe')
+        return True
+    except sqlite3.OperationalError:
+        return False
+
+
+def fts_schema(fts_table, content_table, content_rowid='id'):
+    """SQL для индекса с внешним содержимым и поддерживающих его триггеров"""
+    columns = ', '.join(FTS_COLUMNS)
+    new_values = ', '.join(f'new.{column}' for column in FTS_COLUMNS)
+    old_values = ', '.join(f'old.{column}' for column in FTS_COLUMNS)
+
+    return [
+        f'''CREATE VIRTUAL TABLE IF NOT EXISTS {fts_table} USING fts5(
+            {columns},
+            content='{content_table}', content_rowid='{content_rowid}',
+            tokenize='{FTS_TOKENIZE}', prefix='{FTS_PREFIX}'
+        )''',
+        f'''CREATE TRIGGER IF NOT EXISTS {fts_table}_ai AFTER INSERT ON {content_table} BEGIN
+            INSERT INTO {fts_table} (rowid, {columns}) VALUES (new.{content_rowid}, {new_values});
+        END''',
+        f'''CREATE TRIGGER IF NOT EXISTS {fts_table}_ad AFTER DELETE ON {content_table} BEGIN
+            INSERT INTO {fts_table} ({fts_table}, rowid, {columns}) VALUES ('delete', old.{content_rowid}, {old_values});
+        END''',
+        f'''CREATE TRIGGER IF NOT EXISTS {fts_table}_au AFTER UPDATE ON {content_table} BEGIN
+            INSERT INTO {fts_table} ({fts_table}, rowid, {columns}) VALUES ('delete', old.{content_rowid}, {old_values});
+            INSERT INTO {fts_table} (rowid, {columns}) VALUES (new.{content_rowid}, {new_values});
+        END''',
+    ]
+
+
+def create_fts_index(cursor, fts_table, content_table, content_rowid='id'):
+    """Создание индекса и заполнение его текущими данными.
+
+    Возвращает False, если FTS5 недоступен (поиск работает через LIKE)."""
+    if not fts5_available(cursor.connection):
+        return False
+
+    exists = cursor.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (fts_table,)
+    ).fetchone()
+
+    for statement in fts_schema(fts_table, content_table, content_rowid):
+        cursor.execute(statement)
+
+    if not exists:
+        cursor.execute(f"INSERT INTO {fts_table} ({fts_table}) VALUES ('rebuild')")
+    return True
+
+
+def fts_table_exists(conn, fts_table):
+    """Создан ли индекс в базе"""
+    return conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (fts_table,)
+    ).fetchone() is not None
+
+
+def build_match_query(text):
+    """Преобразование пользовательского ввода в выражение MATCH.
+
+    Каждое слово ищется по префиксу, все слова обязательны. Спецсимволы
+    синтаксиса FTS5 отбрасываются, поэтому ввод не может сломать запрос."""
+    tokens = [token for token in _TOKEN_RE.findall(text.lower()) if token]
+    if not tokens:
+        return None
+    return ' '.join(f'"{token}"*' for token in tokens)
+
+
+def search_sql(fts_table, content_table, content_rowid='id', where='', columns='p.*'):
+    """SELECT с ранжированием bm25; параметры: выражение MATCH, затем limit"""
+    weights = ', '.join(str(weight) for weight in BM25_WEIGHTS)
+    extra = f' AND {where}' if where else ''
+    return f'''
+        SELECT {columns} FROM {fts_table}
+        JOIN {content_table} AS p ON p.{content_rowid} = {fts_table}.rowid
+        WHERE {fts_table} MATCH ?{extra}
+        ORDER BY bm25({fts_table}, {weights})
+        LIMIT ?
+    '''
+
+
+# ==================== ИНДЕКС В ПАМЯТИ ====================
+
+# Транслитерация: русские и латинские написания брендов сводятся к одному виду
+_TRANSLIT = str.maketrans({
+    'а': 'a', 'б': 'b', 'в': 'v', 'г': 'g', 'д': 'd', 'е': 'e', 'ё': 'e', 'ж': 'zh',
+    'з': 'z', 'и': 'i', 'й': 'i', 'к': 'k', 'л': 'l', 'м': 'm', 'н': 'n', 'о': 'o',
+    'п': 'p', 'р': 'r', 'с': 's', 'т': 't', 'у': 'u', 'ф': 'f', 'х': 'h', 'ц': 'c',
+    'ч': 'ch', 'ш': 'sh', 'щ': 'sch', 'ъ': '', 'ы': 'y', 'ь': '', 'э': 'e', 'ю': 'yu',
+    'я': 'ya', 'à': 'a', 'á': 'a', 'â': 'a', 'è': 'e', 'é': 'e', 'ê': 'e', 'ë': 'e',
+    'ì': 'i', 'í': 'i', 'ò': 'o', 'ó': 'o', 'ô': 'o', 'ù': 'u', 'ú': 'u', 'ü': 'u', 'ç': 'c',
+})
+
+
+def normalize_tokens(text):
+    """Слова текста в нижнем регистре и латинской транслитерации"""
+    if not text:
+        return []
+    return [token for token in (t.translate(_TRANSLIT) for t in _TOKEN_RE.findall(text.lower())) if token]
+
+
+def trigrams(term):
+    padded = f'  {term} '
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def bounded_levenshtein(a, b, limit):
+    """Расстояние Левенштейна или limit + 1, если оно больше limit"""
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    previous = list(range(len(b) + 1))
+    for i, char_a in enumerate(a, 1):
+        current = [i] + [0] * len(b)
+        row_min = i
+        for j, char_b in enumerate(b, 1):
+            current[j] = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (char_a != char_b))
+            row_min = min(row_min, current[j])
+        if row_min > limit:
+            return limit + 1
+        previous = current
+    return previous[-1]
+
+
+class _TrieNode:
+    __slots__ = ('children', 'terminal')
+
+    def __init__(self):
+        self.children = {}
+        self.terminal = False
+
+
+class SearchIndex:
+    """Индекс товаров в памяти: точные слова, префиксы и опечатки.
+
+    Слово запроса сопоставляется со словарем индекса в три этапа: точное
+    совпадение, продолжение по префиксному дереву и, если слово не нашлось,
+    кандидаты по общим триграммам с проверкой расстояния Левенштейна."""
+
+    # Вес поля в релевантности документа
+    FIELD_WEIGHTS = {'name': 3.0, 'brand': 3.0, 'article': 2.0, 'category': 1.0}
+    PREFIX_PENALTY = 0.6
+    TYPO_PENALTY = 0.4
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._documents = {}   # id -> (данные для отображения, {слово: вес})
+        self._postings = {}    # слово -> {id: вес}
+        self._trigrams = {}    # триграмма -> {слово}
+        self._trie = _TrieNode()
+
+    def __len__(self):
+        return len(self._documents)
+
+    # ---------- изменение ----------
+
+    def upsert(self, doc_id, fields, display=None):
+        """Добавление или обновление документа (поля: name, brand, category, article)"""
+        terms = {}
+        for field, weight in self.FIELD_WEIGHTS.items():
+            for term in normalize_tokens(fields.get(field)):
+                terms[term] = max(terms.get(term, 0), weight)
+
+        with self._lock:
+            self._remove(doc_id)
+            self._documents[doc_id] = (display or dict(fields), terms)
+            for term, weight in terms.items():
+                postings = self._postings.get(term)
+                if postings is None:
+                    postings = self._postings[term] = {}
+                    self._add_term(term)
+                postings[doc_id] = weight
+
+    def remove(self, doc_id):
+        with self._lock:
+            self._remove(doc_id)
+
+    def clear(self):
+        with self._lock:
+            self._documents.clear()
+            self._postings.clear()
+            self._trigrams.clear()
+            self._trie = _TrieNode()
+
+    def _remove(self, doc_id):
+        document = self._documents.pop(doc_id, None)
+        if document is None:
+            return
+        for term in document[1]:
+            postings = self._postings.get(term)
+            if postings is None:
+                continue
+            postings.pop(doc_id, None)
+            if not postings:
+                del self._postings[term]
+                self._drop_term(term)
+
+    def _add_term(self, term):
+        node = self._trie
+        for char in term:
+            node = node.children.setdefault(char, _TrieNode())
+        node.terminal = True
+        for gram in trigrams(term):
+            self._trigrams.setdefault(gram, set()).add(term)
+
+    def _drop_term(self, term):
+        path = [self._trie]
+        for char in term:
+            node = path[-1].children.get(char)
+            if node is None:
+                return
+            path.append(node)
+        path[-1].terminal = False
+        # Удаляем опустевшие ветви дерева
+        for depth in range(len(term), 0, -1):
+            node = path[depth]
+            if node.terminal or node.children:
+                break
+            del path[depth - 1].children[term[depth - 1]]
+        for gram in trigrams(term):
+            terms = self._trigrams.get(gram)
+            if terms is not None:
+                terms.discard(term)
+                if not terms:
+                    del self._trigrams[gram]
+
+    # ---------- поиск ----------
+
+    def _completions(self, prefix, limit):
+        node = self._trie
+        for char in prefix:
+            node = node.children.get(char)
+            if node is None:
+                return []
+        found = []
+        stack = [(node, prefix)]
+        while stack and len(found) < limit:
+            node, term = stack.pop()
+            if node.terminal:
+                found.append(term)
+            # Короткие продолжения первыми
+            for char in sorted(node.children, reverse=True):
+                stack.append((node.children[char], term + char))
+        return found
+
+    def _fuzzy_terms(self, token, max_distance):
+        grams = trigrams(token)
+        # Каждая опечатка портит не более трех триграмм
+        threshold = max(1, len(grams) - 3 * max_distance)
+        # Слово с threshold общими триграммами обязано содержать хотя бы одну
+        # из (len - threshold + 1) самых редких - кандидатов берем только из них
+        ordered = sorted(grams, key=lambda gram: len(self._trigrams.get(gram, ())))
+        candidates = set()
+        for gram in ordered[:len(grams) - threshold + 1]:
+            candidates.update(self._trigrams.get(gram, ()))
+
+        matches = []
+        for term in candidates:
+            if abs(len(term) - len(token)) > max_distance:
+                continue
+            if len(grams & trigrams(term)) < threshold:
+                continue
+            distance = bounded_levenshtein(token, term, max_distance)
+            if distance <= max_distance:
+                matches.append((term, distance))
+        return matches
+
+    def _expand(self, token, allow_prefix, completions=50):
+        """Варианты слова запроса: {слово индекса: множитель релевантности}"""
+        variants = {}
+        if token in self._postings:
+            variants[token] = 1.0
+        if allow_prefix and len(token) >= 2:
+            for term in self._completions(token, completions):
+                variants.setdefault(term, self.PREFIX_PENALTY)
+        if not variants and len(token) >= 4:
+            # Сначала одна опечатка; две - только для длинных слов и если одной мало
+            for max_distance in ((1, 2) if len(token) > 6 else (1,)):
+                for term, distance in self._fuzzy_terms(token, max_distance):
+                    variants[term] = self.TYPO_PENALTY / distance
+                if variants:
+                    break
+        return variants
+
+    def _token_postings(self, variants):
+        """Документы, подходящие под слово запроса: {id: релевантность}"""
+        if len(variants) == 1:
+            term, factor = next(iter(variants.items()))
+            postings = self._postings.get(term, {})
+            return postings if factor == 1.0 else {doc_id: weight * factor for doc_id, weight in postings.items()}
+        scores = {}
+        for term, factor in variants.items():
+            for doc_id, weight in self._postings.get(term, {}).items():
+                score = weight * factor
+                if score > scores.get(doc_id, 0):
+                    scores[doc_id] = score
+        return scores
+
+    def search(self, query, limit=10, prefix_last=True):
+        """Id документов по убыванию релевантности.
+
+        Документ должен содержать все слова запроса (с учетом префиксов и
+        опечаток); если таких нет, возвращаются документы с частью слов."""
+        tokens = normalize_tokens(query)
+        if not tokens:
+            return []
+
+        with self._lock:
+            expanded = []
+            for position, token in enumerate(tokens):
+                allow_prefix = prefix_last and position == len(tokens) - 1
+                variants = self._expand(token, allow_prefix)
+                if variants:
+                    size = sum(len(self._postings.get(term, ())) for term in variants)
+                    expanded.append((size, variants))
+
+            if not expanded:
+                return []
+
+            # Пересечение начинаем с самого редкого слова: остальные слова
+            # проверяются точечно только для оставшихся кандидатов
+            expanded.sort(key=lambda item: item[0])
+            if len(expanded) == 1 and len(expanded[0][1]) == 1:
+                # Одно слово с одним вариантом: порядок задают веса полей
+                scores = self._postings.get(next(iter(expanded[0][1])), {})
+            else:
+                scores = dict(self._token_postings(expanded[0][1]))
+            for _, variants in expanded[1:]:
+                narrowed = {}
+                for doc_id, score in scores.items():
+                    best = 0
+                    for term, factor in variants.items():
+                        weight = self._postings.get(term, {}).get(doc_id)
+                        if weight is not None and weight * factor > best:
+                            best = weight * factor
+                    if best:
+                        narrowed[doc_id] = score + best
+                scores = narrowed
+                if not scores:
+                    break
+
+            if not scores or len(expanded) < len(tokens):
+                # Не все слова нашлись: ранжируем по сумме совпавших слов
+                partial = {}
+                for _, variants in expanded:
+                    for doc_id, score in self._token_postings(variants).items():
+                        partial[doc_id] = partial.get(doc_id, 0) + score
+                scores = partial
+
+            return self._top(scores, limit)
+
+    @staticmethod
+    def _top(scores, limit):
+        """Первые limit документов по убыванию релевантности.
+
+        Различных значений релевантности немного (веса полей и штрафы),
+        поэтому документы отбираются по уровням, без сортировки всех."""
+        ranked = []
+        for value in sorted(set(scores.values()), reverse=True):
+            ranked.extend(sorted(doc_id for doc_id, score in scores.items() if score == value))
+            if len(ranked) >= limit:
+                break
+        return ranked[:limit]
+
+    def suggest(self, query, limit=8):
+        """Подсказки по мере ввода: данные документов для отображения"""
+        doc_ids = self.search(query, limit=limit, prefix_last=True)
+        with self._lock:
+            return [self._documents[doc_id][0] for doc_id in doc_ids if doc_id in self._documents]
@@ -0,0 +1,220 @@
+# serializers.py - Сериализация товаров с кэшем готовых JSON-фрагментов
+import copy
+import json
+import threading
+from collections import OrderedDict
+
+PLACEHOLDER_IMAGE = '/static/img/placeholder.jpg'
+
+
+def _isoformat(value):
+    return value.isoformat() if value else None
+
+
+def _images(product):
+    if product.images:
+        try:
+            return json.loads(product.images)
+        except (TypeError, ValueError):
+            return []
+    return []
+
+
+# Функция image_url -> URL производных изображения и функция image_url -> версия
+# ее результата, например хэш файла (устанавливаются веб-приложением)
+_image_resolver = None
+_image_version = None
+
+
+def set_image_resolver(resolver, version=None):
+    global _image_resolver, _image_version
+    _image_resolver = resolver
+    _image_version = version
+
+
+def _image_cache_version(product):
+    if _image_version is None or not product.image_url:
+        return None
+    return _image_version(product.image_url)
+
+
+def _image_variants(product):
+    if _image_resolver is None or not product.image_url:
+        return None
+    return _image_resolver(product.image_url)
+
+
+def _images_with_main(product):
+    """Галерея с основным изображением на первом месте"""
+    images = _images(product)
+    if product.image_url and product.image_url not in images:
+        images.insert(0, product.image_url)
+    return images
+
+
+# Поля: имя в ответе -> функция получения значения из модели
+FIELDS = {
+    'id': lambda p: p.id,
+    'article': lambda p: p.article,
+    'name': lambda p: p.name,
+    'description': lambda p: p.description or '',
+    'detailed_description': lambda p: p.detailed_description or '',
+    'price': lambda p: p.price,
+    'old_price': lambda p: p.old_price,
+    'discount': lambda p: p.discount,
+    'category': lambda p: p.category,
+    'subcategory': lambda p: p.subcategory,
+    'brand': lambda p: p.brand or '',
+    'image_url': lambda p: p.image_url or PLACEHOLDER_IMAGE,
+    'images': _images,
+    'image_variants': _image_variants,
+    'stock': lambda p: p.stock,
+    'is_new': lambda p: p.is_new,
+    'is_hit': lambda p: p.is_hit,
+    'is_exclusive': lambda p: p.is_exclusive,
+    'is_limited': lambda p: p.is_limited,
+    'is_active': lambda p: p.is_active,
+    'color': lambda p: p.color or '',
+    'size': lambda p: p.size or '',
+    'material': lambda p: p.material or '',
+    'country': lambda p: p.country or '',
+    'season': lambda p: p.season or '',
+    'weight': lambda p: p.weight,
+    'dimensions': lambda p: p.dimensions,
+    'care_instructions': lambda p: p.care_instructions,
+    'created_at': lambda p: _isoformat(p.created_at),
+    'updated_at': lambda p: _isoformat(p.updated_at),
+}
+
+LIST_FIELDS = (
+    'id', 'article', 'name', 'description', 'detailed_description', 'price', 'old_price',
+    'discount', 'category', 'subcategory', 'brand', 'image_url', 'images', 'stock',
+    'is_new', 'is_hit', 'is_exclusive', 'is_limited', 'color', 'size', 'material',
+    'country', 'season', 'created_at', 'updated_at'
+)
+
+# Проекции: набор полей под конкретного потребителя.
+# Поле может быть переопределено парой (имя, функция).
+PROJECTIONS = {
+    # Карточка товара в списках, поиске и подборках
+    'card': (
+        'id', 'name', 'category', 'brand', 'price', 'old_price', 'discount', 'image_url',
+        'stock', 'is_new', 'is_hit', 'is_exclusive', 'is_limited', 'image_variants'
+    ),
+    # Список каталога (/api/products)
+    'list': LIST_FIELDS + ('image_variants',),
+    # Страница товара: галерея включает основное изображение
+    'detail': LIST_FIELDS + (
+        'image_variants',
+        ('subcategory', lambda p: p.subcategory or ''),
+        ('images', _images_with_main),
+    ),
+    # Синхронизация с ботом: все поля, включая деактивированные товары
+    'sync': LIST_FIELDS + ('is_active', 'weight', 'dimensions', 'care_instructions'),
+    # Товар внутри позиции корзины
+    'cart_line': ('name', 'article', 'price', 'image_url', 'stock'),
+    # Товар позиции в GET /api/cart/sync: имена полей прежнего API
+    'cart_sync_line': (
+        ('product_name', FIELDS['name']),
+        ('product_article', FIELDS['article']),
+        'price', 'image_url', 'stock',
+    ),
+    # Товар внутри избранного и сравнения
+    'item_ref': (
+        ('product_name', FIELDS['name']),
+        ('product_price', FIELDS['price']),
+        ('product_image', FIELDS['image_url']),
+        ('product_category', FIELDS['category']),
+    ),
+}
+
+
+def _compile(fields):
+    """Сведение описания проекции к упорядоченному списку (имя, функция)"""
+    compiled = OrderedDict()
+    for field in fields:
+        if isinstance(field, tuple):
+            name, getter = field
+        else:
+            name, getter = field, FIELDS[field]
+        compiled[name] = getter
+    return list(compiled.items())
+
+
+class ProductSerializer:
+    """Сериализатор товаров с LRU-кэшем по (id, проекция).
+
+    Запись кэша хранит updated_at товара, для которого она построена:
+    при изменении товара updated_at меняется и запись пересобирается.
+    Для проекций с image_variants в версию входит и версия изображения,
+    так как файл можно заменить, не изменяя строку товара."""
+
+    def __init__(self, max_entries=5000):
+        self.max_entries = max_entries
+        self._projections = {name: _compile(fields) for name, fields in PROJECTIONS.items()}
+        self._with_images = {
+            name for name, getters in self._projections.items()
+            if any(getter is _image_variants for _, getter in getters)
+        }
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _entry(self, product, projection):
+        key = (product.id, projection)
+        version = product.updated_at
+        if projection in self._with_images:
+            version = (version, _image_cache_version(product))
+
+        with self._lock:
+            entry = self._cache.get(key)
+            if entry is not None and entry[0] == version:
+                self._cache.move_to_end(key)
+                self.hits += 1
+                return entry
+
+        data = {name: getter(product) for name, getter in self._projections[projection]}
+        entry = (version, data, json.dumps(data, ensure_ascii=False).encode('utf-8'))
+
+        with self._lock:
+            self.misses += 1
+            self._cache[key] = entry
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.max_entries:
+                self._cache.popitem(last=False)
+        return entry
+
+    def serialize(self, product, projection='list'):
+        """Словарь товара в заданной проекции (копия, можно дополнять)"""
+        return copy.deepcopy(self._entry(product, projection)[1])
+
+    def serialize_bytes(self, product, projection='list'):
+        """Готовый JSON-фрагмент товара"""
+        return self._entry(product, projection)[2]
+
+    def serialize_many_bytes(self, products, projection='list'):
+        """JSON-массив товаров, собранный из кэшированных фрагментов"""
+        return b'[' + b','.join(self.serialize_bytes(product, projection) for product in products) + b']'
+
+    def envelope(self, key, products, projection='list', **meta):
+        """JSON-ответ вида {"success": true, key: [...], **meta} без повторной сериализации товаров"""
+        head = json.dumps({'success': True, **meta}, ensure_ascii=False).encode('utf-8')
+        body = self.serialize_many_bytes(products, projection)
+        return head[:-1] + b', "' + key.encode('utf-8') + b'": ' + body + b'}'
+
+    def invalidate(self, product_id=None):
+        """Сброс кэша товара или всего кэша"""
+        with self._lock:
+            if product_id is None:
+                self._cache.clear()
+                return
+            for projection in self._projections:
+                self._cache.pop((product_id, projection), None)
+
+    def stats(self):
+        with self._lock:
+            return {'entries': len(self._cache), 'hits': self.hits, 'misses': self.misses}
+
+
+product_serializer = ProductSerializer()
@@ -0,0 +1,66 @@
+# showcase.py - Витрины товаров: перемешанные пулы кандидатов вместо ORDER BY random()
+import random
+import threading
+
+
+class ShowcasePools:
+    """Пулы id товаров для витрин (хиты, эксклюзивы, похожие по категории).
+
+    loader() -> {ключ пула: [id]} читает кандидатов одним проходом по каталогу;
+    пулы пересобираются и перемешиваются только при смене поколения каталога.
+    sample() выдает очередное окно пула по кругу, поэтому каждый запрос
+    показывает другие товары без сортировки таблицы."""
+
+    def __init__(self, loader, seed=None):
+        self.loader = loader
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._generation = None
+        self._pools = {}
+        self._positions = {}
+        self.rebuilds = 0
+
+    def refresh(self, generation):
+        """Пересборка пулов, если каталог изменился"""
+        if generation == self._generation:
+            return False
+        with self._lock:
+            if generation == self._generation:
+                return False
+            pools = self.loader()
+            for ids in pools.values():
+                self._random.shuffle(ids)
+            # Начальные позиции случайны: разные процессы показывают разные окна
+            self._positions = {key: self._random.randrange(len(ids)) if ids else 0
+                               for key, ids in pools.items()}
+            self._pools = pools
+            self._generation = generation
+            self.rebuilds += 1
+            return True
+
+    def sample(self, key, count, exclude=()):
+        """До count id из пула key, начиная с текущей позиции; позиция сдвигается"""
+        with self._lock:
+            pool = self._pools.get(key)
+            if not pool:
+                return []
+            start = self._positions[key]
+            self._positions[key] = (start + count) % len(pool)
+
+        result = []
+        for offset in range(len(pool)):
+            item = pool[(start + offset) % len(pool)]
+            if item not in exclude:
+                result.append(item)
+                if len(result) == count:
+                    break
+        return result
+
+    def stats(self):
+        with self._lock:
+            return {
+                'generation': self._generation,
+                'pools': len(self._pools),
+                'candidates': sum(len(ids) for ids in self._pools.values()),
+                'rebuilds': self.rebuilds
+            }
@@ -0,0 +1,150 @@
+# statestore.py - Хранилище состояний диалогов в памяти с TTL
+import copy
+import logging
+import math
+import threading
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+class TimerWheel:
+    """Колесо таймеров: истечение сроков без просмотра всех записей.
+
+    Время делится на тики по tick секунд, срок попадает в ячейку
+    (номер тика % slots). advance() просматривает только ячейки пройденных
+    тиков; записи с более поздним сроком (следующий оборот колеса) остаются
+    в ячейке. Отмена ленивая: владелец сверяет тик сработавшей записи."""
+
+    def __init__(self, tick=1.0, slots=512, now=None):
+        self.tick = tick
+        self.slots = [set() for _ in range(slots)]
+        self.current = int((now if now is not None else time.time()) / tick)
+
+    def schedule(self, key, deadline):
+        """Постановка срока; возвращает тик, в который он сработает"""
+        due = max(math.ceil(deadline / self.tick), self.current + 1)
+        self.slots[due % len(self.slots)].add((due, key))
+        return due
+
+    def advance(self, now):
+        """Сдвиг колеса до момента now; возвращает сработавшие (тик, ключ)"""
+        target = int(now / self.tick)
+        fired = []
+        # За один полный оборот просматриваются все ячейки
+        while self.current < target:
+            self.current += 1
+            slot = self.slots[self.current % len(self.slots)]
+            due = [item for item in slot if item[0] <= self.current]
+            slot.difference_update(due)
+            fired.extend(due)
+            if target - self.current >= len(self.slots):
+                self.current = target - len(self.slots)
+        return fired
+
+
+class StateStore:
+    """Состояния пользователей в памяти: LRU с ограничением размера и TTL.
+
+    Чтение и запись - операции со словарем; истечение сроков обрабатывает
+    TimerWheel в фоновом потоке. Необязательные колбэки:
+    loader(key) -> (state, data, age) - чтение вытесненной записи из
+    постоянного хранилища, on_expire(keys) - удаление истекших записей из него."""
+
+    def __init__(self, ttl=86400, max_entries=50000, tick=60.0, loader=None, on_expire=None):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.loader = loader
+        self.on_expire = on_expire
+        self.wheel = TimerWheel(tick=tick, slots=max(16, math.ceil(ttl / tick) + 1))
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stop = threading.Event()
+        self.evictions = 0
+        self.expired = 0
+
+    def set(self, key, state, data=None, age=0.0):
+        """Сохранение состояния (age - сколько секунд назад оно было создано)"""
+        expires_at = time.time() + self.ttl - age
+        with self._lock:
+            due = self.wheel.schedule(key, expires_at)
+            self._entries[key] = (state, data, expires_at, due)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def get(self, key):
+        """Состояние и копия данных или None"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[2] <= time.time():
+                    del self._entries[key]
+                    entry = None
+                else:
+                    self._entries.move_to_end(key)
+            evicted = self.evictions
+
+        if entry is None:
+            # Запись могла быть вытеснена из памяти, но сохранена в базе
+            if evicted and self.loader:
+                loaded = self.loader(key)
+                if loaded is not None and loaded[2] < self.ttl:
+                    self.set(key, *loaded)
+                    return loaded[0], copy.deepcopy(loaded[1])
+            return None
+        # Обработчики изменяют данные перед сохранением - отдаем копию
+        return entry[0], copy.deepcopy(entry[1])
+
+    def delete(self, key):
+        """Удаление состояния; True, если оно было"""
+        with self._lock:
+            return self._entries.pop(key, None) is not None
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def expire(self, now=None):
+        """Удаление записей, срок которых истек к моменту now"""
+        now = now if now is not None else time.time()
+        with self._lock:
+            expired = []
+            for due, key in self.wheel.advance(now):
+                entry = self._entries.get(key)
+                # Запись пересохранена позже - срабатывание устарело
+                if entry is not None and entry[3] == due:
+                    del self._entries[key]
+                    expired.append(key)
+            self.expired += len(expired)
+
+        if expired and self.on_expire:
+            try:
+                self.on_expire(expired)
+            except Exception as e:
+                logger.error(f"Ошибка удаления истекших состояний: {e}")
+        return expired
+
+    def start(self):
+        """Запуск фонового истечения сроков"""
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name='state-expiry', daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(self.wheel.tick):
+            self.expire()
+
+    def stop(self):
+        self._stop.set()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        with self._lock:
+            return {'entries': len(self._entries), 'evictions': self.evictions, 'expired': self.expired}
@@ -17,6 +17,9 @@ class CatalogManager {
         };
         this.currentPage = 1;
         this.productsPerPage = 12;
+        this.apiPageSize = 100;
+        // Выборка сервера, из которой загружены товары (категория и сортировка страницы)
+        this.loaded = { category: 'all', sort: 'newest' };
         this.totalPages = 1;
         this.isLoading = false;
         this.isMobile = window.innerWidth < 768;
@@ -325,15 +328,22 @@ class CatalogManager {
         this.showLoading();
         
         try {
-            // Сначала пытаемся загрузить с сервера
-            const response = await fetch('/api/products');
+            // Первая страница встроена в шаблон, остальные догружаются по курсору
+            const initialPage = this.readInitialPage();
+            let data;
+            if (initialPage) {
+                this.applyInitialFilters(initialPage);
+                data = { success: true, products: initialPage.products, next_page_token: initialPage.next_page_token };
+            } else {
+                const response = await fetch(this.productsPageUrl());
+                data = response.ok ? await response.json() : null;
+            }
             
-            if (response.ok) {
-                const data = await response.json();
+            if (data) {
                 console.log('CatalogManager: Получены данные с сервера', data);
                 
                 if (data.success && data.products) {
-                    this.products = data.products;
+                    this.products = data.products.concat(await this.loadRemainingPages(data.next_page_token));
                     console.log(`CatalogManager: Загружено ${this.products.length} продуктов`);
                 } else {
                     // Если сервер вернул ошибку, используем демо-данные
@@ -358,6 +368,55 @@ class CatalogManager {
         this.hideLoading();
     }
 
+    // Первая страница каталога из шаблона (или null)
+    readInitialPage() {
+        const element = document.getElementById('catalog-initial-page');
+        if (!element) return null;
+        try {
+            return JSON.parse(element.textContent);
+        } catch (error) {
+            console.error('CatalogManager: Некорректная первая страница каталога:', error);
+            return null;
+        }
+    }
+
+    // Категория и сортировка из адреса страницы
+    applyInitialFilters(initialPage) {
+        this.loaded = { category: initialPage.category || 'all', sort: initialPage.sort || 'newest' };
+        if (initialPage.category) {
+            this.filters.category = initialPage.category;
+            this.updateCategoryUI(initialPage.category);
+        }
+        if (initialPage.sort) {
+            // Сортировки сервера (price_low) записаны в select через дефис (price-low)
+            this.filters.sort = initialPage.sort.replace('_', '-');
+            const sortSelect = document.getElementById('sort-select');
+            if (sortSelect) sortSelect.value = this.filters.sort;
+        }
+    }
+
+    // Адрес страницы каталога в API: та же выборка, что и у первой страницы
+    productsPageUrl(pageToken) {
+        const params = new URLSearchParams({ limit: this.apiPageSize, include_total: '0', sort: this.loaded.sort });
+        if (this.loaded.category !== 'all') params.set('category', this.loaded.category);
+        if (pageToken) params.set('page_token', pageToken);
+        return `/api/products?${params.toString()}`;
+    }
+
+    // Догрузка остальных страниц по next_page_token
+    async loadRemainingPages(pageToken) {
+        const products = [];
+        while (pageToken) {
+            const response = await fetch(this.productsPageUrl(pageToken));
+            if (!response.ok) break;
+            const data = await response.json();
+            if (!data.success || !data.products) break;
+            products.push(...data.products);
+            pageToken = data.next_page_token;
+        }
+        return products;
+    }
+
     // Получение демо продуктов
     getDemoProducts() {
         const demoProducts = [];
@@ -549,10 +608,30 @@ class CatalogManager {
 
     // Установка фильтра
     setFilter(filterName, value) {
+        if (!this.loadedSelectionCovers(filterName, value)) {
+            // Загруженных товаров недостаточно: страница запрашивается с новой выборкой
+            const category = filterName === 'category' ? value : this.filters.category;
+            const sort = (filterName === 'sort' ? value : this.filters.sort).replace('-', '_');
+            const params = new URLSearchParams({ category: category, sort: sort });
+            window.location.href = `/catalog?${params.toString()}`;
+            return;
+        }
         this.filters[filterName] = value;
         this.applyFilters();
     }
 
+    // Содержит ли загруженная выборка все товары для новой категории или сортировки
+    loadedSelectionCovers(filterName, value) {
+        if (filterName === 'category') {
+            return this.loaded.category === 'all' || this.loaded.category === value;
+        }
+        if (filterName === 'sort') {
+            // Сортировка по скидке загружает только товары со скидкой
+            return this.loaded.sort !== 'discount' || value === 'discount';
+        }
+        return true;
+    }
+
     // Переключение фильтра (для массивов)
     toggleFilter(filterName, value) {
         const filterArray = this.filters[filterName];
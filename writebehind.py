@@ -0,0 +1,245 @@
+# writebehind.py - Отложенная пакетная запись часто обновляемых значений
+import abc
+import atexit
+import json
+import logging
+import os
+import queue
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class _PeriodicFlusher(abc.ABC):
+    """Фоновый поток, вызывающий flush() раз в interval секунд и при остановке"""
+
+    def __init__(self, interval, name):
+        self.interval = interval
+        self.name = name
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _ensure_started(self):
+        if self._thread is None:
+            self.start()
+
+    def start(self):
+        """Запуск фонового сброса (выполняется один раз)"""
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+        self._thread.start()
+        atexit.register(self.stop)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.flush()
+
+    @abc.abstractmethod
+    def flush(self):
+        """Запись накопленных данных"""
+
+    def stop(self):
+        """Остановка фонового потока с финальным сбросом"""
+        self._stop.set()
+        thread = self._thread
+        if thread is not None and thread is not threading.current_thread():
+            thread.join(self.interval + 1)
+        self.flush()
+
+
+class CoalescingBuffer(_PeriodicFlusher):
+    """Буфер отложенной записи с объединением по ключу.
+
+    touch() только запоминает последнее значение ключа в памяти; фоновый поток
+    раз в interval секунд передает накопленные пары (ключ, значение) в
+    flush_func одним пакетом. Повторные обновления ключа между сбросами
+    схлопываются в одну запись. Остаток сбрасывается при остановке процесса."""
+
+    def __init__(self, flush_func, interval=5.0, name='write-behind'):
+        super().__init__(interval, name)
+        self.flush_func = flush_func
+        self._pending = {}
+        self.touches = 0
+        self.flushes = 0
+        self.flushed_rows = 0
+        self.failed_flushes = 0
+        self.last_flush_ms = 0.0
+        self.max_flush_ms = 0.0
+
+    def touch(self, key, value):
+        """Запоминание значения ключа до следующего сброса"""
+        with self._lock:
+            self._pending[key] = value
+            self.touches += 1
+        self._ensure_started()
+
+    def flush(self):
+        """Запись накопленных значений одним пакетом; возвращает число строк"""
+        with self._flush_lock:
+            with self._lock:
+                if not self._pending:
+                    return 0
+                items, self._pending = self._pending, {}
+
+            started = time.perf_counter()
+            try:
+                self.flush_func(list(items.items()))
+            except Exception as e:
+                logger.error(f"Ошибка сброса буфера {self.name}: {e}")
+                with self._lock:
+                    self.failed_flushes += 1
+                    # Возвращаем значения, не затирая более новые
+                    for key, value in items.items():
+                        self._pending.setdefault(key, value)
+                return 0
+
+            elapsed = (time.perf_counter() - started) * 1000
+            with self._lock:
+                self.flushes += 1
+                self.flushed_rows += len(items)
+                self.last_flush_ms = elapsed
+                self.max_flush_ms = max(self.max_flush_ms, elapsed)
+            return len(items)
+
+    def stats(self):
+        """Размер буфера и задержка сброса"""
+        with self._lock:
+            return {
+                'pending': len(self._pending),
+                'touches': self.touches,
+                'flushes': self.flushes,
+                'flushed_rows': self.flushed_rows,
+                'failed_flushes': self.failed_flushes,
+                'last_flush_ms': round(self.last_flush_ms, 2),
+                'max_flush_ms': round(self.max_flush_ms, 2)
+            }
+
+
+class BatchWriter(_PeriodicFlusher):
+    """Асинхронная групповая запись строк через ограниченную очередь.
+
+    put() не блокирует вызывающий поток: строка ставится в очередь, а фоновый
+    поток раз в interval секунд записывает накопленное пачками по batch_size
+    (одна транзакция на пачку в write_func). При переполнении очереди строки
+    дописываются в файл spill_path и дозаписываются после разгрузки очереди,
+    без spill_path - отбрасываются. Строки должны сериализоваться в JSON."""
+
+    def __init__(self, write_func, interval=1.0, max_queue=10000, batch_size=1000,
+                 spill_path=None, name='batch-writer'):
+        super().__init__(interval, name)
+        self.write_func = write_func
+        self.batch_size = batch_size
+        self.spill_path = spill_path
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._spill_lock = threading.Lock()
+        self.queued = 0
+        self.written = 0
+        self.spilled = 0
+        self.replayed = 0
+        self.dropped = 0
+        self.failed_batches = 0
+        self.last_flush_ms = 0.0
+        self.max_flush_ms = 0.0
+
+    def put(self, row):
+        """Постановка строки в очередь; False, если строка отброшена"""
+        self._ensure_started()
+        try:
+            self._queue.put_nowait(row)
+        except queue.Full:
+            return self._overflow([row])
+        with self._lock:
+            self.queued += 1
+        return True
+
+    def _overflow(self, rows):
+        """Сброс строк в файл или отказ от них при перегрузке"""
+        if self.spill_path:
+            try:
+                with self._spill_lock:
+                    with open(self.spill_path, 'a', encoding='utf-8') as f:
+                        for row in rows:
+                            f.write(json.dumps(row, ensure_ascii=False) + '\n')
+                with self._lock:
+                    self.spilled += len(rows)
+                return True
+            except (OSError, TypeError, ValueError) as e:
+                logger.error(f"Ошибка записи в файл переполнения {self.spill_path}: {e}")
+
+        with self._lock:
+            self.dropped += len(rows)
+        return False
+
+    def _write(self, rows):
+        started = time.perf_counter()
+        try:
+            self.write_func(rows)
+        except Exception as e:
+            logger.error(f"Ошибка записи пачки {self.name} ({len(rows)} строк): {e}")
+            with self._lock:
+                self.failed_batches += 1
+            self._overflow(rows)
+            return
+
+        elapsed = (time.perf_counter() - started) * 1000
+        with self._lock:
+            self.written += len(rows)
+            self.last_flush_ms = elapsed
+            self.max_flush_ms = max(self.max_flush_ms, elapsed)
+
+    def _drain(self):
+        rows = []
+        while len(rows) < self.batch_size:
+            try:
+                rows.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return rows
+
+    def _replay_spill(self):
+        """Дозапись строк из файла переполнения"""
+        if not self.spill_path:
+            return
+        replay_path = self.spill_path + '.replay'
+        with self._spill_lock:
+            if not os.path.exists(self.spill_path) or os.path.exists(replay_path):
+                return
+            os.replace(self.spill_path, replay_path)
+
+        with open(replay_path, encoding='utf-8') as f:
+            rows = [tuple(json.loads(line)) for line in f if line.strip()]
+        os.remove(replay_path)
+        with self._lock:
+            self.replayed += len(rows)
+        for start in range(0, len(rows), self.batch_size):
+            self._write(rows[start:start + self.batch_size])
+
+    def flush(self):
+        """Запись всех строк очереди пачками по batch_size"""
+        with self._flush_lock:
+            while True:
+                rows = self._drain()
+                if not rows:
+                    break
+                self._write(rows)
+            self._replay_spill()
+
+    def stats(self):
+        """Счетчики очереди: в очереди, записано, в файле переполнения, отброшено"""
+        with self._lock:
+            return {
+                'queue_depth': self._queue.qsize(),
+                'queued': self.queued,
+                'written': self.written,
+                'spilled': self.spilled,
+                'replayed': self.replayed,
+                'dropped': self.dropped,
+                'failed_batches': self.failed_batches,
+                'last_flush_ms': round(self.last_flush_ms, 2),
+                'max_flush_ms': round(self.max_flush_ms, 2)
+            }